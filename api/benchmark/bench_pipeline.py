@@ -0,0 +1,474 @@
+"""
+Benchmark offline della pipeline backend (nessun servizio Azure).
+
+Esegue in-process ProcessTelemetry (single e batch), GenerateAdvice (sync e async), get_vehicles,
+get_vehicle_history e le DELETE admin, con fake locali per Cosmos (LocalContainer), coda, SignalR,
+IoT Hub e LLM (FakeChatModel). Ogni dipendenza ha una latenza iniettabile.
+
+Per ogni stage: throughput, latenza p50/p95/p99 (passata di timing senza tracemalloc) e, in una
+seconda passata con tracemalloc, picco di memoria e blocchi/KiB ancora allocati a fine stage.
+
+USO (dalla cartella api/):
+    python -m benchmark.bench_pipeline --output bench.json
+    python -m benchmark.bench_pipeline --cosmos-latency-ms 5 --llm-latency-ms 300 --stages advice.single,advice.async
+    python -m benchmark.bench_pipeline --output new.json --compare bench.json   # delta rispetto a un run precedente
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+
+
+# --- Fake con latenza iniettabile ---
+
+class SlowProxy:
+    """Inoltra ogni chiamata di metodo all'oggetto reale dopo `latency_ms` (sleep o asyncio.sleep)."""
+
+    def __init__(self, target, latency_ms):
+        self._target = target
+        self._latency = latency_ms / 1000.0
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr) or not self._latency:
+            return attr
+        if asyncio.iscoroutinefunction(attr):
+            @functools.wraps(attr)
+            async def slow_async(*args, **kwargs):
+                await asyncio.sleep(self._latency)
+                return await attr(*args, **kwargs)
+            return slow_async
+
+        @functools.wraps(attr)
+        def slow(*args, **kwargs):
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return slow
+
+
+class Out:
+    """func.Out in memoria; `sink` riceve il valore (es. binding Cosmos → LocalContainer)."""
+
+    def __init__(self, latency_ms=0.0, sink=None):
+        self.value = None
+        self.latency = latency_ms / 1000.0
+        self.sink = sink
+
+    def set(self, value):
+        if self.latency:
+            time.sleep(self.latency)
+        self.value = value
+        if self.sink:
+            self.sink(value)
+
+    def get(self):
+        return self.value
+
+
+class FakeRegistryManager:
+    """IoTHubRegistryManager fittizio: conta i messaggi C2D."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.sent = 0
+
+    def send_c2d_message(self, device_id, message, properties=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.sent += 1
+
+
+# --- Misura ---
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _timed(op, inputs):
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        t0 = time.perf_counter()
+        op(item)
+        latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - started
+
+
+def _timed_async(op, inputs):
+    """Tutte le operazioni concorrenti sullo stesso event loop (come un worker async)."""
+    async def run():
+        async def one(item):
+            t0 = time.perf_counter()
+            await op(item)
+            return time.perf_counter() - t0
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one(item) for item in inputs))
+        return list(latencies), time.perf_counter() - started
+    return asyncio.run(run())
+
+
+class Stage:
+    """setup() → lista di input (rigenerata per ogni passata); op(input) esegue un'operazione che
+    elabora `items_per_op` elementi (es. eventi di un batch)."""
+
+    def __init__(self, name, setup, op, items_per_op=1, is_async=False, teardown=None):
+        self.name = name
+        self.setup = setup
+        self.op = op
+        self.items_per_op = items_per_op
+        self.is_async = is_async
+        self.teardown = teardown
+
+    def _run(self, inputs):
+        return (_timed_async if self.is_async else _timed)(self.op, inputs)
+
+    def measure(self, memory_ops):
+        inputs = self.setup()
+        try:
+            latencies, elapsed = self._run(inputs)
+        finally:
+            if self.teardown:
+                self.teardown()
+
+        # Passata di memoria separata: tracemalloc rallenta molto le allocazioni
+        inputs = self.setup()[:memory_ops]
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            self._run(inputs)
+            peak = tracemalloc.get_traced_memory()[1] - base
+            diff = tracemalloc.take_snapshot().compare_to(before, "filename")
+        finally:
+            tracemalloc.stop()
+            if self.teardown:
+                self.teardown()
+
+        ordered = sorted(latencies)
+        ops, items = len(latencies), len(latencies) * self.items_per_op
+        return {
+            "ops": ops,
+            "items": items,
+            "elapsed_sec": round(elapsed, 4),
+            "ops_per_sec": round(ops / elapsed, 1) if elapsed else 0.0,
+            "items_per_sec": round(items / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "mean": round(sum(latencies) / ops * 1000, 3) if ops else 0.0,
+                "p50": round(_percentile(ordered, 50) * 1000, 3),
+                "p95": round(_percentile(ordered, 95) * 1000, 3),
+                "p99": round(_percentile(ordered, 99) * 1000, 3),
+                "max": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+            },
+            "memory": {
+                "ops": len(inputs),
+                "peak_kib": round(peak / 1024, 1),
+                "retained_kib": round(sum(s.size_diff for s in diff) / 1024, 1),
+                "retained_blocks": sum(s.count_diff for s in diff),
+            },
+        }
+
+
+# --- Ambiente fittizio ---
+
+def configure_environment(args):
+    """Variabili lette all'import dei moduli shared: vanno impostate prima di importare i blueprint."""
+    os.environ["ADVICE_LLM_PROVIDER"] = "fake"
+    os.environ["FAKE_LLM_LATENCY_MS"] = str(args.llm_latency_ms)
+    os.environ["ADVICE_CACHE_ENABLED"] = "false" if args.no_cache else os.environ.get("ADVICE_CACHE_ENABLED", "true")
+    os.environ.pop("CosmosDBConnectionString__accountEndpoint", None)
+    os.environ.pop("IotHubHostName", None)
+    os.environ.pop("DELETE_CHECKPOINT_DIR", None)
+
+
+class Backend:
+    """Blueprint reali con i singleton di cosmos_client e iot_hub sostituiti dai fake."""
+
+    def __init__(self, args):
+        import azure.functions as func
+        from blueprints import admin, advice, telemetry, vehicles
+        from shared import cosmos_client, iot_hub
+        from shared.local_cosmos import LocalAsyncContainer, LocalContainer
+
+        self.func, self.args = func, args
+        self.telemetry, self.advice, self.vehicles, self.admin = telemetry, advice, vehicles, admin
+        self.cosmos_client = cosmos_client
+
+        self.container = LocalContainer("Telemetry", partition_key_field=args.partition_key)
+        cosmos_client._partition_key_field = args.partition_key
+        cosmos_client._container = SlowProxy(self.container, args.cosmos_latency_ms)
+        cosmos_client._async_container = SlowProxy(LocalAsyncContainer(self.container), args.cosmos_latency_ms)
+        cosmos_client._vehicles_container = SlowProxy(LocalContainer("Vehicles", "id"), args.cosmos_latency_ms)
+        cosmos_client._rollups_container = SlowProxy(LocalContainer("Rollups", "vehicle_id"), args.cosmos_latency_ms)
+        cosmos_client._jobs_container = SlowProxy(LocalContainer("Jobs", "id"), args.cosmos_latency_ms)
+        self.iot = FakeRegistryManager(args.c2d_latency_ms)
+        iot_hub._iot_registry_manager = self.iot
+
+        self.rng = random.Random(args.seed)
+        self.vehicle_ids = [f"Bus-{i + 1:03d}" for i in range(args.vehicles)]
+        self._clock = time.time()
+        self._seq = {}  # vehicle_id -> ultima sequenza (come l'emulatore)
+
+    # --- Generatori di input ---
+
+    def reading(self):
+        self._clock += 0.001
+        vehicle_id = self.rng.choice(self.vehicle_ids)
+        self._seq[vehicle_id] = self._seq.get(vehicle_id, 0) + 1
+        return {
+            "vehicle_id": vehicle_id,
+            "seq": self._seq[vehicle_id],
+            "boot_id": "bench",
+            "speed": round(self.rng.uniform(0, 180), 2),
+            "rpm": self.rng.randint(600, 6000),
+            "gear": self.rng.randint(1, 6),
+            "fuel_level": round(self.rng.uniform(0, 100), 2),
+            "timestamp": self._clock,
+        }
+
+    def events(self, count):
+        return [self.func.EventHubEvent(body=json.dumps(self.reading()).encode("utf-8")) for _ in range(count)]
+
+    def packed_events(self, count, wire_format):
+        """`count` letture in messaggi da --samples-per-message letture (JSON array o binario)."""
+        from shared.wire_format import encode
+        per_message = self.args.samples_per_message
+        return [self.func.EventHubEvent(body=encode([self.reading() for _ in range(per_message)], wire_format)[0])
+                for _ in range(max(1, count // per_message))]
+
+    def store(self, value):
+        """Sink del binding Cosmos: Document o DocumentList → upsert nel container locale."""
+        docs = value if isinstance(value, self.func.DocumentList) else [value]
+        for doc in docs:
+            self.container.upsert_item(doc.to_dict())
+
+    def outputs(self):
+        return (Out(sink=self.store), Out(self.args.signalr_latency_ms), Out(self.args.queue_latency_ms))
+
+    def seed(self, per_vehicle):
+        """Popola Telemetry con `per_vehicle` documenti per veicolo (via ProcessTelemetry batch)."""
+        events = self.events(per_vehicle * len(self.vehicle_ids))
+        for i in range(0, len(events), 100):
+            self.telemetry.process_telemetry_batch(events[i:i + 100], *self.outputs())
+
+    def advice_messages(self, count):
+        docs = self.container.all_items()[:count]
+        return [self.func.QueueMessage(body=json.dumps({
+            "doc_id": doc["id"], "vehicle_id": doc["vehicle_id"],
+            "speed": doc["speed"], "rpm": doc["rpm"], "fuel_level": doc["fuel_level"],
+        })) for doc in docs]
+
+    def request(self, method, url, params=None, route_params=None):
+        return self.func.HttpRequest(method, url, params=params or {}, route_params=route_params or {}, body=b"")
+
+    # --- Stage ---
+
+    def stages(self):
+        args, t, a, v, adm = self.args, self.telemetry, self.advice, self.vehicles, self.admin
+        from shared import ai_advisor
+        batch = args.batch_size
+        per_message = args.samples_per_message
+
+        def advice_setup():
+            a._semaphore = None  # il semaforo async è legato all'event loop di ogni passata
+            if a.get_c2d_dispatcher():
+                a.get_c2d_dispatcher().clear()  # ogni passata parte senza stato di dedup/rate limit
+            if len(self.container.all_items()) < args.advice_messages:
+                self.seed(-(-args.advice_messages // len(self.vehicle_ids)))
+            return self.advice_messages(args.advice_messages)
+
+        def advice_teardown():
+            if a.get_c2d_dispatcher():
+                a.get_c2d_dispatcher().flush(timeout=30)
+
+        def history_setup(params):
+            def setup():
+                if len(self.container.all_items()) < args.history_docs:
+                    self.seed(-(-args.history_docs // len(self.vehicle_ids)))
+                return [self.request("GET", "/api/history", params, {"vehicleId": vid})
+                        for vid in self.vehicle_ids[:args.http_requests]] * max(1, args.http_requests // len(self.vehicle_ids))
+            return setup
+
+        def reseed_setup(make_inputs):
+            def setup():
+                self.container._items.clear()
+                self.seed(args.delete_docs // len(self.vehicle_ids))
+                return make_inputs()
+            return setup
+
+        def delete_all(req):
+            # Simula la coda delete-jobs: ogni messaggio accodato avvia la fetta successiva
+            queue = Out()
+            adm.delete_all_telemetry(req, queue)
+            while queue.value:
+                msg, queue = self.func.QueueMessage(body=queue.value.encode("utf-8")), Out()
+                adm.continue_delete_job(msg, queue)
+
+        @contextlib.contextmanager
+        def no_registry():
+            original = v.get_vehicle_registry
+            v.get_vehicle_registry = lambda: None
+            try:
+                yield
+            finally:
+                v.get_vehicle_registry = original
+
+        def distinct_scan(req):
+            with no_registry():
+                v.get_vehicles(req)
+
+        return [
+            Stage("telemetry.single", lambda: self.events(args.events),
+                  lambda event: t.process_telemetry(event, *self.outputs())),
+            Stage("telemetry.batch", lambda: [self.events(batch) for _ in range(max(1, args.events // batch))],
+                  lambda events: t.process_telemetry_batch(events, *self.outputs()), items_per_op=batch),
+            # Più letture per messaggio D2C: throughput in letture/s, JSON array contro formato binario
+            Stage("telemetry.packed_json", lambda: self.packed_events(args.events, "json"),
+                  lambda event: t.process_telemetry(event, *self.outputs()), items_per_op=per_message),
+            Stage("telemetry.packed_binary", lambda: self.packed_events(args.events, "binary"),
+                  lambda event: t.process_telemetry(event, *self.outputs()), items_per_op=per_message),
+            Stage("telemetry.batch_binary",
+                  lambda: [self.packed_events(batch, "binary") for _ in range(max(1, args.events // batch))],
+                  lambda events: t.process_telemetry_batch(events, *self.outputs()),
+                  items_per_op=max(1, batch // per_message) * per_message),
+            # Redelivery Event Hub: ogni batch arriva due volte, la seconda viene scartata dal dedup
+            Stage("telemetry.redelivery",
+                  lambda: [events for events in (self.events(batch) for _ in range(max(1, args.events // batch // 2)))
+                           for _ in range(2)],
+                  lambda events: t.process_telemetry_batch(events, *self.outputs()), items_per_op=batch),
+            Stage("advice.single", advice_setup,
+                  lambda msg: a.generate_advice(msg, Out(args.signalr_latency_ms)), teardown=advice_teardown),
+            Stage("advice.async", advice_setup,
+                  lambda msg: a.generate_advice_async(msg, Out(args.signalr_latency_ms)), is_async=True,
+                  teardown=advice_teardown),
+            Stage("vehicles.registry", lambda: [self.request("GET", "/api/vehicles")] * args.http_requests,
+                  v.get_vehicles),
+            Stage("vehicles.distinct_scan", lambda: [self.request("GET", "/api/vehicles")] * args.http_requests,
+                  distinct_scan),
+            Stage("history.page", history_setup({"limit": "200"}), v.get_vehicle_history),
+            Stage("history.minmax", history_setup({"downsample": "minmax", "bucket": "1"}), v.get_vehicle_history),
+            Stage("history.lttb", history_setup({"downsample": "lttb", "points": "100"}), v.get_vehicle_history),
+            Stage("history.rescore", history_setup({}), v.rescore_vehicle_history),
+            Stage("rules.fallback_batch", lambda: [[{"doc_id": str(i), **self.reading()} for i in range(batch)]
+                                                   for _ in range(max(1, args.events // batch))],
+                  ai_advisor._fallback_advice_batch, items_per_op=batch),
+            Stage("admin.delete_vehicle",
+                  reseed_setup(lambda: [self.request("DELETE", "/api/telemetry", route_params={"vehicleId": vid})
+                                        for vid in self.vehicle_ids]),
+                  adm.delete_vehicle_telemetry, items_per_op=max(1, args.delete_docs // len(self.vehicle_ids))),
+            Stage("admin.delete_all", reseed_setup(lambda: [self.request("DELETE", "/api/telemetry")]),
+                  delete_all, items_per_op=args.delete_docs),
+        ]
+
+
+# --- Report ---
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=API_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current, baseline):
+    """Variazione percentuale di throughput e p95 rispetto a un report precedente."""
+    rows = {}
+    for name, stage in current["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if not base:
+            continue
+        def delta(new, old):
+            return round((new - old) / old * 100, 1) if old else None
+        rows[name] = {
+            "items_per_sec_pct": delta(stage["items_per_sec"], base["items_per_sec"]),
+            "p95_pct": delta(stage["latency_ms"]["p95"], base["latency_ms"]["p95"]),
+            "peak_kib_pct": delta(stage["memory"]["peak_kib"], base["memory"]["peak_kib"]),
+        }
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EcoFleet offline backend benchmark")
+    parser.add_argument("--stages", help="elenco separato da virgole (default: tutti)")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--vehicles", type=int, default=50)
+    parser.add_argument("--samples-per-message", type=int, default=10, help="letture per messaggio negli stage packed")
+    parser.add_argument("--advice-messages", type=int, default=500)
+    parser.add_argument("--history-docs", type=int, default=10000)
+    parser.add_argument("--http-requests", type=int, default=200)
+    parser.add_argument("--delete-docs", type=int, default=5000)
+    parser.add_argument("--memory-ops", type=int, default=50, help="operazioni nella passata tracemalloc")
+    parser.add_argument("--partition-key", default="vehicle_id")
+    parser.add_argument("--cosmos-latency-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--signalr-latency-ms", type=float, default=0.0)
+    parser.add_argument("--queue-latency-ms", type=float, default=0.0)
+    parser.add_argument("--c2d-latency-ms", type=float, default=0.0)
+    parser.add_argument("--no-cache", action="store_true", help="disabilita la cache advice")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="file JSON dei risultati (default: stdout)")
+    parser.add_argument("--compare", help="report JSON precedente da confrontare")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+    configure_environment(args)
+    backend = Backend(args)
+
+    selected = set(args.stages.split(",")) if args.stages else None
+    results = {}
+    for stage in backend.stages():
+        if selected and stage.name not in selected:
+            continue
+        print(f"⏱️ {stage.name}...", file=sys.stderr)
+        results[stage.name] = stage.measure(args.memory_ops)
+        r = results[stage.name]
+        print(f"   {r['items_per_sec']:>10.1f} items/s | p50 {r['latency_ms']['p50']:.3f} ms | "
+              f"p95 {r['latency_ms']['p95']:.3f} ms | p99 {r['latency_ms']['p99']:.3f} ms | "
+              f"peak {r['memory']['peak_kib']} KiB", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "stages")},
+        },
+        "stages": results,
+    }
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["comparison"] = {"baseline": args.compare, "stages": compare(report, json.load(f))}
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"📄 Results written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,30 +3,70 @@ import json
 
 import azure.functions as func
 
+from shared.bulk_delete import DELETE_QUEUE_NAME, DeleteJob, get_job, run_delete_job, run_delete_slice, save_checkpoint
+from shared.advice_gate import get_advice_gate
+from shared.broadcast import get_frame_broadcaster
+from shared.c2d_dispatcher import get_c2d_dispatcher
+from shared.cold_tier import get_cold_tier
 from shared.cosmos_client import get_cosmos_container, get_partition_key_field
+from shared.ingest_sequencer import get_ingest_sequencer
+from shared.instrumentation import get_instrumentation
+from shared.rollups import get_rollup_aggregator
+from shared.vehicle_registry import get_vehicle_registry
 
 bp = func.Blueprint()
 
 
-# --- Helper condiviso per cancellazione documenti ---
-
-def _delete_documents(container, pk_field, query, params=None):
-    """Esegue una query e cancella tutti i documenti trovati. Restituisce il conteggio."""
-    items = list(container.query_items(
-        query=query,
-        parameters=params or [],
-        enable_cross_partition_query=True
-    ))
-    for item in items:
-        container.delete_item(item=item["id"], partition_key=item[pk_field])
-    return len(items)
+# --- Coerenza del registro veicoli ---
+
+def _forget_vehicles(vehicle_id=None):
+    """Rimuove dal registro veicoli (e dallo stato in-process di gate, rollup, C2D, frame SignalR e dedup) un veicolo o, se None, tutti."""
+    registry = get_vehicle_registry()
+    if registry:
+        if vehicle_id:
+            registry.remove(vehicle_id)
+        else:
+            registry.clear()
+    aggregator = get_rollup_aggregator()
+    if aggregator:
+        aggregator.forget(vehicle_id)
+    gate = get_advice_gate()
+    if gate:
+        if vehicle_id:
+            gate.forget(vehicle_id)
+        else:
+            gate.clear()
+    dispatcher = get_c2d_dispatcher()
+    if dispatcher:
+        if vehicle_id:
+            dispatcher.forget(vehicle_id)
+        else:
+            dispatcher.clear()
+    broadcaster = get_frame_broadcaster()
+    if broadcaster:
+        broadcaster.forget(vehicle_id)
+    sequencer = get_ingest_sequencer()
+    if sequencer:
+        sequencer.forget(vehicle_id)
+
+
+def _delete_archive(vehicle_id=None) -> int:
+    """Cancella dall'archivio Parquet i file di un veicolo (o tutti): i dati cancellati non riappaiono da /archive."""
+    cold_tier = get_cold_tier()
+    if not cold_tier:
+        return 0
+    try:
+        return cold_tier.delete(vehicle_id)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not delete archived telemetry{f' for {vehicle_id}' if vehicle_id else ''}: {e}")
+        return 0
 
 
 # --- DELETE ENDPOINTS ---
 
 @bp.route(route="telemetry/{vehicleId}", methods=["DELETE"], auth_level=func.AuthLevel.ANONYMOUS)
 def delete_vehicle_telemetry(req: func.HttpRequest) -> func.HttpResponse:
-    """Cancella tutti i documenti di un veicolo da Cosmos DB."""
+    """Cancella tutti i documenti di un veicolo da Cosmos DB e dall'archivio Parquet."""
     vehicle_id = req.route_params.get("vehicleId")
     if not vehicle_id:
         return func.HttpResponse("vehicleId richiesto", status_code=400)
@@ -38,21 +78,32 @@ def delete_vehicle_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     pk_field = get_partition_key_field()
 
     try:
-        deleted = _delete_documents(
-            container, pk_field,
-            query=f"SELECT c.id, c.{pk_field} FROM c WHERE c.vehicle_id = @vid",
-            params=[{"name": "@vid", "value": vehicle_id}]
-        )
-        logging.info(f"🗑️ Deleted {deleted} docs for {vehicle_id} (PK: {pk_field})")
-        return func.HttpResponse(json.dumps({"deleted": deleted}), mimetype="application/json")
+        # Se la partition key è vehicle_id la query resta su una sola partizione
+        with get_instrumentation().timer("admin.delete_vehicle"):
+            job = run_delete_job(container, pk_field, DeleteJob(
+                query=f"SELECT c.id, c.{pk_field} FROM c WHERE c.vehicle_id = @vid",
+                params=[{"name": "@vid", "value": vehicle_id}],
+                partition_key=vehicle_id if pk_field == "vehicle_id" else None,
+            ))
+        if job.status != "completed":
+            raise RuntimeError(f"{job.error} (job {job.job_id}, {job.deleted} deleted)")
+        _forget_vehicles(vehicle_id)
+        archived = _delete_archive(vehicle_id)
+        logging.info(f"🗑️ Deleted {job.deleted} docs and {archived} archive files for {vehicle_id} (PK: {pk_field})")
+        return func.HttpResponse(json.dumps({"deleted": job.deleted, "archive_files_deleted": archived}),
+                                 mimetype="application/json")
     except Exception as e:
         logging.error(f"Delete error: {e}")
         return func.HttpResponse(f"Errore: {e}", status_code=500)
 
 
 @bp.route(route="telemetry", methods=["DELETE"], auth_level=func.AuthLevel.ANONYMOUS)
-def delete_all_telemetry(req: func.HttpRequest) -> func.HttpResponse:
-    """Cancella TUTTI i documenti telemetria da Cosmos DB."""
+@bp.queue_output(arg_name="deleteJobs", queue_name=DELETE_QUEUE_NAME, connection="AzureStorageQueueConnectionString")
+def delete_all_telemetry(req: func.HttpRequest, deleteJobs: func.Out[str]) -> func.HttpResponse:
+    """Avvia la cancellazione di TUTTI i documenti telemetria come job asincrono (202 + URL di stato).
+    Il job viene salvato nel container Jobs e portato avanti da ContinueDeleteJob tramite delete-jobs.
+    Con ?resume=<jobId> riprende un job fallito o interrotto (pending/running senza checkpoint da
+    DELETE_STALE_SEC), rieseguendo la query sui documenti rimasti."""
     container = get_cosmos_container()
     if not container:
         return func.HttpResponse("Cosmos non configurato", status_code=500)
@@ -60,12 +111,67 @@ def delete_all_telemetry(req: func.HttpRequest) -> func.HttpResponse:
     pk_field = get_partition_key_field()
 
     try:
-        deleted = _delete_documents(
-            container, pk_field,
-            query=f"SELECT c.id, c.{pk_field} FROM c"
-        )
-        logging.info(f"🗑️ Deleted ALL {deleted} docs (PK: {pk_field})")
-        return func.HttpResponse(json.dumps({"deleted": deleted}), mimetype="application/json")
+        resume_id = req.params.get("resume")
+        if resume_id:
+            job = get_job(resume_id)
+            if job is None:
+                return func.HttpResponse(f"Job {resume_id} non trovato", status_code=404)
+            if job.status == "completed" or (job.status in ("pending", "running") and not job.is_stale()):
+                return func.HttpResponse(json.dumps(job.to_dict()), mimetype="application/json")
+            job.status = "pending"
+        else:
+            job = DeleteJob(query=f"SELECT c.id, c.{pk_field} FROM c")
+            _delete_archive()
+
+        # Registro veicoli e stato in-process vengono azzerati solo a job completato (ContinueDeleteJob)
+        save_checkpoint(job)
+        deleteJobs.set(json.dumps({"job_id": job.job_id}))
+        logging.info(f"🗑️ Delete ALL job {job.job_id} queued (PK: {pk_field}, resume: {bool(resume_id)})")
+        body = dict(job.to_dict(), status_url=f"/api/telemetry/jobs/{job.job_id}")
+        return func.HttpResponse(json.dumps(body), status_code=202, mimetype="application/json")
     except Exception as e:
         logging.error(f"Delete all error: {e}")
         return func.HttpResponse(f"Errore: {e}", status_code=500)
+
+
+def continue_delete_job(msg: func.QueueMessage, deleteJobs: func.Out[str]):
+    """Esegue una fetta (DELETE_SLICE_SEC) del job e, se non è finito, accoda il messaggio per la successiva.
+    Se il worker viene riciclato a metà fetta il messaggio torna visibile e la fetta riesegue la query
+    sui documenti rimasti; le cancellazioni in corso già applicate risultano "already_gone"."""
+    try:
+        job_id = json.loads(msg.get_body().decode("utf-8"))["job_id"]
+    except Exception as e:
+        logging.error(f"Invalid delete job message (dropped): {e}")
+        return
+    job = get_job(job_id)
+    if job is None or job.status in ("completed", "failed"):
+        logging.info(f"🗑️ Delete job {job_id} {'not found' if job is None else job.status}, nothing to do")
+        return
+    container = get_cosmos_container()
+    if not container:
+        raise RuntimeError("Cosmos non configurato")  # il messaggio viene ritentato
+
+    with get_instrumentation().timer("admin.delete_slice"):
+        more = run_delete_slice(container, get_partition_key_field(), job)
+    if more:
+        deleteJobs.set(json.dumps({"job_id": job.job_id}))
+        logging.info(f"🗑️ Delete job {job.job_id} continues in a new slice ({job.deleted} deleted so far)")
+    elif job.status == "completed":
+        _forget_vehicles()
+        logging.info(f"🗑️ Delete job {job.job_id} completed: {job.deleted} deleted")
+
+
+@bp.function_name(name="ContinueDeleteJob")
+@bp.queue_trigger(arg_name="msg", queue_name=DELETE_QUEUE_NAME, connection="AzureStorageQueueConnectionString")
+@bp.queue_output(arg_name="deleteJobs", queue_name=DELETE_QUEUE_NAME, connection="AzureStorageQueueConnectionString")
+def ContinueDeleteJob(msg: func.QueueMessage, deleteJobs: func.Out[str]):
+    continue_delete_job(msg, deleteJobs)
+
+
+@bp.route(route="telemetry/jobs/{jobId}", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def get_delete_job_status(req: func.HttpRequest) -> func.HttpResponse:
+    """Stato e avanzamento di un job di cancellazione."""
+    job = get_job(req.route_params.get("jobId"))
+    if job is None:
+        return func.HttpResponse("Job non trovato", status_code=404)
+    return func.HttpResponse(json.dumps(job.to_dict()), mimetype="application/json")
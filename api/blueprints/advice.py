@@ -1,72 +1,334 @@
+import asyncio
 import logging
 import json
+import os
 
 import azure.functions as func
 
-from shared.ai_advisor import get_ai_advice
-from shared.cosmos_client import get_cosmos_container, get_partition_key_field
+from shared.ai_advisor import get_ai_advice, get_ai_advice_batch, aget_ai_advice
+from shared.advice_queue import drain_advice_requests, complete_advice_requests
+from shared.broadcast import get_frame_broadcaster
+from shared.c2d_dispatcher import get_c2d_dispatcher
+from shared.coalescing import get_sequence_registry, coalesce_requests
+from shared.cosmos_client import get_cosmos_container, get_async_cosmos_container, update_advice, update_advice_batch, update_advice_async
+from shared.instrumentation import get_instrumentation
 from shared.iot_hub import get_iot_registry_manager
 
 bp = func.Blueprint()
 
+# Numero massimo di richieste elaborate in una sola chiamata LLM (1 = una richiesta per invocazione)
+ADVICE_BATCH_SIZE = int(os.environ.get("ADVICE_BATCH_SIZE", "1"))
+
+# Pipeline asincrona: LLM via ainvoke, Cosmos aio e fan-out concorrente dei sink
+ADVICE_ASYNC = os.environ.get("ADVICE_ASYNC", "false").lower() == "true"
+ADVICE_MAX_CONCURRENCY = int(os.environ.get("ADVICE_MAX_CONCURRENCY", "16"))
+
+
+# --- Sink condivisi tra modalità singola e batch ---
+
+def _update_cosmos(doc_id, vehicle_id, advice, alert_level):
+    """Aggiorna il documento in Cosmos DB con l'advice (patch parziale, fallback read+upsert)."""
+    try:
+        container = get_cosmos_container()
+        if container:
+            with get_instrumentation().timer("advice.cosmos"):
+                outcome = update_advice(container, doc_id, vehicle_id, advice, alert_level)
+            logging.info(f"✅ Cosmos doc {doc_id} updated with AI advice ({outcome})")
+    except Exception as e:
+        logging.warning(f"⚠️ Could not update Cosmos doc with advice: {e}")
+
+
+def _advice_message(doc_id, vehicle_id, advice, alert_level):
+    """Messaggio SignalR 'newAdvice' per la dashboard."""
+    return {
+        'target': 'newAdvice',
+        'arguments': [{
+            "doc_id": doc_id,
+            "vehicle_id": vehicle_id,
+            "ai_advice": advice,
+            "alert_level": alert_level,
+        }]
+    }
+
+
+def _advice_payload(updates):
+    """Payload SignalR per gli advice (doc_id, vehicle_id, advice, alert_level): un evento 'newAdvice' per
+    advice oppure, in modalità frames, i frame dovuti (None se il tick non è ancora scaduto)."""
+    broadcaster = get_frame_broadcaster()
+    if broadcaster is None:
+        messages = [_advice_message(*update) for update in updates]
+        return json.dumps(messages[0] if len(messages) == 1 else messages)
+    for update in updates:
+        broadcaster.add_advice(*update)
+    frames = broadcaster.collect()
+    return json.dumps(frames) if frames else None
+
+
+def _send_c2d(vehicle_id, advice, alert_level, pending=None):
+    """Invio C2D Feedback al veicolo: tramite il dispatcher (dedup, rate limit, worker pool) se abilitato,
+    altrimenti sincrono. I messaggi accodati finiscono in `pending`, da attendere con _wait_c2d."""
+    if vehicle_id:
+        registry_manager = get_iot_registry_manager()
+        if registry_manager:
+            dispatcher = get_c2d_dispatcher()
+            if dispatcher is not None:
+                dispatcher.submit(vehicle_id, advice, alert_level, pending)
+                return
+            metrics = get_instrumentation()
+            try:
+                with metrics.timer("advice.c2d"):
+                    registry_manager.send_c2d_message(vehicle_id, advice)
+                logging.info(f"📤 C2D [{alert_level}] -> {vehicle_id}: {advice}")
+            except Exception as e:
+                metrics.incr("advice.c2d_errors")
+                logging.error(f"❌ Failed to send C2D to {vehicle_id}: {e}")
+
+
+def _c2d_target(request):
+    """Device destinatario del C2D: il veicolo, se è il device che ha inviato la telemetria. Le letture
+    multiplexate su un device del pool (device_id ≠ vehicle_id) non hanno un device a cui rispondere."""
+    vehicle_id = request.get("vehicle_id")
+    device_id = request.get("device_id")
+    if device_id and device_id != vehicle_id:
+        get_instrumentation().incr("advice.c2d_pooled")
+        return None
+    return vehicle_id
+
+
+def _wait_c2d(pending):
+    """Attende (al più C2D_WAIT_SEC) la consegna dei C2D accodati dall'invocazione: i worker del
+    dispatcher sono thread in-process e non sopravvivono a riciclo o freeze dell'host."""
+    dispatcher = get_c2d_dispatcher()
+    if pending and dispatcher is not None:
+        with get_instrumentation().timer("advice.c2d_wait"):
+            dispatcher.wait(pending)
+
+
+def _is_superseded(request) -> bool:
+    """Coalescing: True se per il veicolo è già in coda telemetria più recente."""
+    registry = get_sequence_registry()
+    if registry is None:
+        return False
+    if registry.is_superseded(request.get("vehicle_id"), request.get("coalesce_seq")):
+        registry.record(coalesced=1)
+        get_instrumentation().incr("advice.superseded")
+        logging.info(f"⏭️ Advice request {request.get('doc_id')} for {request.get('vehicle_id')} superseded by newer telemetry, skipped")
+        return True
+    registry.record(processed=1)
+    return False
+
+
 # =============================================================================
 # GenerateAdvice (ASYNC — chiama Gemini, poi aggiorna dashboard e veicolo)
 # =============================================================================
-@bp.queue_trigger(arg_name="msg", queue_name="advice-queue", connection="AzureStorageQueueConnectionString")
-@bp.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
-def GenerateAdvice(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+def generate_advice(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+    with get_instrumentation().timer("advice.total"):
+        _generate_advice(msg, signalRMessages)
+
+
+def _generate_advice(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+    metrics = get_instrumentation()
     try:
         request = json.loads(msg.get_body().decode('utf-8'))
     except Exception as e:
         logging.error(f"Error parsing advice request: {e}")
         return
 
+    if ADVICE_BATCH_SIZE > 1:
+        generate_advice_batch(request, signalRMessages)
+        return
+
     doc_id = request.get("doc_id")
     vehicle_id = request.get("vehicle_id")
     speed = request.get("speed", 0)
     rpm = request.get("rpm", 0)
     fuel_level = request.get("fuel_level", 100)
 
+    # 0. Coalescing: se per il veicolo è già in coda telemetria più recente, questa richiesta è superata
+    if _is_superseded(request):
+        return
+
     # 1. Chiama Gemini via LangChain
-    result = get_ai_advice(speed, rpm, fuel_level)
+    metrics.incr("advice.requests")
+    with metrics.timer("advice.llm"):
+        result = get_ai_advice(speed, rpm, fuel_level)
     advice = result.advice
     alert_level = result.alert_level
     logging.info(f"🤖 AI Advice for {vehicle_id}: {advice} [{alert_level}]")
 
     # 2. Aggiorna il documento in Cosmos DB con l'advice
+    _update_cosmos(doc_id, vehicle_id, advice, alert_level)
+
+    # 3. Invia advice alla Dashboard via SignalR (evento separato)
+    try:
+        with metrics.timer("advice.signalr"):
+            payload = _advice_payload([(doc_id, vehicle_id, advice, alert_level)])
+            if payload:
+                signalRMessages.set(payload)
+                logging.info("📡 AI Advice dispatched to SignalR")
+    except Exception as e:
+        logging.error(f"Error sending advice to SignalR: {e}")
+
+    # 4. Invio C2D Feedback al veicolo
+    pending = []
+    _send_c2d(_c2d_target(request), advice, alert_level, pending)
+    _wait_c2d(pending)
+
+
+# =============================================================================
+# GenerateAdvice BATCH — drena fino a ADVICE_BATCH_SIZE richieste (anche di veicoli
+# diversi), una sola chiamata LLM strutturata, poi fan-out su Cosmos, SignalR e C2D
+# =============================================================================
+def generate_advice_batch(first_request, signalRMessages: func.Out[str]):
+    metrics = get_instrumentation()
+    with metrics.timer("advice_batch.drain"):
+        drained = drain_advice_requests(ADVICE_BATCH_SIZE - 1)
+    requests = [first_request] + [request for _, request in drained]
+    requests = [r for r in requests if r.get("doc_id")]
+
+    # 0. Coalescing: una sola richiesta per veicolo (la più recente), scartando quelle già superate
+    registry = get_sequence_registry()
+    if registry is not None:
+        requests, superseded = coalesce_requests(requests)
+        stale = [r for r in requests if registry.is_superseded(r.get("vehicle_id"), r.get("coalesce_seq"))]
+        requests = [r for r in requests if r not in stale]
+        registry.record(processed=len(requests), coalesced=len(superseded) + len(stale))
+        metrics.incr("advice.superseded", len(superseded) + len(stale))
+        if superseded or stale:
+            logging.info(f"⏭️ {len(superseded) + len(stale)} superseded advice requests skipped")
+
+    # 1. Una sola chiamata Gemini per tutto il batch (fallback per-item gestito da get_ai_advice_batch)
+    metrics.incr("advice.requests", len(requests))
+    with metrics.timer("advice_batch.llm"):
+        results = get_ai_advice_batch(requests)
+    logging.info(f"🤖 AI Advice batch: {len(results)} requests from {len({r.get('vehicle_id') for r in requests})} vehicles")
+
+    # 2. Aggiorna Cosmos: patch raggruppate per partizione in batch transazionali
+    updates = [
+        (r["doc_id"], r.get("vehicle_id"), results[r["doc_id"]].advice, results[r["doc_id"]].alert_level)
+        for r in requests
+    ]
     try:
         container = get_cosmos_container()
+        if container and updates:
+            with metrics.timer("advice_batch.cosmos"):
+                outcomes = update_advice_batch(container, updates)
+            logging.info(f"✅ Cosmos advice batch update: {outcomes}")
+    except Exception as e:
+        logging.warning(f"⚠️ Could not update Cosmos docs with advice batch: {e}")
+
+    # 3. Tutti i messaggi SignalR in un solo output
+    try:
+        with metrics.timer("advice_batch.signalr"):
+            payload = _advice_payload(updates) if updates else None
+            if payload:
+                signalRMessages.set(payload)
+                logging.info(f"📡 {len(updates)} AI Advice dispatched to SignalR")
+    except Exception as e:
+        logging.error(f"Error sending advice batch to SignalR: {e}")
+
+    # 4. Invio C2D per ogni richiesta
+    pending = []
+    for request, (doc_id, vehicle_id, advice, alert_level) in zip(requests, updates):
+        _send_c2d(_c2d_target(request), advice, alert_level, pending)
+    _wait_c2d(pending)
+
+    # I messaggi drenati vengono confermati solo a elaborazione completata
+    complete_advice_requests([message for message, _ in drained])
+
+
+# =============================================================================
+# GenerateAdvice ASYNC — LLM via ainvoke con concorrenza limitata da semaforo,
+# poi Cosmos, SignalR e C2D in parallelo: latenza ≈ max(sink) invece della somma
+# =============================================================================
+_semaphore = None
+
+def _get_semaphore():
+    """Semaforo creato al primo uso, sull'event loop del worker."""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(ADVICE_MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def _update_cosmos_async(doc_id, vehicle_id, advice, alert_level):
+    """Aggiorna il documento in Cosmos DB con l'advice (client aio, patch parziale)."""
+    try:
+        container = await get_async_cosmos_container()
         if container:
-            pk_field = get_partition_key_field()
-            existing = container.read_item(item=doc_id, partition_key=doc_id if pk_field == "id" else vehicle_id)
-            existing["ai_advice"] = advice
-            existing["alert_level"] = alert_level
-            container.upsert_item(existing)
-            logging.info(f"✅ Cosmos doc {doc_id} updated with AI advice")
+            with get_instrumentation().timer("advice.cosmos"):
+                outcome = await update_advice_async(container, doc_id, vehicle_id, advice, alert_level)
+            logging.info(f"✅ Cosmos doc {doc_id} updated with AI advice ({outcome})")
     except Exception as e:
         logging.warning(f"⚠️ Could not update Cosmos doc with advice: {e}")
 
-    # 3. Invia advice alla Dashboard via SignalR (evento separato)
+
+async def _set_signalr_async(signalRMessages, updates):
     try:
-        signalRMessages.set(json.dumps({
-            'target': 'newAdvice',
-            'arguments': [{
-                "doc_id": doc_id,
-                "vehicle_id": vehicle_id,
-                "ai_advice": advice,
-                "alert_level": alert_level,
-            }]
-        }))
-        logging.info("📡 AI Advice dispatched to SignalR")
+        with get_instrumentation().timer("advice.signalr"):
+            payload = _advice_payload(updates)
+            if payload:
+                signalRMessages.set(payload)
+                logging.info("📡 AI Advice dispatched to SignalR")
     except Exception as e:
         logging.error(f"Error sending advice to SignalR: {e}")
 
-    # 4. Invio C2D Feedback al veicolo
-    if vehicle_id:
-        registry_manager = get_iot_registry_manager()
-        if registry_manager:
-            try:
-                registry_manager.send_c2d_message(vehicle_id, advice)
-                logging.info(f"📤 C2D [{alert_level}] -> {vehicle_id}: {advice}")
-            except Exception as e:
-                logging.error(f"❌ Failed to send C2D to {vehicle_id}: {e}")
+
+async def generate_advice_async(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+    with get_instrumentation().timer("advice.total"):
+        await _generate_advice_async(msg, signalRMessages)
+
+
+async def _generate_advice_async(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+    metrics = get_instrumentation()
+    try:
+        request = json.loads(msg.get_body().decode('utf-8'))
+    except Exception as e:
+        logging.error(f"Error parsing advice request: {e}")
+        return
+
+    if _is_superseded(request):
+        return
+
+    doc_id = request.get("doc_id")
+    vehicle_id = request.get("vehicle_id")
+
+    # 1. Chiamata LLM non bloccante, al massimo ADVICE_MAX_CONCURRENCY in volo per worker
+    metrics.incr("advice.requests")
+    async with _get_semaphore():
+        with metrics.timer("advice.llm"):
+            result = await aget_ai_advice(request.get("speed", 0), request.get("rpm", 0), request.get("fuel_level", 100))
+    advice = result.advice
+    alert_level = result.alert_level
+    logging.info(f"🤖 AI Advice for {vehicle_id}: {advice} [{alert_level}]")
+
+    # 2-4. Cosmos, SignalR e C2D in parallelo (con il dispatcher i non CRITICAL vengono solo accodati
+    # e attesi alla fine, altrimenti SDK sincrono → thread)
+    sinks = [
+        _update_cosmos_async(doc_id, vehicle_id, advice, alert_level),
+        _set_signalr_async(signalRMessages, [(doc_id, vehicle_id, advice, alert_level)]),
+    ]
+    pending = []
+    target = _c2d_target(request)
+    if get_c2d_dispatcher() is not None and alert_level != "CRITICAL":
+        _send_c2d(target, advice, alert_level, pending)
+    else:
+        sinks.append(asyncio.to_thread(_send_c2d, target, advice, alert_level))
+    await asyncio.gather(*sinks)
+    if pending:
+        await asyncio.to_thread(_wait_c2d, pending)
+
+
+# --- Registrazione della funzione in base a ADVICE_ASYNC ---
+
+if ADVICE_ASYNC:
+    @bp.function_name(name="GenerateAdvice")
+    @bp.queue_trigger(arg_name="msg", queue_name="advice-queue", connection="AzureStorageQueueConnectionString")
+    @bp.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
+    async def GenerateAdviceAsync(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+        await generate_advice_async(msg, signalRMessages)
+else:
+    @bp.queue_trigger(arg_name="msg", queue_name="advice-queue", connection="AzureStorageQueueConnectionString")
+    @bp.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
+    def GenerateAdvice(msg: func.QueueMessage, signalRMessages: func.Out[str]):
+        generate_advice(msg, signalRMessages)
@@ -0,0 +1,91 @@
+import logging
+import json
+
+import azure.functions as func
+
+from shared.cold_tier import get_cold_tier, hot_window_start, read_window
+from shared.cosmos_client import get_cosmos_container
+from shared.instrumentation import get_instrumentation
+
+from blueprints.vehicles import HISTORY_FIELDS, HISTORY_MAX_LIMIT, _normalize_timestamp
+
+bp = func.Blueprint()
+
+
+# =============================================================================
+# ArchiveTelemetry — copia nell'archivio Parquet (per veicolo/giorno) la telemetria
+# che sta per scadere dal container Telemetry (TTL per documento)
+# =============================================================================
+@bp.timer_trigger(arg_name="timer", schedule="0 */15 * * * *", run_on_startup=False)
+def ArchiveTelemetry(timer: func.TimerRequest):
+    cold_tier = get_cold_tier()
+    container = get_cosmos_container()
+    if not cold_tier or not container:
+        return
+    try:
+        with get_instrumentation().timer("archive.export"):
+            result = cold_tier.export(container)
+        if result["rows"]:
+            logging.info(f"🧊 Archived {result['rows']} telemetry docs in {result['files']} Parquet files "
+                         f"(watermark {result['watermark']}, complete: {result['complete']})")
+    except Exception as e:
+        logging.error(f"Telemetry archive error: {e}")
+
+
+# =============================================================================
+# CompactArchive — ogni notte riunisce in un file i part dei giorni chiusi
+# (ogni export ne aggiunge uno per veicolo e giorno)
+# =============================================================================
+@bp.timer_trigger(arg_name="timer", schedule="0 30 3 * * *", run_on_startup=False)
+def CompactArchive(timer: func.TimerRequest):
+    cold_tier = get_cold_tier()
+    if not cold_tier:
+        return
+    try:
+        with get_instrumentation().timer("archive.compact"):
+            result = cold_tier.compact()
+        if result["partitions"]:
+            logging.info(f"🧊 Compacted {result['partitions']} archive partitions ({result['files_removed']} files merged)")
+    except Exception as e:
+        logging.error(f"Archive compaction error: {e}")
+
+
+# =============================================================================
+# GET /api/archive/{vehicleId} — storico archiviato (più vecchio della finestra hot)
+# =============================================================================
+@bp.route(route="archive/{vehicleId}", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def get_archived_history(req: func.HttpRequest) -> func.HttpResponse:
+    """Storico del veicolo dall'archivio Parquet, più recente prima. Parametri: from/to (ISO 8601, al più
+    COLD_TIER_MAX_READ_DAYS giorni; di default quelli che precedono la finestra hot), fields (proiezione,
+    come /history), limit. L'header X-Hot-Window-Start indica da quando lo storico è (anche) in /history."""
+    vehicle_id = req.route_params.get("vehicleId")
+    try:
+        date_from, date_to = read_window(_normalize_timestamp(req.params.get("from")),
+                                         _normalize_timestamp(req.params.get("to")))
+        fields = req.params.get("fields")
+        fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(HISTORY_FIELDS)
+        unknown = [f for f in fields if f not in HISTORY_FIELDS]
+        if unknown:
+            raise ValueError(f"Campi non validi: {', '.join(unknown)}")
+        limit = min(int(req.params.get("limit", HISTORY_MAX_LIMIT)), HISTORY_MAX_LIMIT)
+        if limit <= 0:
+            raise ValueError("limit deve essere positivo")
+    except ValueError as e:
+        return func.HttpResponse(f"Parametri non validi: {e}", status_code=400)
+
+    cold_tier = get_cold_tier()
+    if not cold_tier:
+        return func.HttpResponse("Archivio non configurato (COLD_TIER_URL)", status_code=404)
+
+    try:
+        with get_instrumentation().timer("archive.read"):
+            history = cold_tier.read_history(vehicle_id, date_from, date_to, fields, limit)
+        headers = {}
+        hot_start = hot_window_start()
+        if hot_start:
+            headers["X-Hot-Window-Start"] = hot_start
+            headers["Access-Control-Expose-Headers"] = "X-Hot-Window-Start"
+        return func.HttpResponse(json.dumps(history), mimetype="application/json", headers=headers)
+    except Exception as e:
+        logging.error(f"Archive query error for {vehicle_id}: {e}")
+        return func.HttpResponse(f"Errore: {e}", status_code=500)
@@ -0,0 +1,79 @@
+import json
+
+import azure.functions as func
+
+from shared.advice_cache import get_advice_cache
+from shared.advice_gate import get_advice_gate
+from shared.broadcast import get_frame_broadcaster
+from shared.c2d_dispatcher import get_c2d_dispatcher
+from shared.client_registry import get_client_registry
+from shared.cold_tier import get_cold_tier
+from shared.coalescing import get_sequence_registry
+from shared.ingest_sequencer import get_ingest_sequencer
+from shared.instrumentation import get_instrumentation
+from shared.local_backend import get_local_backend
+from shared.llm_guard import get_llm_guard
+from shared.rollups import get_rollup_aggregator
+from shared.startup_profile import get_startup_profile
+from shared.vehicle_registry import get_vehicle_registry
+
+bp = func.Blueprint()
+
+
+def _component_gauges(metrics: dict):
+    """Appiattisce le statistiche numeriche dei componenti in righe Prometheus (gauge)."""
+    lines = ["# TYPE ecofleet_component gauge"]
+
+    def walk(component, prefix, value):
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines.append(f'ecofleet_component{{component="{component}",metric="{prefix}"}} {value}')
+        elif isinstance(value, dict):
+            for key, child in value.items():
+                walk(component, f"{prefix}.{key}" if prefix else key, child)
+
+    for component, stats in metrics.items():
+        if stats:
+            walk(component, "", stats)
+    return "\n".join(lines) + "\n"
+
+
+# =============================================================================
+# GET /api/metrics — contatori in-process (per worker) delle ottimizzazioni
+# e timing per stage; ?format=prometheus per il formato testo Prometheus
+# =============================================================================
+@bp.route(route="metrics", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def get_metrics(req: func.HttpRequest) -> func.HttpResponse:
+    cache = get_advice_cache()
+    registry = get_sequence_registry()
+    gate = get_advice_gate()
+    vehicles = get_vehicle_registry()
+    rollups = get_rollup_aggregator()
+    dispatcher = get_c2d_dispatcher()
+    broadcaster = get_frame_broadcaster()
+    guard = get_llm_guard()
+    sequencer = get_ingest_sequencer()
+    cold_tier = get_cold_tier()
+    local = get_local_backend()
+    instrumentation = get_instrumentation()
+    metrics = {
+        "advice_cache": cache.stats() if cache else None,
+        "advice_coalescing": registry.stats() if registry else None,
+        "advice_gate": gate.stats() if gate else None,
+        "vehicle_registry": vehicles.stats() if vehicles else None,
+        "rollups": rollups.stats() if rollups else None,
+        "c2d_dispatcher": dispatcher.stats() if dispatcher else None,
+        "signalr_frames": broadcaster.stats() if broadcaster else None,
+        "llm_guard": guard.stats() if guard else None,
+        "ingest_dedup": sequencer.stats() if sequencer else None,
+        "cold_tier": cold_tier.stats() if cold_tier else None,
+        "local_backend": local.stats() if local else None,
+        "clients": get_client_registry().stats(),
+    }
+    if req.params.get("format") == "prometheus":
+        body = instrumentation.prometheus_text() + _component_gauges(metrics)
+        return func.HttpResponse(body, mimetype="text/plain; version=0.0.4")
+    metrics["instrumentation"] = instrumentation.stats()
+    metrics["startup"] = get_startup_profile().stats()
+    return func.HttpResponse(json.dumps(metrics), mimetype="application/json")
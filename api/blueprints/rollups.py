@@ -0,0 +1,69 @@
+import logging
+import json
+
+import azure.functions as func
+
+from blueprints.vehicles import _normalize_timestamp
+from shared.cosmos_client import get_rollups_container
+from shared.rollups import GRANULARITIES, get_rollup_aggregator
+
+bp = func.Blueprint()
+
+
+# =============================================================================
+# FlushRollups — scrive i bucket chiusi anche quando non arriva nuova telemetria
+# =============================================================================
+@bp.timer_trigger(arg_name="timer", schedule="0 * * * * *", run_on_startup=False)
+def FlushRollups(timer: func.TimerRequest):
+    aggregator = get_rollup_aggregator()
+    container = get_rollups_container()
+    if aggregator and container:
+        flushed = aggregator.flush_due(container)
+        if flushed:
+            logging.info(f"📊 Flushed {flushed} rollup buckets")
+
+
+# =============================================================================
+# GET /api/rollups/{vehicleId} — KPI aggregati per minuto/ora (O(bucket))
+# =============================================================================
+@bp.route(route="rollups/{vehicleId}", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def get_vehicle_rollups(req: func.HttpRequest) -> func.HttpResponse:
+    """Rollup del veicolo in ordine cronologico. Parametri: granularity=minute|hour, from/to (ISO 8601), limit."""
+    vehicle_id = req.route_params.get("vehicleId")
+    granularity = req.params.get("granularity", "minute")
+    if granularity not in GRANULARITIES:
+        return func.HttpResponse(f"granularity deve essere uno tra: {', '.join(GRANULARITIES)}", status_code=400)
+    try:
+        limit = min(int(req.params.get("limit", "1440")), 10000)
+    except ValueError:
+        return func.HttpResponse("limit non valido", status_code=400)
+    try:
+        date_from, date_to = _normalize_timestamp(req.params.get("from")), _normalize_timestamp(req.params.get("to"))
+    except ValueError as e:
+        return func.HttpResponse(f"Parametri non validi: {e}", status_code=400)
+
+    container = get_rollups_container()
+    if not container:
+        return func.HttpResponse("Cosmos non configurato", status_code=500)
+
+    conditions = ["c.vehicle_id = @vid", "c.granularity = @gran"]
+    params = [{"name": "@vid", "value": vehicle_id}, {"name": "@gran", "value": granularity}]
+    if date_from:
+        conditions.append("c.bucket_start >= @from")
+        params.append({"name": "@from", "value": date_from})
+    if date_to:
+        conditions.append("c.bucket_start < @to")
+        params.append({"name": "@to", "value": date_to})
+    params.append({"name": "@limit", "value": limit})
+
+    try:
+        rollups = list(container.query_items(
+            query=f"SELECT * FROM c WHERE {' AND '.join(conditions)} ORDER BY c.bucket_start DESC OFFSET 0 LIMIT @limit",
+            parameters=params,
+            partition_key=vehicle_id,
+        ))
+        rollups = [{k: v for k, v in r.items() if not k.startswith("_")} for r in reversed(rollups)]
+        return func.HttpResponse(json.dumps(rollups), mimetype="application/json")
+    except Exception as e:
+        logging.error(f"Rollups query error for {vehicle_id}: {e}")
+        return func.HttpResponse(f"Errore: {e}", status_code=500)
@@ -1,8 +1,38 @@
+import json
+import logging
+
 import azure.functions as func
 
+from shared.broadcast import SIGNALR_MODE, subscription_groups
+
 bp = func.Blueprint()
 
 @bp.route(route="negotiate", auth_level=func.AuthLevel.ANONYMOUS)
 @bp.generic_input_binding(arg_name="connectionInfo", type="signalRConnectionInfo", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
 def negotiate(req: func.HttpRequest, connectionInfo: str) -> func.HttpResponse:
     return func.HttpResponse(connectionInfo)
+
+
+# =============================================================================
+# POST /api/signalr/subscribe — iscrive la connessione della dashboard ai gruppi
+# del veicolo selezionato (SIGNALR_GROUP_MODE=vehicle|shard). Body:
+# {"connectionId": "...", "vehicleId": "Bus-01" | null, "previousVehicleId": ...}
+# =============================================================================
+@bp.route(route="signalr/subscribe", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+@bp.generic_output_binding(arg_name="signalRGroupActions", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
+def subscribe(req: func.HttpRequest, signalRGroupActions: func.Out[str]) -> func.HttpResponse:
+    try:
+        body = req.get_json()
+        connection_id = body["connectionId"]
+    except (ValueError, KeyError, TypeError):
+        return func.HttpResponse("connectionId mancante", status_code=400)
+
+    groups = subscription_groups(body.get("vehicleId"))
+    previous = set(subscription_groups(body.get("previousVehicleId"))) if "previousVehicleId" in body else set()
+    actions = [{"connectionId": connection_id, "groupName": g, "action": "remove"} for g in sorted(previous - set(groups))]
+    actions += [{"connectionId": connection_id, "groupName": g, "action": "add"} for g in groups]
+    if actions:
+        signalRGroupActions.set(json.dumps(actions))
+        logging.info(f"👥 SignalR connection {connection_id}: {len(groups)} groups joined, {len(actions) - len(groups)} left")
+    return func.HttpResponse(json.dumps({"mode": SIGNALR_MODE, "groups": groups}), mimetype="application/json")
+
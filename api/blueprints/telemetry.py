@@ -1,78 +1,441 @@
 import logging
 import json
-import hashlib
 import datetime
+import math
+import os
+from typing import List
 
 import azure.functions as func
 
+from shared.advice_gate import get_advice_gate
+from shared.broadcast import get_frame_broadcaster
+from shared.cold_tier import HOT_TTL_SEC
+from shared.coalescing import get_sequence_registry
+from shared.cosmos_client import get_cosmos_container, get_partition_key_field, get_rollups_container
+from shared.ingest_sequencer import DUPLICATE, NEW, PROBABLE_DUPLICATE, device_timestamp, document_id, get_ingest_sequencer
+from shared.instrumentation import get_instrumentation
+from shared.rollups import get_rollup_aggregator
+from shared.rules import classify
+from shared.vehicle_registry import get_vehicle_registry
+from shared.wire_format import decode as decode_telemetry
+
 bp = func.Blueprint()
 
+# Modalità di esecuzione: "single" (un evento per invocazione) o "batch" (cardinality=many)
+TELEMETRY_MODE = os.environ.get("TELEMETRY_MODE", "single").lower()
+
+
+# --- Helper condivisi tra modalità single e batch ---
+
+def _content_type(event: func.EventHubEvent):
+    """content_type dichiarato dal device (proprietà di sistema IoT Hub), se il trigger lo riporta."""
+    system = (event.metadata or {}).get("SystemProperties") or {}
+    return (event.iothub_metadata or {}).get("content-type") or system.get("content-type")
+
+
+def _device_id(event: func.EventHubEvent):
+    """Device IoT Hub che ha inviato il messaggio (proprietà di sistema), se il trigger lo riporta."""
+    system = (event.metadata or {}).get("SystemProperties") or {}
+    return (event.iothub_metadata or {}).get("connection-device-id") or system.get("iothub-connection-device-id")
+
+
+def _build_documents(raw: bytes, content_type=None, device_id=None) -> List[dict]:
+    """Decodifica il body D2C (JSON o binario, anche con più letture) e costruisce un documento Cosmos
+    per lettura. Solleva eccezione se il messaggio è malformato. Le letture inviate da un device diverso
+    dal veicolo (pool multiplexato del simulatore) riportano il device in `device_id`."""
+    samples = decode_telemetry(raw, content_type)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    docs = [_build_document(raw, telemetry, index, now) for index, telemetry in enumerate(samples)]
+    if device_id:
+        for doc in docs:
+            if doc["vehicle_id"] != device_id:
+                doc["device_id"] = device_id
+    return docs
+
+
+# Campi numerici della lettura e valore usato se assenti o null
+NUMERIC_FIELDS = {"speed": 0, "rpm": 0, "fuel_level": 100}
+
+
+def _numeric(telemetry: dict, field: str):
+    """Valore numerico del campo: null/assente → default, stringhe numeriche convertite.
+    ValueError per valori non numerici o non finiti (la lettura viene scartata come malformata)."""
+    value = telemetry.get(field)
+    if value is None:
+        return NUMERIC_FIELDS[field]
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid {field}: {value!r}")
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError(f"Invalid {field}: {value!r}") from None
+    if not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"Invalid {field}: {value!r}")
+    return value
+
+
+def _build_document(raw: bytes, telemetry: dict, index: int, now: datetime.datetime) -> dict:
+    """Documento Cosmos della lettura (senza advice). ValueError se un campo numerico non è valido."""
+    if not isinstance(telemetry, dict):
+        raise ValueError("Telemetry reading must be a JSON object")
+    numeric = {field: _numeric(telemetry, field) for field in NUMERIC_FIELDS}
+    if telemetry.get("seq") is not None:
+        telemetry["seq"] = int(telemetry["seq"])
+
+    # Documento Cosmos DB (senza advice — verrà aggiornato da GenerateAdvice).
+    # timestamp = ora della lettura sul device (se plausibile), processed_at = ora di elaborazione
+    measured = device_timestamp(telemetry.get("timestamp"), now)
+    doc = {
+        "id": document_id(raw, telemetry, index),
+        "vehicle_id": telemetry.get("vehicle_id"),
+        "timestamp": (measured or now).isoformat(),
+        **numeric,
+        "ai_advice": "",
+        "alert_level": "INFO",
+        "processed_at": now.isoformat()
+    }
+    if telemetry.get("seq") is not None:
+        doc["seq"] = telemetry["seq"]
+        doc["boot_id"] = telemetry.get("boot_id")
+    if HOT_TTL_SEC > 0:
+        doc["ttl"] = HOT_TTL_SEC  # scadenza nel tier hot; prima viene copiato nell'archivio Parquet
+    return doc
+
+
+def _build_advice_request(doc: dict) -> dict:
+    """Estrae dal documento i campi necessari a GenerateAdvice."""
+    request = {
+        "doc_id": doc["id"],
+        "vehicle_id": doc["vehicle_id"],
+        "speed": doc["speed"],
+        "rpm": doc["rpm"],
+        "fuel_level": doc["fuel_level"],
+    }
+    if doc.get("device_id"):
+        request["device_id"] = doc["device_id"]  # il veicolo non ha un device proprio: niente C2D
+    # Sequenza per-veicolo: GenerateAdvice scarta le richieste superate da telemetria più recente
+    registry = get_sequence_registry()
+    if registry is not None and doc["vehicle_id"]:
+        request["coalesce_seq"] = registry.next_sequence(doc["vehicle_id"])
+    return request
+
+
+def _needs_advice(doc: dict, rule=None) -> bool:
+    """Gate di cambio stato: False se lo stato del veicolo non è cambiato dall'ultimo advice."""
+    gate = get_advice_gate()
+    if gate is None:
+        return True
+    return gate.should_forward(doc["vehicle_id"], doc["speed"], doc["rpm"], doc["fuel_level"],
+                               rule.rule_id if rule else None)
+
+
+def _classify(docs: List[dict]) -> list:
+    """Regola di ogni documento: scalare per la singola lettura, vettorizzata per i batch."""
+    if len(docs) == 1:
+        return [classify(docs[0]["speed"], docs[0]["rpm"], docs[0]["fuel_level"])]
+    from shared.rule_engine import get_rule_engine  # NumPy caricato al primo batch (o dal pre-warm)
+    return get_rule_engine().classify_docs(docs)
+
+
+def _update_registry(docs: List[dict], rules: list):
+    """Aggiorna il registro veicoli materializzato con l'ultima lettura di ogni veicolo."""
+    registry = get_vehicle_registry()
+    if registry is None:
+        return
+    latest = {doc["vehicle_id"]: (doc, rule) for doc, rule in zip(docs, rules) if doc["vehicle_id"]}
+    for doc, rule in latest.values():
+        try:
+            registry.record(doc, rule.alert_level)
+        except Exception as e:
+            logging.warning(f"⚠️ Could not update vehicle registry for {doc['vehicle_id']}: {e}")
+
+
+def _aggregate(docs: List[dict], rules: list):
+    """Aggiorna le rollup per veicolo/bucket e scrive quelle dei bucket ormai chiusi."""
+    aggregator = get_rollup_aggregator()
+    if aggregator is None:
+        return
+    # Ogni lettura è isolata: una sola malformata non fa perdere l'aggiornamento del resto del batch
+    for doc, rule in zip(docs, rules):
+        try:
+            aggregator.add(doc, alert_level=rule.alert_level)
+        except Exception as e:
+            logging.warning(f"⚠️ Rollup skipped for {doc.get('id')}: {e}")
+    try:
+        container = get_rollups_container()
+        if container:
+            aggregator.flush_due(container)
+    except Exception as e:
+        logging.warning(f"⚠️ Could not update rollups: {e}")
+
+
+def _broadcast_frames(signalRMessages, docs: List[dict]) -> bool:
+    """Modalità frames: accumula l'ultimo stato per veicolo e invia i frame dovuti. False in modalità event."""
+    broadcaster = get_frame_broadcaster()
+    if broadcaster is None:
+        return False
+    for doc in docs:
+        broadcaster.add_telemetry(doc)
+    frames = broadcaster.collect()
+    if frames:
+        signalRMessages.set(json.dumps(frames))
+        logging.info(f"📡 {len(frames)} telemetry frames dispatched to SignalR")
+    return True
+
+
+def _screen(docs: List[dict], metrics) -> tuple:
+    """Dedup e ordine del device. Restituisce (documenti da salvare, flag "live" per ciascuno): i duplicati
+    sono scartati; le letture fuori ordine e i probabili duplicati vengono salvati ma non aggiornano lo
+    stato live (dashboard, registro, gate) né generano advice. Un duplicato il cui documento manca in
+    Cosmos (scrittura fallita dopo il commit) viene salvato di nuovo, come non live."""
+    sequencer = get_ingest_sequencer()
+    if sequencer is None:
+        return docs, [True] * len(docs)
+    if len(docs) > 1:
+        docs = sequencer.order(docs)
+    verdicts = sequencer.screen(docs)
+    batch_ids = {doc["id"] for doc, verdict in zip(docs, verdicts) if verdict != DUPLICATE}
+    unsaved = _not_persisted([doc for doc, verdict in zip(docs, verdicts)
+                              if verdict == DUPLICATE and doc["id"] not in batch_ids])
+    stored = []
+    for doc, verdict in zip(docs, verdicts):
+        if verdict != DUPLICATE:
+            stored.append((doc, verdict == NEW))
+        elif doc["id"] in unsaved:
+            unsaved.discard(doc["id"])  # una sola copia per id
+            stored.append((doc, False))
+            metrics.incr("telemetry.duplicates_unsaved")
+    metrics.incr("telemetry.duplicates", len(docs) - len(stored))
+    metrics.incr("telemetry.probable_duplicates", verdicts.count(PROBABLE_DUPLICATE))
+    metrics.incr("telemetry.late", sum(1 for doc, _ in stored if doc.get("late")))
+    return [doc for doc, _ in stored], [live for _, live in stored]
+
+
+def _not_persisted(docs: List[dict]) -> set:
+    """id dei documenti già registrati dal sequencer ma assenti in Cosmos. Point read per documento:
+    riguarda solo i duplicati, cioè le redelivery. Nel dubbio (errore di lettura) resta un duplicato."""
+    container = get_cosmos_container() if docs else None
+    if container is None:
+        return set()
+    from azure.cosmos.exceptions import CosmosResourceNotFoundError
+    pk_field = get_partition_key_field()
+    missing = set()
+    for doc in docs:
+        try:
+            container.read_item(item=doc["id"], partition_key=doc.get(pk_field))
+        except CosmosResourceNotFoundError:
+            missing.add(doc["id"])
+        except Exception as e:
+            logging.warning(f"⚠️ Could not verify duplicate {doc['id']} in Cosmos: {e}")
+    return missing
+
+
+def _commit(docs: List[dict]):
+    """Registra i documenti come elaborati. Avviene nel corpo della funzione, prima che l'host scriva
+    l'output binding Cosmos: se quella scrittura fallisce e il batch viene rieseguito, le letture risultano
+    già viste. _screen le verifica in Cosmos e salva quelle mancanti, ma come non live: dashboard, registro
+    e advice di quelle letture restano quelli (at-most-once) dell'invocazione fallita."""
+    sequencer = get_ingest_sequencer()
+    if sequencer is not None and docs:
+        sequencer.commit(docs)
+
+
+def _parse_events(events: List[func.EventHubEvent], metrics) -> List[dict]:
+    """Parsing in un'unica passata: gli eventi malformati vengono scartati senza far fallire il batch."""
+    docs = []
+    for event in events:
+        try:
+            docs.extend(_build_documents(event.get_body(), _content_type(event), _device_id(event)))
+        except Exception as e:
+            metrics.incr("telemetry.parse_errors")
+            logging.error(f"Error parsing message (skipped): {e}")
+    return docs
+
+
 # =============================================================================
 # ProcessTelemetry (FAST — nessuna attesa per Gemini)
 # Riceve D2C da IoT Hub, salva su Cosmos, invia a SignalR, inoltra ad advice-queue
 # =============================================================================
-@bp.event_hub_message_trigger(arg_name="event", event_hub_name="%IoTHubEventHubName%", connection="IoTHubEventHubConnectionString", consumer_group="$Default")
-@bp.cosmos_db_output(arg_name="outputDocument", database_name="EcoFleetDB", container_name="Telemetry", connection="CosmosDBConnectionString", create_if_not_exists=True)
-@bp.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
-@bp.queue_output(arg_name="adviceQueue", queue_name="advice-queue", connection="AzureStorageQueueConnectionString")
-def ProcessTelemetry(event: func.EventHubEvent, outputDocument: func.Out[func.Document], signalRMessages: func.Out[str], adviceQueue: func.Out[str]):
-    body = event.get_body().decode('utf-8')
-    logging.info(f"📡 D2C Telemetry received from IoT Hub: {body}")
-    
+def process_telemetry(event: func.EventHubEvent, outputDocument: func.Out[func.Document], signalRMessages: func.Out[str], adviceQueue: func.Out[str]):
+    metrics = get_instrumentation()
+    with metrics.timer("telemetry.total"):
+        _process_telemetry(event, outputDocument, signalRMessages, adviceQueue, metrics)
+
+
+def _process_telemetry(event, outputDocument, signalRMessages, adviceQueue, metrics):
+    body = event.get_body()
+    metrics.incr("telemetry.events")
+    # Il body completo solo a campione (DEBUG): loggarlo a ogni messaggio costa caro ad alto rate
+    if metrics.sample("telemetry.body"):
+        logging.debug(f"📡 D2C Telemetry received from IoT Hub (sampled): {body.decode('utf-8', errors='replace')}")
+
     try:
-        telemetry = json.loads(body)
+        with metrics.timer("telemetry.parse"):
+            docs = _build_documents(body, _content_type(event), _device_id(event))
     except Exception as e:
+        metrics.incr("telemetry.parse_errors")
         logging.error(f"Error parsing message: {e}")
         return
+    metrics.incr("telemetry.samples", len(docs))
+    if not docs:
+        return
+    if len(docs) > 1:
+        # Messaggio con più letture: stesso percorso del batch (gli output accettano anche liste)
+        _process_documents(docs, outputDocument, signalRMessages, adviceQueue, metrics, "telemetry_packed")
+        return
+    doc = docs[0]
 
-    speed = telemetry.get("speed", 0)
-    rpm = telemetry.get("rpm", 0)
-    fuel_level = telemetry.get("fuel_level", 100)
-    vehicle_id = telemetry.get("vehicle_id")
-
-    doc_id = hashlib.sha256(event.get_body()).hexdigest()
-
-    # Documento Cosmos DB (senza advice — verrà aggiornato da GenerateAdvice)
-    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-    doc = {
-        "id": doc_id,
-        "vehicle_id": vehicle_id,
-        "timestamp": now,
-        "speed": speed,
-        "rpm": rpm,
-        "fuel_level": fuel_level,
-        "ai_advice": "",
-        "alert_level": "INFO",
-        "processed_at": now
-    }
+    # 0. Dedup delle redelivery e riconoscimento delle letture fuori ordine
+    with metrics.timer("telemetry.dedup"):
+        docs, live = _screen([doc], metrics)
+    if not docs:
+        logging.info(f"♻️ Duplicate telemetry {doc['id']} from {doc['vehicle_id']} skipped")
+        return
+    live = live[0]
+    doc_id = doc["id"]
 
     # 1. Salva su Cosmos DB
     try:
-        outputDocument.set(func.Document.from_dict(doc))
-        logging.info(f"✅ Telemetry saved to Cosmos: {doc_id}")
+        with metrics.timer("telemetry.cosmos"):
+            outputDocument.set(func.Document.from_dict(doc))
+        logging.info(f"✅ Telemetry saved to Cosmos: {doc_id}" + (" (late)" if doc.get("late") else ""))
     except Exception as e:
         logging.error(f"CRITICAL ERROR saving to Cosmos: {e}")
 
-    # 2. Invia dati IMMEDIATI alla Dashboard via SignalR
-    try:
-        signalRMessages.set(json.dumps({
-            'target': 'newTelemetry',
-            'arguments': [doc]
-        }))
-        logging.info("📡 Telemetry dispatched to SignalR (instant)")
-    except Exception as e:
-        logging.error(f"Error sending telemetry to SignalR: {e}")
+    # 2. Invia dati IMMEDIATI alla Dashboard via SignalR (o li accumula nel frame del prossimo tick)
+    if live:
+        try:
+            with metrics.timer("telemetry.signalr"):
+                if not _broadcast_frames(signalRMessages, [doc]):
+                    signalRMessages.set(json.dumps({
+                        'target': 'newTelemetry',
+                        'arguments': [doc]
+                    }))
+                    logging.info("📡 Telemetry dispatched to SignalR (instant)")
+        except Exception as e:
+            logging.error(f"Error sending telemetry to SignalR: {e}")
+
+    # 3. Aggiorna il registro veicoli (servito da /vehicles) e le rollup per minuto/ora
+    rules = _classify([doc])
+    if live:
+        with metrics.timer("telemetry.registry"):
+            _update_registry([doc], rules)
+    with metrics.timer("telemetry.rollups"):
+        _aggregate([doc], rules)
+
+    # 4. Inoltra alla advice-queue per generazione AI asincrona (solo se lo stato è cambiato)
+    if live:
+        _forward_advice(doc, rules[0], adviceQueue, metrics)
+    _commit(docs)
+
 
-    # 3. Inoltra alla advice-queue per generazione AI asincrona
+def _forward_advice(doc, rule, adviceQueue, metrics):
+    with metrics.timer("telemetry.gate"):
+        forward = _needs_advice(doc, rule)
+    if not forward:
+        metrics.incr("telemetry.advice_suppressed")
+        logging.info(f"⏸️ State of {doc['vehicle_id']} unchanged, advice request skipped")
+        return
     try:
-        advice_request = {
-            "doc_id": doc_id,
-            "vehicle_id": vehicle_id,
-            "speed": speed,
-            "rpm": rpm,
-            "fuel_level": fuel_level,
-        }
-        adviceQueue.set(json.dumps(advice_request))
+        with metrics.timer("telemetry.enqueue"):
+            adviceQueue.set(json.dumps(_build_advice_request(doc)))
+        metrics.incr("telemetry.advice_forwarded")
         logging.info("📨 Forwarded to advice-queue for AI processing")
     except Exception as e:
         logging.error(f"Error forwarding to advice-queue: {e}")
+
+
+# =============================================================================
+# ProcessTelemetry BATCH (cardinality=many)
+# Un solo output Cosmos (DocumentList), un solo payload SignalR raggruppato,
+# una sola lista di messaggi per advice-queue per ogni batch di eventi.
+# =============================================================================
+def process_telemetry_batch(events: List[func.EventHubEvent], outputDocuments: func.Out[func.DocumentList], signalRMessages: func.Out[str], adviceQueue: func.Out[List[str]]):
+    metrics = get_instrumentation()
+    with metrics.timer("telemetry_batch.total"):
+        _process_telemetry_batch(events, outputDocuments, signalRMessages, adviceQueue, metrics)
+
+
+def _process_telemetry_batch(events, outputDocuments, signalRMessages, adviceQueue, metrics):
+    # Nel batch i timer misurano l'intero batch (stage telemetry_batch.*), i contatori i singoli eventi
+    with metrics.timer("telemetry_batch.parse"):
+        docs = _parse_events(events, metrics)
+    metrics.incr("telemetry.events", len(events))
+    metrics.incr("telemetry.samples", len(docs))
+    logging.info(f"📡 D2C batch received from IoT Hub: {len(docs)} readings from {len(events)} events")
+    _process_documents(docs, outputDocuments, signalRMessages, adviceQueue, metrics, "telemetry_batch")
+
+
+def _process_documents(docs, outputDocuments, signalRMessages, adviceQueue, metrics, stage):
+    """Salvataggio, SignalR, registro, rollup e advice per un gruppo di letture (un batch di eventi o un
+    messaggio con più letture); i timer misurano l'intero gruppo con prefisso `stage`."""
+    # 0. Ordine del device, dedup delle redelivery (anche interne al batch) e letture fuori ordine
+    with metrics.timer(f"{stage}.dedup"):
+        docs, live = _screen(docs, metrics)
+    if not docs:
+        return
+    live_docs = [doc for doc, is_live in zip(docs, live) if is_live]
+
+    # 1. Salva su Cosmos DB (un solo output per tutto il batch)
+    try:
+        with metrics.timer(f"{stage}.cosmos"):
+            outputDocuments.set(func.DocumentList([func.Document.from_dict(doc) for doc in docs]))
+        logging.info(f"✅ {len(docs)} telemetry docs saved to Cosmos ({len(docs) - len(live_docs)} late)")
+    except Exception as e:
+        logging.error(f"CRITICAL ERROR saving batch to Cosmos: {e}")
+
+    # 2. Un unico messaggio SignalR con i documenti live del batch (o i frame per tick)
+    try:
+        with metrics.timer(f"{stage}.signalr"):
+            if live_docs and not _broadcast_frames(signalRMessages, live_docs):
+                signalRMessages.set(json.dumps({
+                    'target': 'newTelemetryBatch',
+                    'arguments': [live_docs]
+                }))
+                logging.info("📡 Telemetry batch dispatched to SignalR (instant)")
+    except Exception as e:
+        logging.error(f"Error sending telemetry batch to SignalR: {e}")
+
+    # 3. Aggiorna il registro veicoli (una scrittura al massimo per veicolo per batch) e le rollup;
+    # le regole vengono valutate una sola volta, vettorizzate, per registro, rollup e gate
+    with metrics.timer(f"{stage}.classify"):
+        rules = _classify(docs)
+    live_rules = [rule for rule, is_live in zip(rules, live) if is_live]
+    with metrics.timer(f"{stage}.registry"):
+        _update_registry(live_docs, live_rules)
+    with metrics.timer(f"{stage}.rollups"):
+        _aggregate(docs, rules)
+
+    # 4. Inoltra alla advice-queue, in un solo output, le richieste dei veicoli con stato cambiato
+    with metrics.timer(f"{stage}.gate"):
+        forwarded = [doc for doc, rule in zip(live_docs, live_rules) if _needs_advice(doc, rule)]
+    metrics.incr("telemetry.advice_suppressed", len(live_docs) - len(forwarded))
+    if forwarded:
+        try:
+            with metrics.timer(f"{stage}.enqueue"):
+                adviceQueue.set([json.dumps(_build_advice_request(doc)) for doc in forwarded])
+            metrics.incr("telemetry.advice_forwarded", len(forwarded))
+            logging.info(f"📨 Forwarded {len(forwarded)}/{len(docs)} requests to advice-queue")
+        except Exception as e:
+            logging.error(f"Error forwarding batch to advice-queue: {e}")
+    _commit(docs)
+
+
+# --- Registrazione della funzione in base a TELEMETRY_MODE ---
+
+if TELEMETRY_MODE == "batch":
+    @bp.function_name(name="ProcessTelemetry")
+    @bp.event_hub_message_trigger(arg_name="events", event_hub_name="%IoTHubEventHubName%", connection="IoTHubEventHubConnectionString", consumer_group="$Default", cardinality=func.Cardinality.MANY)
+    @bp.cosmos_db_output(arg_name="outputDocuments", database_name="EcoFleetDB", container_name="Telemetry", connection="CosmosDBConnectionString", create_if_not_exists=True)
+    @bp.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
+    @bp.queue_output(arg_name="adviceQueue", queue_name="advice-queue", connection="AzureStorageQueueConnectionString")
+    def ProcessTelemetryBatch(events: List[func.EventHubEvent], outputDocuments: func.Out[func.DocumentList], signalRMessages: func.Out[str], adviceQueue: func.Out[List[str]]):
+        process_telemetry_batch(events, outputDocuments, signalRMessages, adviceQueue)
+else:
+    @bp.event_hub_message_trigger(arg_name="event", event_hub_name="%IoTHubEventHubName%", connection="IoTHubEventHubConnectionString", consumer_group="$Default")
+    @bp.cosmos_db_output(arg_name="outputDocument", database_name="EcoFleetDB", container_name="Telemetry", connection="CosmosDBConnectionString", create_if_not_exists=True)
+    @bp.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="telemetryHub", connectionStringSetting="SignalRConnectionString")
+    @bp.queue_output(arg_name="adviceQueue", queue_name="advice-queue", connection="AzureStorageQueueConnectionString")
+    def ProcessTelemetry(event: func.EventHubEvent, outputDocument: func.Out[func.Document], signalRMessages: func.Out[str], adviceQueue: func.Out[str]):
+        process_telemetry(event, outputDocument, signalRMessages, adviceQueue)
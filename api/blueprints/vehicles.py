@@ -1,37 +1,227 @@
 import logging
 import json
+import datetime
 
 import azure.functions as func
 
+from shared.cosmos_client import get_cosmos_container, get_partition_key_field
+from shared.downsampling import bucket_aggregate, lttb
+from shared.instrumentation import get_instrumentation
+from shared.rules import THRESHOLDS
+from shared.vehicle_registry import get_vehicle_registry
+
 bp = func.Blueprint()
 
 @bp.route(route="vehicles", auth_level=func.AuthLevel.ANONYMOUS)
-@bp.cosmos_db_input(arg_name="documents",
-                    database_name="EcoFleetDB",
-                    container_name="Telemetry",
-                    sql_query="SELECT DISTINCT c.vehicle_id FROM c",
-                    connection="CosmosDBConnectionString")
-def get_vehicles(req: func.HttpRequest, documents: func.DocumentList) -> func.HttpResponse:
+def get_vehicles(req: func.HttpRequest) -> func.HttpResponse:
+    """Lista veicoli dal registro materializzato (O(veicoli)); ?details=true restituisce i documenti completi."""
     logging.info("Richiesta lista veicoli")
-    
-    # Ogni doc è {"vehicle_id": "BUS-01"}, estraiamo solo l'ID
-    vehicles = [json.loads(doc.to_json())["vehicle_id"] for doc in documents]
 
+    metrics = get_instrumentation()
+    docs = []
+    try:
+        registry = get_vehicle_registry()
+        if registry:
+            with metrics.timer("vehicles.registry"):
+                docs = registry.list()
+    except Exception as e:
+        logging.warning(f"⚠️ Vehicle registry unavailable, falling back to DISTINCT scan: {e}")
+
+    # Registro vuoto o non disponibile (es. dati precedenti al registro): scansione DISTINCT su Telemetry
+    if not docs:
+        container = get_cosmos_container()
+        if container:
+            with metrics.timer("vehicles.scan"):
+                docs = [{"id": item["vehicle_id"], "vehicle_id": item["vehicle_id"]} for item in container.query_items(
+                    query="SELECT DISTINCT c.vehicle_id FROM c",
+                    enable_cross_partition_query=True,
+                ) if item.get("vehicle_id")]
+
+    if req.params.get("details") == "true":
+        return func.HttpResponse(json.dumps(docs), mimetype="application/json")
+
+    vehicles = [doc["vehicle_id"] for doc in docs]
     return func.HttpResponse(json.dumps(vehicles), mimetype="application/json")
 
+# --- Storico: paginazione, filtri temporali, proiezione e downsampling ---
+
+HISTORY_FIELDS = ("id", "vehicle_id", "timestamp", "speed", "rpm", "fuel_level", "ai_advice", "alert_level", "processed_at")
+NUMERIC_FIELDS = ("speed", "rpm", "fuel_level")
+HISTORY_DEFAULT_LIMIT = 200
+HISTORY_MAX_LIMIT = 1000
+HISTORY_DOWNSAMPLE_WINDOW_SEC = 86400  # finestra di default del downsampling se manca from
+DOWNSAMPLE_MODES = ("minmax", "avg", "lttb")
+
+
+def _history_query(vehicle_id, fields, date_from, date_to, order):
+    """Query parametrica: i campi proiettati provengono solo dalla whitelist HISTORY_FIELDS."""
+    conditions = ["c.vehicle_id = @vid"]
+    params = [{"name": "@vid", "value": vehicle_id}]
+    if date_from:
+        conditions.append("c.timestamp >= @from")
+        params.append({"name": "@from", "value": date_from})
+    if date_to:
+        conditions.append("c.timestamp < @to")
+        params.append({"name": "@to", "value": date_to})
+    projection = ", ".join(f"c.{field}" for field in fields)
+    query = f"SELECT {projection} FROM c WHERE {' AND '.join(conditions)} ORDER BY c.timestamp {order}"
+    return query, params
+
+
+def _normalize_timestamp(value):
+    """ISO 8601 -> stesso formato UTC dei documenti (confronto lessicografico coerente). ValueError se non valido."""
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc).isoformat()
+
+
+def _parse_history_params(req):
+    """Valida i parametri di query. Solleva ValueError con un messaggio per l'utente."""
+    fields = req.params.get("fields")
+    fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(HISTORY_FIELDS)
+    unknown = [f for f in fields if f not in HISTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Campi non validi: {', '.join(unknown)}")
+    if "timestamp" not in fields:
+        fields.append("timestamp")
+
+    date_from, date_to = _normalize_timestamp(req.params.get("from")), _normalize_timestamp(req.params.get("to"))
+
+    limit = min(int(req.params.get("limit", HISTORY_DEFAULT_LIMIT)), HISTORY_MAX_LIMIT)
+    downsample = req.params.get("downsample")
+    if downsample and downsample not in DOWNSAMPLE_MODES:
+        raise ValueError(f"downsample deve essere uno tra: {', '.join(DOWNSAMPLE_MODES)}")
+    bucket = float(req.params.get("bucket", "60"))
+    points = int(req.params.get("points", "500"))
+    if bucket <= 0 or points < 3 or limit <= 0:
+        raise ValueError("bucket, points e limit devono essere positivi (points >= 3)")
+    return fields, date_from, date_to, limit, downsample, bucket, points
+
+
 @bp.route(route="history/{vehicleId}", auth_level=func.AuthLevel.ANONYMOUS)
-@bp.cosmos_db_input(arg_name="documents",
-                    database_name="EcoFleetDB",
-                    container_name="Telemetry",
-                    sql_query="SELECT * FROM c WHERE c.vehicle_id = {vehicleId} ORDER BY c.timestamp DESC OFFSET 0 LIMIT 200",
-                    connection="CosmosDBConnectionString")
-def get_vehicle_history(req: func.HttpRequest, documents: func.DocumentList) -> func.HttpResponse:
+def get_vehicle_history(req: func.HttpRequest) -> func.HttpResponse:
+    """Storico del veicolo (più recente prima).
+    Parametri: limit, continuation (token della pagina precedente, restituito in X-Continuation-Token),
+    from/to (ISO 8601), fields (proiezione), downsample=minmax|avg (con bucket=secondi) o lttb (con points=N)."""
     vehicle_id = req.route_params.get("vehicleId")
     logging.info(f"Richiesta storico veicolo {vehicle_id}")
 
     if not vehicle_id:
         return func.HttpResponse("Inserisci un id", status_code=404)
-    
-    history = [json.loads(doc.to_json()) for doc in documents]
-    
-    return func.HttpResponse(json.dumps(history), mimetype="application/json")
+
+    try:
+        fields, date_from, date_to, limit, downsample, bucket, points = _parse_history_params(req)
+    except ValueError as e:
+        return func.HttpResponse(f"Parametri non validi: {e}", status_code=400)
+
+    container = get_cosmos_container()
+    if not container:
+        return func.HttpResponse("Cosmos non configurato", status_code=500)
+
+    # Se la partition key è vehicle_id la query resta su una sola partizione
+    query_kwargs = {}
+    if get_partition_key_field() == "vehicle_id":
+        query_kwargs["partition_key"] = vehicle_id
+    else:
+        query_kwargs["enable_cross_partition_query"] = True
+
+    try:
+        if downsample:
+            # Downsampling: si scorre l'intervallo (solo i campi numerici, ultime 24 ore se manca from)
+            # in streaming e si restituiscono i bucket: in memoria resta solo lo stato dei bucket
+            numeric = [f for f in fields if f in NUMERIC_FIELDS] or list(NUMERIC_FIELDS)
+            date_to = date_to or datetime.datetime.now(datetime.timezone.utc).isoformat()
+            date_from = date_from or (datetime.datetime.fromisoformat(date_to)
+                                      - datetime.timedelta(seconds=HISTORY_DOWNSAMPLE_WINDOW_SEC)).isoformat()
+            query, params = _history_query(vehicle_id, ["timestamp"] + numeric, date_from, date_to, "ASC")
+            with get_instrumentation().timer(f"history.downsample_{downsample}"):
+                items = container.query_items(query=query, parameters=params, **query_kwargs)
+                if downsample == "lttb":
+                    series = lttb(items, points, numeric[0], date_from, date_to)
+                else:
+                    series = bucket_aggregate(items, bucket, numeric, mode=downsample)
+            series.reverse()
+            return func.HttpResponse(json.dumps(series), mimetype="application/json")
+
+        query, params = _history_query(vehicle_id, fields, date_from, date_to, "DESC")
+        with get_instrumentation().timer("history.page"):
+            pager = container.query_items(query=query, parameters=params, max_item_count=limit, **query_kwargs) \
+                .by_page(req.params.get("continuation"))
+            history = list(next(pager, []))
+
+        # I documenti arrivano già come dict: una sola serializzazione verso il client
+        headers = {}
+        if pager.continuation_token:
+            headers["X-Continuation-Token"] = pager.continuation_token
+            headers["Access-Control-Expose-Headers"] = "X-Continuation-Token"
+        return func.HttpResponse(json.dumps(history), mimetype="application/json", headers=headers)
+    except Exception as e:
+        logging.error(f"History query error for {vehicle_id}: {e}")
+        return func.HttpResponse(f"Errore: {e}", status_code=500)
+
+
+# =============================================================================
+# GET /api/rescore/{vehicleId} — rivaluta lo storico con le regole correnti (o con
+# soglie/priorità di prova) in un'unica passata vettorizzata
+# =============================================================================
+@bp.route(route="rescore/{vehicleId}", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def rescore_vehicle_history(req: func.HttpRequest) -> func.HttpResponse:
+    """Distribuzione delle regole sullo storico e concordanza con l'alert_level salvato (advice AI).
+    Parametri: from/to (ISO 8601), priority=regola,regola,... e soglie di prova con i nomi di
+    shared.rules.THRESHOLDS (es. overspeed_kmh=120)."""
+    from shared.rule_engine import RuleEngine, get_rule_engine  # NumPy solo per questo endpoint
+
+    vehicle_id = req.route_params.get("vehicleId")
+    try:
+        date_from, date_to = _normalize_timestamp(req.params.get("from")), _normalize_timestamp(req.params.get("to"))
+        thresholds = {name: float(req.params[name]) for name in THRESHOLDS if name in req.params}
+        priority = req.params.get("priority")
+        priority = [r.strip() for r in priority.split(",") if r.strip()] if priority else None
+        engine = RuleEngine(priority, thresholds) if thresholds or priority else get_rule_engine()
+    except ValueError as e:
+        return func.HttpResponse(f"Parametri non validi: {e}", status_code=400)
+
+    container = get_cosmos_container()
+    if not container:
+        return func.HttpResponse("Cosmos non configurato", status_code=500)
+    query_kwargs = {"partition_key": vehicle_id} if get_partition_key_field() == "vehicle_id" \
+        else {"enable_cross_partition_query": True}
+
+    try:
+        query, params = _history_query(vehicle_id, ["speed", "rpm", "fuel_level", "ai_advice", "alert_level"],
+                                       date_from, date_to, "ASC")
+        rows, advised, agree = 0, 0, 0
+        rule_counts = dict.fromkeys(engine.rule_ids, 0)
+        with get_instrumentation().timer("history.rescore"):
+            # Una pagina alla volta: la memoria non cresce con la lunghezza dello storico
+            pager = container.query_items(query=query, parameters=params, max_item_count=HISTORY_MAX_LIMIT,
+                                          **query_kwargs).by_page()
+            for page in pager:
+                items = list(page)
+                if not items:
+                    continue
+                indices = engine.evaluate_docs(items)
+                for rule_id, n in engine.counts(indices).items():
+                    rule_counts[rule_id] += n
+                rows += len(items)
+                # Concordanza solo sulle letture che hanno già un advice AI
+                for item, i in zip(items, indices.tolist()):
+                    if item.get("ai_advice"):
+                        advised += 1
+                        agree += item.get("alert_level") == engine.rules[i].alert_level
+        result = {
+            "vehicle_id": vehicle_id,
+            "rows": rows,
+            "rules": rule_counts,
+            "priority": list(engine.rule_ids[:-1]),
+            "thresholds": {**THRESHOLDS, **thresholds},
+            "advised_rows": advised,
+            "alert_level_agreement": round(agree / advised, 4) if advised else None,
+        }
+        return func.HttpResponse(json.dumps(result), mimetype="application/json")
+    except Exception as e:
+        logging.error(f"Rescore error for {vehicle_id}: {e}")
+        return func.HttpResponse(f"Errore: {e}", status_code=500)
@@ -1,15 +1,25 @@
-import azure.functions as func
+import importlib
 
-from blueprints.telemetry import bp as telemetry_bp
-from blueprints.advice import bp as advice_bp
-from blueprints.vehicles import bp as vehicles_bp
-from blueprints.admin import bp as admin_bp
-from blueprints.signalr import bp as signalr_bp
+from shared.startup_profile import get_startup_profile
+
+profile = get_startup_profile()
+
+with profile.phase("azure.functions"):
+    import azure.functions as func
+
+from shared.client_registry import prewarm_clients
+
+# Gli SDK pesanti (Cosmos, Identity, IoT Hub, Storage, LangChain/Gemini) sono importati dai singleton
+# di shared/ al primo uso: l'indicizzazione carica solo i blueprint e i loro decoratori
+BLUEPRINTS = ("telemetry", "advice", "vehicles", "admin", "signalr", "metrics", "rollups", "archive")
 
 app = func.FunctionApp()
 
-app.register_functions(telemetry_bp)
-app.register_functions(advice_bp)
-app.register_functions(vehicles_bp)
-app.register_functions(admin_bp)
-app.register_functions(signalr_bp)
+for name in BLUEPRINTS:
+    with profile.phase(f"blueprints.{name}"):
+        app.register_functions(importlib.import_module(f"blueprints.{name}").bp)
+
+profile.finish()
+
+# Credenziale e client vengono inizializzati in background mentre l'host completa l'avvio
+prewarm_clients()
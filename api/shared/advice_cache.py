@@ -0,0 +1,175 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from shared.rules import classify
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione (Application Settings) ---
+
+CACHE_ENABLED = os.environ.get("ADVICE_CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_SIZE = int(os.environ.get("ADVICE_CACHE_MAX_SIZE", "1024"))
+CACHE_TTL_SEC = float(os.environ.get("ADVICE_CACHE_TTL_SEC", "300"))
+SPEED_STEP = float(os.environ.get("ADVICE_CACHE_SPEED_STEP", "5"))      # km/h
+RPM_STEP = float(os.environ.get("ADVICE_CACHE_RPM_STEP", "250"))        # giri/min
+FUEL_STEP = float(os.environ.get("ADVICE_CACHE_FUEL_STEP", "5"))        # %
+SHARED_STORE_PATH = os.environ.get("ADVICE_CACHE_SHARED_PATH", "")      # file SQLite condiviso tra worker
+
+
+# --- Store condiviso (SQLite locale, visibile a tutti i worker dell'host) ---
+
+class SQLiteAdviceStore:
+    """Secondo livello di cache su file SQLite: i worker dello stesso host condividono gli advice."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS advice_cache ("
+                "bucket TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # Una connessione per thread: sqlite3 non condivide connessioni tra thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, bucket: str, ttl: float) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT value, stored_at FROM advice_cache WHERE bucket = ?", (bucket,)
+        ).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, bucket: str, value: dict):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO advice_cache (bucket, value, stored_at) VALUES (?, ?, ?)",
+                (bucket, json.dumps(value), time.time()),
+            )
+
+
+# --- Cache in-process LRU + TTL ---
+
+class AdviceCache:
+    """Cache LRU con scadenza TTL, indicizzata su bucket quantizzati di (speed, rpm, fuel_level)."""
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: float = CACHE_TTL_SEC,
+                 speed_step: float = SPEED_STEP, rpm_step: float = RPM_STEP, fuel_step: float = FUEL_STEP,
+                 store: Optional[SQLiteAdviceStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.speed_step = speed_step
+        self.rpm_step = rpm_step
+        self.fuel_step = fuel_step
+        self.store = store
+        self._entries = OrderedDict()  # bucket -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def bucket(self, speed: float, rpm: float, fuel_level: float) -> str:
+        """Quantizza i valori telemetrici: input che differiscono solo per rumore finiscono nello stesso bucket.
+        La regola applicabile fa parte della chiave: i bucket non attraversano le soglie di shared/rules.py
+        (es. 130 e 134.9 km/h restano distinti), quindi un advice INFO non viene servito a una lettura critica."""
+        return (
+            f"{classify(speed, rpm, fuel_level).rule_id}"
+            f":{math.floor(speed / self.speed_step)}"
+            f":{math.floor(rpm / self.rpm_step)}"
+            f":{math.floor(fuel_level / self.fuel_step)}"
+        )
+
+    def get(self, bucket: str) -> Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(bucket)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(bucket)
+                    self.hits += 1
+                    return value
+                del self._entries[bucket]
+                self.expirations += 1
+
+        if self.store is not None:
+            try:
+                value = self.store.get(bucket, self.ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Shared advice cache read failed: {e}")
+                value = None
+            if value is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                    self._insert(bucket, value, now)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, bucket: str, value: dict):
+        with self._lock:
+            self._insert(bucket, value, time.monotonic())
+        if self.store is not None:
+            try:
+                self.store.put(bucket, value)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Shared advice cache write failed: {e}")
+
+    def _insert(self, bucket: str, value: dict, now: float):
+        self._entries[bucket] = (value, now + self.ttl)
+        self._entries.move_to_end(bucket)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_sec": self.ttl,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+# --- Singleton ---
+
+_cache = None
+
+def get_advice_cache() -> Optional[AdviceCache]:
+    """Lazy singleton: None se la cache è disabilitata via ADVICE_CACHE_ENABLED."""
+    global _cache
+    if _cache is None and CACHE_ENABLED:
+        store = None
+        if SHARED_STORE_PATH:
+            try:
+                store = SQLiteAdviceStore(SHARED_STORE_PATH)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Shared advice cache unavailable ({SHARED_STORE_PATH}): {e}")
+        _cache = AdviceCache(store=store)
+        logger.info(f"✅ Advice cache initialized (max {CACHE_MAX_SIZE}, TTL {CACHE_TTL_SEC}s, shared: {bool(store)})")
+    return _cache
@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from typing import Optional
+
+from shared.rules import classify
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+GATE_ENABLED = os.environ.get("ADVICE_GATE_ENABLED", "true").lower() == "true"
+GATE_SPEED_DELTA = float(os.environ.get("ADVICE_GATE_SPEED_DELTA", "15"))      # km/h
+GATE_RPM_DELTA = float(os.environ.get("ADVICE_GATE_RPM_DELTA", "500"))         # giri/min
+GATE_FUEL_DELTA = float(os.environ.get("ADVICE_GATE_FUEL_DELTA", "10"))        # %
+GATE_MAX_AGE_SEC = float(os.environ.get("ADVICE_GATE_MAX_AGE_SEC", "60"))      # advice forzato almeno ogni N secondi
+GATE_OFFLINE_SEC = float(os.environ.get("ADVICE_GATE_OFFLINE_SEC", "600"))     # snapshot rimosso se il veicolo tace
+GATE_MAX_VEHICLES = int(os.environ.get("ADVICE_GATE_MAX_VEHICLES", "10000"))
+
+# Snapshot compatto dell'ultimo stato per cui è stato richiesto un advice
+Snapshot = namedtuple("Snapshot", ["speed", "rpm", "fuel_level", "rule_id", "advised_at", "seen_at"])
+
+
+class AdviceGate:
+    """Gate di cambio stato: inoltra una richiesta advice solo se la classe rule-based cambia,
+    se speed/rpm/fuel si spostano oltre le soglie o se l'ultimo advice è troppo vecchio."""
+
+    def __init__(self, speed_delta: float = GATE_SPEED_DELTA, rpm_delta: float = GATE_RPM_DELTA,
+                 fuel_delta: float = GATE_FUEL_DELTA, max_age: float = GATE_MAX_AGE_SEC,
+                 offline_after: float = GATE_OFFLINE_SEC, max_vehicles: int = GATE_MAX_VEHICLES):
+        self.speed_delta = speed_delta
+        self.rpm_delta = rpm_delta
+        self.fuel_delta = fuel_delta
+        self.max_age = max_age
+        self.offline_after = offline_after
+        self.max_vehicles = max_vehicles
+        self._snapshots = OrderedDict()  # vehicle_id -> Snapshot, ordinato per ultimo messaggio
+        self._lock = threading.Lock()
+        self.forwarded = {"new": 0, "class_change": 0, "threshold": 0, "max_age": 0}
+        self.suppressed = 0
+        self.evicted = 0
+
+    def _reason(self, last: Optional[Snapshot], speed, rpm, fuel_level, rule_id, now) -> Optional[str]:
+        if last is None:
+            return "new"
+        if rule_id != last.rule_id:
+            return "class_change"
+        if (abs(speed - last.speed) >= self.speed_delta
+                or abs(rpm - last.rpm) >= self.rpm_delta
+                or abs(fuel_level - last.fuel_level) >= self.fuel_delta):
+            return "threshold"
+        if now - last.advised_at >= self.max_age:
+            return "max_age"
+        return None
+
+    def should_forward(self, vehicle_id: str, speed: float, rpm: float, fuel_level: float,
+                       rule_id: Optional[str] = None) -> bool:
+        """Valuta la lettura e aggiorna lo snapshot. True se la richiesta va inoltrata ad advice-queue.
+        `rule_id` può arrivare già calcolato (valutazione vettorizzata del batch)."""
+        if vehicle_id is None:
+            return True
+        now = time.monotonic()
+        if rule_id is None:
+            rule_id = classify(speed, rpm, fuel_level).rule_id
+
+        with self._lock:
+            last = self._snapshots.get(vehicle_id)
+            reason = self._reason(last, speed, rpm, fuel_level, rule_id, now)
+            if reason is None:
+                self._snapshots[vehicle_id] = last._replace(seen_at=now)
+                self.suppressed += 1
+            else:
+                self._snapshots[vehicle_id] = Snapshot(speed, rpm, fuel_level, rule_id, now, now)
+                self.forwarded[reason] += 1
+            self._snapshots.move_to_end(vehicle_id)
+            self._evict(now)
+        return reason is not None
+
+    def _evict(self, now: float):
+        # Veicoli offline (i più vecchi sono in testa) e limite di capacità
+        while self._snapshots:
+            vehicle_id, snapshot = next(iter(self._snapshots.items()))
+            if now - snapshot.seen_at < self.offline_after and len(self._snapshots) <= self.max_vehicles:
+                break
+            del self._snapshots[vehicle_id]
+            self.evicted += 1
+
+    def forget(self, vehicle_id: str):
+        """Rimuove lo snapshot di un veicolo (es. dopo la cancellazione dei suoi dati)."""
+        with self._lock:
+            self._snapshots.pop(vehicle_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            forwarded = sum(self.forwarded.values())
+            total = forwarded + self.suppressed
+            return {
+                "tracked_vehicles": len(self._snapshots),
+                "forwarded": dict(self.forwarded),
+                "suppressed": self.suppressed,
+                "evicted": self.evicted,
+                "suppressed_ratio": round(self.suppressed / total, 4) if total else 0.0,
+            }
+
+
+# --- Singleton ---
+
+_gate = None
+
+def get_advice_gate() -> Optional[AdviceGate]:
+    """Lazy singleton: None se il gate è disabilitato via ADVICE_GATE_ENABLED."""
+    global _gate
+    if _gate is None and GATE_ENABLED:
+        _gate = AdviceGate()
+        logger.info(f"✅ Advice gate initialized (max age {GATE_MAX_AGE_SEC}s, max {GATE_MAX_VEHICLES} vehicles)")
+    return _gate
@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+import threading
+
+from shared.client_registry import get_credential
+from shared.local_backend import get_local_backend
+
+QUEUE_NAME = "advice-queue"
+
+_queue_client = None
+_init_lock = threading.Lock()
+
+def get_advice_queue_client():
+    """Lazy singleton: QueueClient per drenare advice-queue fuori dal trigger (connection string o Managed Identity)."""
+    global _queue_client
+    local = get_local_backend()
+    if _queue_client is None and local is not None:
+        _queue_client = local.advice_queue
+    if _queue_client is None:
+        conn_str = os.environ.get("AzureStorageQueueConnectionString")
+        queue_uri = os.environ.get("AzureStorageQueueConnectionString__queueServiceUri")
+        if not conn_str and not queue_uri:
+            logging.warning("⚠️ AzureStorageQueueConnectionString not configured. Advice batching disabled.")
+            return None
+        with _init_lock:
+            if _queue_client is not None:
+                return _queue_client
+            from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
+            # Le Functions codificano i messaggi di coda in Base64 per default
+            policies = dict(
+                message_encode_policy=TextBase64EncodePolicy(),
+                message_decode_policy=TextBase64DecodePolicy(),
+            )
+            if conn_str:
+                _queue_client = QueueClient.from_connection_string(conn_str, QUEUE_NAME, **policies)
+            else:
+                _queue_client = QueueClient(queue_uri, QUEUE_NAME, credential=get_credential(), **policies)
+            logging.info("✅ QueueClient initialized for advice-queue")
+    return _queue_client
+
+
+def drain_advice_requests(max_messages, visibility_timeout=60):
+    """Preleva fino a max_messages richieste aggiuntive dalla coda. Restituisce [(queue_message, request)].
+    I messaggi restano invisibili per visibility_timeout secondi e vanno confermati con complete_advice_requests."""
+    client = get_advice_queue_client()
+    if client is None or max_messages <= 0:
+        return []
+
+    drained = []
+    try:
+        pages = client.receive_messages(
+            messages_per_page=min(max_messages, 32),  # limite del servizio per singola richiesta
+            visibility_timeout=visibility_timeout,
+            max_messages=max_messages,
+        )
+        for message in pages:
+            try:
+                drained.append((message, json.loads(message.content)))
+            except Exception as e:
+                # Messaggio malformato: lo rimuoviamo subito per non ripresentarlo all'infinito
+                logging.error(f"Error parsing drained advice request (dropped): {e}")
+                client.delete_message(message)
+    except Exception as e:
+        logging.error(f"Error draining advice-queue: {e}")
+    return drained
+
+
+def complete_advice_requests(messages):
+    """Conferma (cancella) i messaggi drenati dopo che il batch è stato elaborato."""
+    client = get_advice_queue_client()
+    if client is None:
+        return
+    for message in messages:
+        try:
+            client.delete_message(message)
+        except Exception as e:
+            logging.warning(f"⚠️ Could not delete drained advice message {message.id}: {e}")
@@ -1,9 +1,15 @@
+import json
 import logging
 import os
+import threading
+from typing import Dict, List
 
 from pydantic import BaseModel, Field
-from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+
+from shared.advice_cache import get_advice_cache
+from shared.instrumentation import get_instrumentation
+from shared.llm_guard import LLM_BATCH_TIMEOUT_SEC, LLM_MAX_RETRIES, ShortCircuit, get_llm_guard
+from shared.rules import classify
 
 logger = logging.getLogger(__name__)
 
@@ -15,28 +21,80 @@ class TelemetryAdvice(BaseModel):
     alert_level: str = Field(description="Uno tra: INFO, WARN, CRITICAL")
 
 
+class TelemetryAdviceItem(TelemetryAdvice):
+    """Consiglio relativo a una singola lettura all'interno di una richiesta batch."""
+    doc_id: str = Field(description="doc_id della lettura a cui si riferisce il consiglio")
+
+
+class BatchTelemetryAdvice(BaseModel):
+    """Risposta strutturata batch: un consiglio per ogni lettura ricevuta."""
+    items: List[TelemetryAdviceItem] = Field(description="Un elemento per ogni lettura, con lo stesso doc_id")
+
+
 # --- Singleton LLM Client ---
 
+# "gemini" (default) oppure "fake" (LLM locale deterministico per test e benchmark offline)
+LLM_PROVIDER = os.environ.get("ADVICE_LLM_PROVIDER", "gemini").lower()
+
 _llm = None
 _structured_llm = None
+_structured_batch_llm = None
+_init_lock = threading.RLock()  # il pre-warm in background e la prima invocazione non creano due client
 
-def _get_structured_llm():
-    """Lazy singleton: crea il client LLM + wrapper strutturato una sola volta per processo."""
-    global _llm, _structured_llm
-    if _structured_llm is None:
+def _get_llm():
+    """Lazy singleton: crea il client LLM una sola volta per processo.
+    langchain_google_genai (~1 s di import) viene caricato solo qui, non all'indicizzazione delle Functions."""
+    global _llm
+    if _llm is not None:
+        return _llm
+    with _init_lock:
+        if _llm is not None:
+            return _llm
+        if LLM_PROVIDER == "fake":
+            from shared.fake_llm import FakeChatModel
+            _llm = FakeChatModel()
+            logger.info("🧪 Fake LLM locale attivo (ADVICE_LLM_PROVIDER=fake)")
+            return _llm
         api_key = os.environ.get("GOOGLE_API_KEY")
         if not api_key:
             logger.warning("⚠️ GOOGLE_API_KEY non configurata. AI Advisor in modalità fallback.")
             return None
+        # Con il guard attivo i retry lunghi del client sono controproducenti: il budget lo decide il guard
+        limits = {"timeout": LLM_BATCH_TIMEOUT_SEC, "max_retries": LLM_MAX_RETRIES} if get_llm_guard() else {}
+        from langchain_google_genai import ChatGoogleGenerativeAI
         _llm = ChatGoogleGenerativeAI(
             model="gemini-2.5-flash-lite",
             google_api_key=api_key,
             temperature=0.3,
+            **limits,
         )
-        _structured_llm = _llm.with_structured_output(TelemetryAdvice)
-        logger.info("✅ Gemini 2.5 Flash Lite inizializzato via LangChain (structured output cached)")
+        logger.info("✅ Gemini 2.5 Flash Lite inizializzato via LangChain")
+    return _llm
+
+def _get_structured_llm():
+    """Lazy singleton: wrapper strutturato (singola lettura) creato una sola volta per processo."""
+    global _structured_llm
+    if _structured_llm is None:
+        with _init_lock:
+            llm = _get_llm()
+            if llm is None:
+                return None
+            if _structured_llm is None:
+                _structured_llm = llm.with_structured_output(TelemetryAdvice)
     return _structured_llm
 
+def _get_structured_batch_llm():
+    """Lazy singleton: wrapper strutturato per richieste multi-veicolo."""
+    global _structured_batch_llm
+    if _structured_batch_llm is None:
+        with _init_lock:
+            llm = _get_llm()
+            if llm is None:
+                return None
+            if _structured_batch_llm is None:
+                _structured_batch_llm = llm.with_structured_output(BatchTelemetryAdvice)
+    return _structured_batch_llm
+
 
 # --- Prompt Template ---
 
@@ -48,59 +106,196 @@ Regole per alert_level:
 - WARN: comportamento da correggere (RPM troppo alti, sosta con motore acceso, carburante basso)
 - CRITICAL: situazione pericolosa (velocità molto elevata, carburante quasi vuoto)"""
 
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+
+Riceverai un elenco JSON di letture, anche di veicoli diversi.
+Restituisci un consiglio per OGNI lettura, riportando esattamente lo stesso doc_id."""
+
 
 # --- Fallback Rule-Based ---
 
+# Un solo TelemetryAdvice per regola, condiviso (i chiamanti lo leggono soltanto)
+_INTERNED_ADVICE = {}
+
+def _interned_advice(rule) -> TelemetryAdvice:
+    advice = _INTERNED_ADVICE.get(rule.rule_id)
+    if advice is None:
+        advice = _INTERNED_ADVICE[rule.rule_id] = TelemetryAdvice(advice=rule.advice, alert_level=rule.alert_level)
+    return advice
+
+
 def _fallback_advice(speed: float, rpm: int, fuel_level: float) -> TelemetryAdvice:
     """Logica rule-based usata come fallback se Gemini non è disponibile."""
-    if speed > 130:
-        return TelemetryAdvice(
-            advice="Stai superando i limiti. Rallenta per sicurezza e consumi.",
-            alert_level="CRITICAL"
-        )
-    if fuel_level < 5:
-        return TelemetryAdvice(
-            advice="Carburante quasi esaurito! Fermati al primo distributore.",
-            alert_level="CRITICAL"
-        )
-    if rpm > 3000:
-        return TelemetryAdvice(
-            advice="Giri troppo alti! Cambia marcia per risparmiare carburante.",
-            alert_level="WARN"
-        )
-    if speed < 10 and rpm > 1000:
-        return TelemetryAdvice(
-            advice="Sei fermo o quasi. Spegni il motore se la sosta è lunga.",
-            alert_level="WARN"
-        )
-    return TelemetryAdvice(
-        advice="Guida ottimale. Continua così!",
-        alert_level="INFO"
-    )
+    metrics = get_instrumentation()
+    metrics.incr("llm.fallback")
+    with metrics.timer("llm.fallback"):
+        return _interned_advice(classify(speed, rpm, fuel_level))
+
+
+def _fallback_advice_batch(requests: List[dict]) -> Dict[str, TelemetryAdvice]:
+    """Fallback per un intero batch: una sola valutazione vettorizzata delle regole."""
+    if not requests:
+        return {}
+    from shared.rule_engine import get_rule_engine
+    metrics = get_instrumentation()
+    metrics.incr("llm.fallback", len(requests))
+    with metrics.timer("llm.fallback_batch"):
+        rules = get_rule_engine().classify_docs(requests)
+        return {r["doc_id"]: _interned_advice(rule) for r, rule in zip(requests, rules)}
+
+
+# --- Chiamate protette (circuit breaker, limiter adattivo, budget di tempo) ---
+
+def _invoke(llm, messages, timeout=None):
+    """invoke() attraverso il guard; ShortCircuit se il breaker è aperto o il limiter è saturo."""
+    guard = get_llm_guard()
+    if guard is None:
+        return llm.invoke(messages)
+    if timeout is None:
+        return guard.call(llm.invoke, messages)
+    return guard.call(llm.invoke, messages, timeout=timeout)
+
+
+async def _ainvoke(llm, messages):
+    guard = get_llm_guard()
+    if guard is None:
+        return await llm.ainvoke(messages)
+    return await guard.acall(llm.ainvoke, messages)
 
 
 # --- Entry Point ---
 
+def _messages(system: str, user: str) -> list:
+    from langchain_core.messages import HumanMessage, SystemMessage  # già in memoria quando esiste un client
+    return [SystemMessage(content=system), HumanMessage(content=user)]
+
+
+def _format_user_message(speed: float, rpm: int, fuel_level: float) -> str:
+    return (
+        f"Dati telemetrici:\n"
+        f"- Velocità: {speed} km/h\n"
+        f"- RPM: {rpm}\n"
+        f"- Livello carburante: {fuel_level}%"
+    )
+
+
+def _cached_advice(speed: float, rpm: int, fuel_level: float):
+    """Cache su bucket quantizzati: evita il round-trip Gemini per input che differiscono solo per rumore.
+    Restituisce (advice in cache o None, bucket in cui salvare la risposta o None senza cache)."""
+    cache = get_advice_cache()
+    if cache is None:
+        return None, None
+    bucket = cache.bucket(speed, rpm, fuel_level)
+    cached = cache.get(bucket)
+    if cached is not None:
+        get_instrumentation().incr("llm.cache_hits")
+        return TelemetryAdvice(**cached), bucket
+    return None, bucket
+
+
+def _accept_advice(result: TelemetryAdvice, bucket) -> TelemetryAdvice:
+    logger.info(f"🤖 Gemini advice: {result.advice} [{result.alert_level}]")
+    if bucket is not None:
+        get_advice_cache().put(bucket, {"advice": result.advice, "alert_level": result.alert_level})
+    return result
+
+
+def _failed_advice(e: Exception, speed: float, rpm: int, fuel_level: float) -> TelemetryAdvice:
+    if isinstance(e, ShortCircuit):
+        # Breaker aperto o limiter saturo: regole subito, senza attendere Gemini
+        logger.info(f"⏭️ Gemini call skipped ({e.reason}), using fallback")
+    else:
+        get_instrumentation().incr("llm.errors")
+        logger.error(f"❌ Gemini call failed, using fallback: {e!r}")
+    return _fallback_advice(speed, rpm, fuel_level)
+
+
 def get_ai_advice(speed: float, rpm: int, fuel_level: float) -> TelemetryAdvice:
     """Genera un consiglio AI sui dati telemetrici. Fallback a regole se Gemini non disponibile."""
     structured_llm = _get_structured_llm()
     if structured_llm is None:
         return _fallback_advice(speed, rpm, fuel_level)
+    cached, bucket = _cached_advice(speed, rpm, fuel_level)
+    if cached is not None:
+        return cached
+    try:
+        with get_instrumentation().timer("llm.invoke"):
+            result = _invoke(structured_llm, _messages(SYSTEM_PROMPT, _format_user_message(speed, rpm, fuel_level)))
+    except Exception as e:
+        return _failed_advice(e, speed, rpm, fuel_level)
+    return _accept_advice(result, bucket)
+
 
+async def aget_ai_advice(speed: float, rpm: int, fuel_level: float) -> TelemetryAdvice:
+    """Variante asincrona di get_ai_advice (usa `ainvoke`, non blocca l'event loop)."""
+    structured_llm = _get_structured_llm()
+    if structured_llm is None:
+        return _fallback_advice(speed, rpm, fuel_level)
+    cached, bucket = _cached_advice(speed, rpm, fuel_level)
+    if cached is not None:
+        return cached
     try:
-        user_message = (
-            f"Dati telemetrici:\n"
-            f"- Velocità: {speed} km/h\n"
-            f"- RPM: {rpm}\n"
-            f"- Livello carburante: {fuel_level}%"
-        )
-        result = structured_llm.invoke([
-            SystemMessage(content=SYSTEM_PROMPT),
-            HumanMessage(content=user_message),
-        ])
-        logger.info(f"🤖 Gemini advice: {result.advice} [{result.alert_level}]")
-        return result
+        with get_instrumentation().timer("llm.invoke"):
+            result = await _ainvoke(structured_llm, _messages(SYSTEM_PROMPT, _format_user_message(speed, rpm, fuel_level)))
+    except Exception as e:
+        return _failed_advice(e, speed, rpm, fuel_level)
+    return _accept_advice(result, bucket)
 
+
+def get_ai_advice_batch(requests: List[dict]) -> Dict[str, TelemetryAdvice]:
+    """Genera i consigli per più richieste (anche di veicoli diversi) con una sola chiamata strutturata.
+    Restituisce un dict doc_id -> TelemetryAdvice. Se la risposta batch è malformata o incompleta,
+    le richieste mancanti vengono rielaborate singolarmente con get_ai_advice."""
+    results = {}
+    batch_llm = _get_structured_batch_llm()
+    if batch_llm is None:
+        return _fallback_advice_batch(requests)
+
+    # 1. Le letture già in cache non vengono inviate al modello
+    cache = get_advice_cache()
+    pending = {}
+    for r in requests:
+        speed, rpm, fuel_level = r.get("speed", 0), r.get("rpm", 0), r.get("fuel_level", 100)
+        cached = cache.get(cache.bucket(speed, rpm, fuel_level)) if cache is not None else None
+        if cached is not None:
+            get_instrumentation().incr("llm.cache_hits")
+            results[r["doc_id"]] = TelemetryAdvice(**cached)
+        else:
+            pending[r["doc_id"]] = r
+    if not pending:
+        return results
+
+    # 2. Una sola chiamata strutturata per tutte le letture rimanenti
+    by_id = {}
+    try:
+        readings = [
+            {"doc_id": doc_id, "speed": r.get("speed", 0), "rpm": r.get("rpm", 0), "fuel_level": r.get("fuel_level", 100)}
+            for doc_id, r in pending.items()
+        ]
+        with get_instrumentation().timer("llm.invoke_batch"):
+            response = _invoke(batch_llm, _messages(BATCH_SYSTEM_PROMPT, json.dumps(readings)),
+                               timeout=LLM_BATCH_TIMEOUT_SEC)
+        by_id = {
+            item.doc_id: TelemetryAdvice(advice=item.advice, alert_level=item.alert_level)
+            for item in response.items
+        }
+        logger.info(f"🤖 Gemini batch advice: {len(by_id)}/{len(pending)} items")
+    except ShortCircuit as e:
+        # Con il breaker aperto anche le chiamate per-item verrebbero saltate: regole per tutto il batch
+        logger.info(f"⏭️ Gemini batch call skipped ({e.reason}), using fallback")
+        results.update(_fallback_advice_batch(list(pending.values())))
+        return results
     except Exception as e:
-        logger.error(f"❌ Gemini call failed, using fallback: {e}")
-        return _fallback_advice(speed, rpm, fuel_level)
+        get_instrumentation().incr("llm.errors")
+        logger.error(f"❌ Gemini batch call failed, falling back to per-item calls: {e!r}")
+
+    # 3. Fan-out: gli elementi mancanti nella risposta batch vengono richiesti singolarmente
+    for doc_id, r in pending.items():
+        speed, rpm, fuel_level = r.get("speed", 0), r.get("rpm", 0), r.get("fuel_level", 100)
+        advice = by_id.get(doc_id)
+        if advice is None:
+            advice = get_ai_advice(speed, rpm, fuel_level)
+        elif cache is not None:
+            cache.put(cache.bucket(speed, rpm, fuel_level), {"advice": advice.advice, "alert_level": advice.alert_level})
+        results[doc_id] = advice
+    return results
@@ -0,0 +1,320 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+import zlib
+from typing import Callable, List, Optional
+from urllib.parse import quote
+
+from shared.local_backend import get_local_backend
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+SIGNALR_MODE = os.environ.get("SIGNALR_MODE", "event").lower()                     # event | frames
+SIGNALR_FRAME_INTERVAL_SEC = float(os.environ.get("SIGNALR_FRAME_INTERVAL_SEC", "1"))
+SIGNALR_FRAME_DELTAS = os.environ.get("SIGNALR_FRAME_DELTAS", "true").lower() == "true"
+SIGNALR_KEYFRAME_EVERY = int(os.environ.get("SIGNALR_KEYFRAME_EVERY", "10"))      # un frame completo ogni N (delta)
+SIGNALR_GROUP_MODE = os.environ.get("SIGNALR_GROUP_MODE", "none").lower()          # none | vehicle | shard
+SIGNALR_GROUP_SHARDS = int(os.environ.get("SIGNALR_GROUP_SHARDS", "8"))
+SIGNALR_MAX_VEHICLES = int(os.environ.get("SIGNALR_MAX_VEHICLES", "10000"))
+SIGNALR_FRAME_MAX_BYTES = int(os.environ.get("SIGNALR_FRAME_MAX_BYTES", "131072"))  # oltre, il frame è diviso in parti
+SIGNALR_HUB = "telemetryHub"
+
+FRAME_TARGET = "telemetryFrame"
+FLEET_GROUP = "fleet"
+
+# Campi della telemetria e dell'advice inclusi nei frame (il resto del documento resta su Cosmos)
+TELEMETRY_FIELDS = ("id", "timestamp", "speed", "rpm", "fuel_level")
+ADVICE_FIELDS = ("doc_id", "ai_advice", "alert_level")
+
+
+def group_for(vehicle_id: str, mode: str = SIGNALR_GROUP_MODE, shards: int = SIGNALR_GROUP_SHARDS) -> Optional[str]:
+    """Gruppo SignalR che riceve gli aggiornamenti del veicolo (None = broadcast a tutti)."""
+    if mode == "vehicle":
+        return f"vehicle-{vehicle_id}"
+    if mode == "shard":
+        return f"shard-{zlib.crc32(vehicle_id.encode('utf-8')) % shards}"
+    return None
+
+
+def subscription_groups(vehicle_id: Optional[str], mode: str = SIGNALR_GROUP_MODE,
+                        shards: int = SIGNALR_GROUP_SHARDS) -> List[str]:
+    """Gruppi a cui iscrivere una connessione della dashboard (vehicle_id None = vista di flotta)."""
+    if mode == "none":
+        return []
+    if vehicle_id:
+        return [group_for(vehicle_id, mode, shards)]
+    if mode == "shard":
+        return [f"shard-{i}" for i in range(shards)]
+    return [FLEET_GROUP]
+
+
+class FrameBroadcaster:
+    """Coalesce degli aggiornamenti per la dashboard: tiene solo l'ultimo stato per veicolo ed emette al più
+    un frame per gruppo ogni `interval` secondi. In modalità delta ogni veicolo porta solo i campi di telemetria
+    cambiati rispetto al frame precedente dello stesso gruppo, con un frame completo (keyframe) ogni `keyframe_every`;
+    un frame più grande di `max_bytes` viene diviso in parti con lo stesso seq.
+    Lo stato è per worker e i frame di worker diversi si sommano lato client (merge per campo): la base dei delta
+    e i keyframe contengono solo la telemetria, che per un veicolo arriva a un solo worker (partizione Event Hub),
+    mentre l'advice (elaborato da qualunque istanza) viaggia sempre intero e non viene mai ripetuto."""
+
+    def __init__(self, interval: float = SIGNALR_FRAME_INTERVAL_SEC, deltas: bool = SIGNALR_FRAME_DELTAS,
+                 keyframe_every: int = SIGNALR_KEYFRAME_EVERY, group_mode: str = SIGNALR_GROUP_MODE,
+                 shards: int = SIGNALR_GROUP_SHARDS, max_vehicles: int = SIGNALR_MAX_VEHICLES,
+                 max_bytes: int = SIGNALR_FRAME_MAX_BYTES):
+        self.interval = interval
+        self.deltas = deltas
+        self.keyframe_every = max(1, keyframe_every)
+        self.group_mode = group_mode
+        self.shards = shards
+        self.max_vehicles = max_vehicles
+        self.max_bytes = max_bytes
+        self._pending = {}    # vehicle_id -> campi aggiornati dall'ultimo frame
+        self._sent = {}       # vehicle_id -> ultima telemetria inviata (base dei delta e dei keyframe)
+        self._frames = {}     # gruppo -> numero di frame emessi
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self.updates = 0
+        self.coalesced = 0
+        self.frames = 0
+        self.keyframes = 0
+        self.vehicle_updates = 0
+        self.messages = 0
+        self.background_flushes = 0
+        self.background_errors = 0
+        self._flusher = None
+
+    def add(self, vehicle_id: str, fields: dict):
+        """Registra l'ultimo stato (parziale) di un veicolo; sovrascrive quello non ancora inviato."""
+        if not vehicle_id:
+            return
+        with self._lock:
+            self.updates += 1
+            pending = self._pending.get(vehicle_id)
+            if pending is None:
+                self._pending[vehicle_id] = dict(fields)
+            else:
+                self.coalesced += 1
+                pending.update(fields)
+
+    def add_telemetry(self, doc: dict):
+        self.add(doc.get("vehicle_id"), {k: doc[k] for k in TELEMETRY_FIELDS if k in doc})
+
+    def add_advice(self, doc_id: str, vehicle_id: str, advice: str, alert_level: str):
+        self.add(vehicle_id, {"doc_id": doc_id, "ai_advice": advice, "alert_level": alert_level})
+
+    def collect(self, force: bool = False) -> List[dict]:
+        """Messaggi SignalR dei frame dovuti (lista vuota se il tick non è ancora scaduto)."""
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.interval:
+            return []
+        with self._lock:
+            if not force and now - self._last_flush < self.interval:
+                return []
+            self._last_flush = now
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return []
+            groups = {}
+            for vehicle_id, fields in pending.items():
+                groups.setdefault(group_for(vehicle_id, self.group_mode, self.shards), []).append(vehicle_id)
+                if self.group_mode == "vehicle":
+                    groups.setdefault(FLEET_GROUP, []).append(vehicle_id)
+            messages = [message for group, vehicle_ids in groups.items()
+                         for message in self._frame(group, vehicle_ids, pending)]
+            for vehicle_id, fields in pending.items():
+                telemetry = {k: v for k, v in fields.items() if k in TELEMETRY_FIELDS}
+                if telemetry:
+                    self._sent.setdefault(vehicle_id, {}).update(telemetry)
+            while len(self._sent) > self.max_vehicles:
+                del self._sent[next(iter(self._sent))]
+            return messages
+
+    def _frame(self, group: Optional[str], vehicle_ids: List[str], pending: dict) -> List[dict]:
+        seq = self._frames.get(group, 0)
+        self._frames[group] = seq + 1
+        keyframe = not self.deltas or seq % self.keyframe_every == 0
+        vehicles = {}
+        if keyframe:
+            # Il keyframe riporta la telemetria di tutti i veicoli noti del gruppo: i client appena
+            # connessi si sincronizzano senza leggere lo storico
+            for vehicle_id, state in self._sent.items():
+                if group in (None, FLEET_GROUP) or group_for(vehicle_id, self.group_mode, self.shards) == group:
+                    vehicles[vehicle_id] = dict(state)
+        for vehicle_id in vehicle_ids:
+            fields = pending[vehicle_id]
+            previous = self._sent.get(vehicle_id, {})
+            if keyframe:
+                vehicles[vehicle_id] = {**previous, **fields}
+            else:
+                # L'advice non ha una base affidabile (altre istanze possono averne inviato uno più recente)
+                changed = {k: v for k, v in fields.items() if k not in TELEMETRY_FIELDS or previous.get(k) != v}
+                if changed:
+                    vehicles[vehicle_id] = changed
+        if not vehicles:
+            return []
+        self.frames += 1
+        self.keyframes += keyframe
+        self.vehicle_updates += len(vehicles)
+        parts = self._split(vehicles)
+        messages = []
+        for index, part in enumerate(parts):
+            frame = {"seq": seq, "keyframe": keyframe, "ts": time.time(), "vehicles": part}
+            if len(parts) > 1:
+                frame.update(part=index, parts=len(parts))
+            message = {"target": FRAME_TARGET, "arguments": [frame]}
+            if group is not None:
+                message["groupName"] = group
+            messages.append(message)
+        self.messages += len(messages)
+        return messages
+
+    def _split(self, vehicles: dict) -> List[dict]:
+        """Divide i veicoli di un frame in parti di al più max_bytes (JSON), sotto il limite dei messaggi SignalR."""
+        parts, current, size = [], {}, 0
+        for vehicle_id, fields in vehicles.items():
+            entry = len(json.dumps(fields, separators=(",", ":"))) + len(vehicle_id) + 4
+            if current and size + entry > self.max_bytes:
+                parts.append(current)
+                current, size = {}, 0
+            current[vehicle_id] = fields
+            size += entry
+        parts.append(current)
+        return parts
+
+    def start_flusher(self, send: Callable[[str], None]):
+        """Avvia (una volta per processo) il thread che invia i frame rimasti nel buffer quando non arrivano
+        altre invocazioni: ogni istanza svuota il proprio buffer, senza dipendere da un timer singleton."""
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, args=(send,), name="frame-flusher", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self, send):
+        while True:
+            time.sleep(self.interval)
+            try:
+                frames = self.collect()
+                if frames:
+                    send(json.dumps(frames))
+                    with self._lock:
+                        self.background_flushes += 1
+            except Exception as e:
+                with self._lock:
+                    self.background_errors += 1
+                logger.warning(f"⚠️ Could not flush pending telemetry frames: {e}")
+
+    def forget(self, vehicle_id: str = None):
+        """Dimentica lo stato di un veicolo o, se None, di tutti (es. dopo la cancellazione dei dati)."""
+        with self._lock:
+            if vehicle_id:
+                self._pending.pop(vehicle_id, None)
+                self._sent.pop(vehicle_id, None)
+            else:
+                self._pending.clear()
+                self._sent.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "group_mode": self.group_mode,
+                "deltas": self.deltas,
+                "updates": self.updates,
+                "coalesced": self.coalesced,
+                "frames": self.frames,
+                "messages": self.messages,
+                "keyframes": self.keyframes,
+                "background_flushes": self.background_flushes,
+                "background_errors": self.background_errors,
+                "vehicles_per_frame": round(self.vehicle_updates / self.frames, 2) if self.frames else 0.0,
+                "pending_vehicles": len(self._pending),
+                "tracked_vehicles": len(self._sent),
+                "messages_saved_ratio": round(1 - self.frames / self.updates, 4) if self.updates else 0.0,
+            }
+
+
+# --- Invio diretto (fuori dalle invocazioni) ---
+
+class SignalRRestSender:
+    """Invia payload del binding SignalR (JSON di un messaggio o di una lista) con la REST API del servizio,
+    autenticata con un JWT firmato dall'AccessKey della connection string."""
+
+    def __init__(self, endpoint: str, access_key: str, hub: str = SIGNALR_HUB, timeout: float = 5.0):
+        self.endpoint = endpoint.rstrip("/")
+        self.access_key = access_key
+        self.hub = hub
+        self.timeout = timeout
+
+    @classmethod
+    def from_connection_string(cls, connection_string: str, hub: str = SIGNALR_HUB):
+        parts = dict(item.split("=", 1) for item in connection_string.split(";") if "=" in item)
+        if "Endpoint" not in parts or "AccessKey" not in parts:
+            raise ValueError("connection string SignalR senza Endpoint/AccessKey")
+        endpoint = parts["Endpoint"]
+        if parts.get("Port"):
+            endpoint = f"{endpoint.rstrip('/')}:{parts['Port']}"
+        return cls(endpoint, parts["AccessKey"], hub)
+
+    def _token(self, audience: str) -> str:
+        def encode(data):
+            raw = data if isinstance(data, bytes) else json.dumps(data, separators=(",", ":")).encode("utf-8")
+            return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+        signing_input = f"{encode({'alg': 'HS256', 'typ': 'JWT'})}.{encode({'aud': audience, 'exp': int(time.time()) + 300})}"
+        signature = hmac.new(self.access_key.encode("utf-8"), signing_input.encode("ascii"), hashlib.sha256).digest()
+        return f"{signing_input}.{encode(signature)}"
+
+    def __call__(self, payload: str):
+        messages = json.loads(payload)
+        for message in messages if isinstance(messages, list) else [messages]:
+            url = f"{self.endpoint}/api/v1/hubs/{quote(self.hub)}"
+            if message.get("groupName"):
+                url += f"/groups/{quote(message['groupName'])}"
+            body = json.dumps({"target": message["target"], "arguments": message["arguments"]}).encode("utf-8")
+            request = urllib.request.Request(url, data=body, method="POST", headers={
+                "Authorization": f"Bearer {self._token(url)}", "Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+
+
+def _direct_sender() -> Optional[Callable[[str], None]]:
+    """Registratore del backend locale, REST API se SignalRConnectionString ha una AccessKey, altrimenti None."""
+    local = get_local_backend()
+    if local is not None:
+        return local.signalr.record
+    connection_string = os.environ.get("SignalRConnectionString")
+    if not connection_string:
+        return None
+    try:
+        return SignalRRestSender.from_connection_string(connection_string)
+    except ValueError as e:
+        logger.warning(f"⚠️ Background frame flush disabled: {e}")
+        return None
+
+
+# --- Singleton ---
+
+_broadcaster = None
+_init_lock = threading.Lock()
+
+def get_frame_broadcaster() -> Optional[FrameBroadcaster]:
+    """Lazy singleton: None in modalità SIGNALR_MODE=event (un messaggio SignalR per evento)."""
+    global _broadcaster
+    if _broadcaster is None and SIGNALR_MODE == "frames":
+        with _init_lock:
+            if _broadcaster is None:
+                _broadcaster = FrameBroadcaster()
+                send = _direct_sender()
+                if send is not None:
+                    _broadcaster.start_flusher(send)
+                logger.info(f"✅ SignalR frame broadcaster initialized (interval {SIGNALR_FRAME_INTERVAL_SEC}s, "
+                            f"deltas: {SIGNALR_FRAME_DELTAS}, groups: {SIGNALR_GROUP_MODE}, "
+                            f"background flush: {send is not None})")
+    return _broadcaster
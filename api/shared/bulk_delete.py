@@ -0,0 +1,258 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+DELETE_PAGE_SIZE = int(os.environ.get("DELETE_PAGE_SIZE", "1000"))              # documenti per pagina di query
+DELETE_CONCURRENCY = int(os.environ.get("DELETE_CONCURRENCY", "8"))              # partizioni elaborate in parallelo
+DELETE_MAX_RETRIES = int(os.environ.get("DELETE_MAX_RETRIES", "8"))              # tentativi su 429
+DELETE_CHECKPOINT_DIR = os.environ.get("DELETE_CHECKPOINT_DIR", "")              # copia dei checkpoint su file (sviluppo)
+DELETE_SLICE_SEC = float(os.environ.get("DELETE_SLICE_SEC", "240"))              # lavoro massimo per invocazione
+DELETE_STALE_SEC = float(os.environ.get("DELETE_STALE_SEC", "900"))              # pending/running senza checkpoint = interrotto
+DELETE_QUEUE_NAME = "delete-jobs"  # coda che porta avanti i job, una fetta per messaggio
+MAX_BATCH_OPERATIONS = 100  # limite Cosmos per batch transazionale
+
+
+# --- Retry con backoff su throttling (429) ---
+
+def _retry_after(e, attempt):
+    """Attesa suggerita dal servizio (x-ms-retry-after-ms) o backoff esponenziale con tetto."""
+    headers = getattr(e, "headers", None) or {}
+    retry_ms = headers.get("x-ms-retry-after-ms")
+    if retry_ms:
+        return float(retry_ms) / 1000.0
+    return min(0.1 * (2 ** attempt), 5.0)
+
+
+def _with_backoff(job, fn, *args, **kwargs):
+    from azure.cosmos.exceptions import CosmosHttpResponseError
+    for attempt in range(DELETE_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except CosmosHttpResponseError as e:
+            if e.status_code != 429 or attempt == DELETE_MAX_RETRIES:
+                raise
+            job.record(throttled=1)
+            time.sleep(_retry_after(e, attempt))
+
+
+# --- Job di cancellazione ---
+
+class DeleteJob:
+    """Stato di una cancellazione bulk: avanzamento (contatori, pagine) ed esito. Non serve un
+    continuation token: la query seleziona solo documenti non ancora cancellati, quindi ogni ripresa
+    la riesegue dall'inizio. Stati: pending (accodato) → running (fette in corso) → completed | failed."""
+
+    def __init__(self, query, params=None, partition_key=None, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.query = query
+        self.params = params or []
+        self.partition_key = partition_key
+        self.status = "pending"  # pending | running | completed | failed
+        self.deleted = 0
+        self.already_gone = 0
+        self.failed = 0
+        self.throttled = 0
+        self.pages = 0
+        self.error = None
+        self.started_at = None
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def record(self, deleted=0, already_gone=0, failed=0, throttled=0):
+        with self._lock:
+            self.deleted += deleted
+            self.already_gone += already_gone
+            self.failed += failed
+            self.throttled += throttled
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "query": self.query,
+                "params": self.params,
+                "partition_key": self.partition_key,
+                "deleted": self.deleted,
+                "already_gone": self.already_gone,
+                "failed": self.failed,
+                "throttled": self.throttled,
+                "pages": self.pages,
+                "error": self.error,
+                "started_at": self.started_at,
+                "updated_at": self.updated_at,
+            }
+
+    def is_stale(self, stale_sec=DELETE_STALE_SEC):
+        """Job pending o running senza checkpoint da stale_sec secondi: il messaggio su delete-jobs è
+        andato perso o in poison queue (prima o durante una fetta) e il job può essere ripreso."""
+        if self.status not in ("pending", "running") or not self.updated_at:
+            return False
+        updated = datetime.datetime.fromisoformat(self.updated_at)
+        return (datetime.datetime.now(datetime.timezone.utc) - updated).total_seconds() > stale_sec
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data["query"], data.get("params"), data.get("partition_key"), job_id=data["job_id"])
+        for field in ("status", "deleted", "already_gone", "failed", "throttled", "pages",
+                      "error", "started_at", "updated_at"):
+            setattr(job, field, data.get(field, getattr(job, field)))
+        return job
+
+
+# --- Registro dei job: container Cosmos Jobs (condiviso tra istanze), in memoria se non configurato ---
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def _job_store():
+    from shared.cosmos_client import get_jobs_container
+    try:
+        return get_jobs_container()
+    except Exception as e:
+        logger.warning(f"⚠️ Jobs container unavailable, delete job state kept in memory: {e}")
+        return None
+
+
+def _checkpoint_path(job_id):
+    return os.path.join(DELETE_CHECKPOINT_DIR, f"delete-job-{job_id}.json")
+
+
+def save_checkpoint(job):
+    """Persiste stato e avanzamento del job. Un errore di scrittura viene solo loggato:
+    il job prosegue e il checkpoint della pagina successiva ritenta."""
+    job.updated_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    data = job.to_dict()
+    with _jobs_lock:
+        _jobs[job.job_id] = job
+    store = _job_store()
+    if store is not None:
+        try:
+            _with_backoff(job, store.upsert_item, {"id": job.job_id, "kind": "delete_job", **data})
+        except Exception as e:
+            logger.warning(f"⚠️ Could not persist delete job {job.job_id}: {e}")
+    if DELETE_CHECKPOINT_DIR:
+        try:
+            os.makedirs(DELETE_CHECKPOINT_DIR, exist_ok=True)
+            tmp_path = _checkpoint_path(job.job_id) + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, _checkpoint_path(job.job_id))
+        except OSError as e:
+            logger.warning(f"⚠️ Could not write delete checkpoint for {job.job_id}: {e}")
+
+
+def get_job(job_id):
+    """Ultimo checkpoint del job: dal container Jobs (scritto da qualsiasi istanza), altrimenti dalla
+    memoria di questo worker o dal file di checkpoint."""
+    from azure.cosmos.exceptions import CosmosResourceNotFoundError
+    store = _job_store()
+    if store is not None:
+        try:
+            return DeleteJob.from_dict(store.read_item(item=job_id, partition_key=job_id))
+        except CosmosResourceNotFoundError:
+            return None
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None and DELETE_CHECKPOINT_DIR and os.path.exists(_checkpoint_path(job_id)):
+        with open(_checkpoint_path(job_id), "r", encoding="utf-8") as f:
+            job = DeleteJob.from_dict(json.load(f))
+        with _jobs_lock:
+            _jobs[job_id] = job
+    return job
+
+
+# --- Motore di cancellazione ---
+
+def _delete_one(container, job, item_id, pk):
+    from azure.cosmos.exceptions import CosmosResourceNotFoundError
+    try:
+        _with_backoff(job, container.delete_item, item=item_id, partition_key=pk)
+        job.record(deleted=1)
+    except CosmosResourceNotFoundError:
+        job.record(already_gone=1)
+    except Exception as e:
+        job.record(failed=1)
+        logger.warning(f"⚠️ Could not delete {item_id}: {e}")
+
+
+def _delete_partition(container, job, pk, item_ids):
+    """Cancella i documenti di una partizione in batch transazionali da 100 (per-item se il batch fallisce)."""
+    from azure.cosmos.exceptions import CosmosBatchOperationError, CosmosHttpResponseError
+
+    for start in range(0, len(item_ids), MAX_BATCH_OPERATIONS):
+        chunk = item_ids[start:start + MAX_BATCH_OPERATIONS]
+        if len(chunk) > 1:
+            try:
+                _with_backoff(job, container.execute_item_batch,
+                              batch_operations=[("delete", (item_id,)) for item_id in chunk],
+                              partition_key=pk)
+                job.record(deleted=len(chunk))
+                continue
+            except CosmosBatchOperationError:
+                pass  # es. un documento già cancellato: la transazione è annullata, si procede per-item
+            except CosmosHttpResponseError as e:
+                if e.status_code == 429:
+                    raise
+        for item_id in chunk:
+            _delete_one(container, job, item_id, pk)
+
+
+def run_delete_job(container, pk_field, job, concurrency=DELETE_CONCURRENCY, page_size=DELETE_PAGE_SIZE,
+                   deadline=None):
+    """Scorre la query per pagine, raggruppa per partition key e cancella le partizioni in parallelo.
+    Dopo ogni pagina salva l'avanzamento. Con `deadline` (time.monotonic()) si ferma alla prima pagina
+    completata oltre la scadenza e lascia il job "running". Una ripresa (fetta successiva o ?resume=)
+    riesegue la query dall'inizio: i documenti già cancellati non vi compaiono più, mentre un continuation
+    token preso prima delle cancellazioni può saltare documenti su una query nuova."""
+    job.status = "running"
+    job.error = None
+    job.started_at = job.started_at or datetime.datetime.now(datetime.timezone.utc).isoformat()
+    save_checkpoint(job)
+
+    query_kwargs = {"query": job.query, "parameters": job.params, "max_item_count": page_size}
+    if job.partition_key is not None:
+        query_kwargs["partition_key"] = job.partition_key
+    else:
+        query_kwargs["enable_cross_partition_query"] = True
+
+    try:
+        pager = container.query_items(**query_kwargs).by_page()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for page in pager:
+                by_partition = {}
+                for item in page:
+                    by_partition.setdefault(item[pk_field], []).append(item["id"])
+                # list() propaga eventuali eccezioni (es. 429 oltre i tentativi)
+                list(pool.map(lambda entry: _delete_partition(container, job, entry[0], entry[1]),
+                              by_partition.items()))
+                job.pages += 1
+                save_checkpoint(job)
+                logger.info(f"🗑️ Delete job {job.job_id}: page {job.pages}, {job.deleted} deleted so far")
+                if not pager.continuation_token:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    return job  # avanzamento già salvato: la prossima fetta riesegue la query
+        job.status = "completed"
+    except Exception as e:
+        job.status = "failed"
+        job.error = str(e)
+        logger.error(f"Delete job {job.job_id} failed (resumable with ?resume=): {e}")
+    save_checkpoint(job)
+    return job
+
+
+def run_delete_slice(container, pk_field, job, slice_sec=DELETE_SLICE_SEC):
+    """Una fetta del job (al massimo slice_sec secondi, sotto il timeout della Function). True se il job
+    va proseguito con un nuovo messaggio su DELETE_QUEUE_NAME."""
+    run_delete_job(container, pk_field, job, deadline=time.monotonic() + slice_sec)
+    return job.status == "running"
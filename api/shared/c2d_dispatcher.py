@@ -0,0 +1,288 @@
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from shared.instrumentation import get_instrumentation
+from shared.iot_hub import get_iot_registry_manager
+from shared.rules import ALERT_LEVELS
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+C2D_DISPATCHER_ENABLED = os.environ.get("C2D_DISPATCHER_ENABLED", "true").lower() == "true"
+C2D_DEDUP_WINDOW_SEC = float(os.environ.get("C2D_DEDUP_WINDOW_SEC", "60"))      # stesso advice/livello soppresso per N secondi
+C2D_MIN_INTERVAL_SEC = float(os.environ.get("C2D_MIN_INTERVAL_SEC", "10"))      # al più un messaggio non CRITICAL ogni N secondi per device
+C2D_WORKERS = int(os.environ.get("C2D_WORKERS", "4"))
+C2D_QUEUE_MAX = int(os.environ.get("C2D_QUEUE_MAX", "1000"))
+C2D_MAX_RETRIES = int(os.environ.get("C2D_MAX_RETRIES", "3"))
+C2D_BACKOFF_BASE_SEC = float(os.environ.get("C2D_BACKOFF_BASE_SEC", "0.5"))
+C2D_DEVICE_BACKOFF_SEC = float(os.environ.get("C2D_DEVICE_BACKOFF_SEC", "60"))  # pausa per device con coda C2D piena
+C2D_MAX_DEVICES = int(os.environ.get("C2D_MAX_DEVICES", "10000"))
+C2D_WAIT_SEC = float(os.environ.get("C2D_WAIT_SEC", "5"))                      # attesa a fine invocazione dei messaggi accodati
+
+# Priorità in coda (valore più basso = servito prima): CRITICAL, WARN, INFO
+PRIORITIES = {level: priority for priority, level in enumerate(reversed(ALERT_LEVELS))}
+
+
+def classify_error(error: Exception) -> str:
+    """Classifica un errore dell'SDK IoT Hub: 'throttled' (429), 'queue_full' (coda C2D del device piena,
+    403004), 'permanent' (es. device inesistente) o 'transient'."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    text = str(error)
+    if status == 429 or "Throttl" in text or "429" in text:
+        return "throttled"
+    if "QueueDepthExceeded" in text or "403004" in text:
+        return "queue_full"
+    if status in (400, 401, 403, 404) or "DeviceNotFound" in text:
+        return "permanent"
+    return "transient"
+
+
+class _DeviceState:
+    __slots__ = ("advice", "alert_level", "sent_at", "blocked_until")
+
+    def __init__(self):
+        self.advice = None
+        self.alert_level = None
+        self.sent_at = float("-inf")
+        self.blocked_until = 0.0
+
+
+class C2DDispatcher:
+    """Dispatcher dei messaggi C2D: dedup per device nella finestra, rate limit per device (CRITICAL
+    esclusi), coda a priorità servita da un pool di worker e backoff su throttling/coda piena.
+
+    I CRITICAL vengono consegnati subito nel thread del chiamante; gli altri sono accodati e
+    l'invocazione attende con wait() la consegna dei propri messaggi prima di terminare, perché un
+    riciclo o un freeze dell'host perderebbe quelli ancora in coda. Lo stato di dedup e rate limit
+    è in memoria, quindi per istanza: con più istanze lo stesso device può ricevere duplicati."""
+
+    def __init__(self, registry_manager_factory: Callable, dedup_window: float = C2D_DEDUP_WINDOW_SEC,
+                 min_interval: float = C2D_MIN_INTERVAL_SEC, workers: int = C2D_WORKERS,
+                 queue_max: int = C2D_QUEUE_MAX, max_retries: int = C2D_MAX_RETRIES,
+                 backoff_base: float = C2D_BACKOFF_BASE_SEC, device_backoff: float = C2D_DEVICE_BACKOFF_SEC,
+                 max_devices: int = C2D_MAX_DEVICES):
+        self.registry_manager_factory = registry_manager_factory
+        self.dedup_window = dedup_window
+        self.min_interval = min_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.device_backoff = device_backoff
+        self.max_devices = max_devices
+        self.queue_max = queue_max
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._devices = OrderedDict()  # vehicle_id -> _DeviceState, ordinato per ultimo uso
+        self._lock = threading.Lock()
+        self._threads = []
+        self._paused_until = 0.0       # pausa globale dopo un 429
+        self.counts = {
+            "submitted": 0, "queued": 0, "duplicate": 0, "rate_limited": 0, "device_blocked": 0,
+            "queue_full": 0, "sent": 0, "retries": 0, "throttled": 0, "device_queue_full": 0, "failed": 0,
+            "direct": 0, "wait_timeout": 0,
+        }
+        self.depth_by_priority = [0] * len(PRIORITIES)
+        self.max_depth = 0
+        self.in_flight = 0
+
+    # --- Ammissione ---
+
+    def _device(self, vehicle_id: str) -> _DeviceState:
+        state = self._devices.get(vehicle_id)
+        if state is None:
+            state = self._devices[vehicle_id] = _DeviceState()
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        self._devices.move_to_end(vehicle_id)
+        return state
+
+    def _admit(self, vehicle_id: str, advice: str, alert_level: str, now: float) -> str:
+        state = self._device(vehicle_id)
+        if now < state.blocked_until:
+            return "device_blocked"
+        if (advice == state.advice and alert_level == state.alert_level
+                and now - state.sent_at < self.dedup_window):
+            return "duplicate"
+        if alert_level != "CRITICAL" and now - state.sent_at < self.min_interval:
+            return "rate_limited"
+        state.advice, state.alert_level, state.sent_at = advice, alert_level, now
+        return "queued"
+
+    def submit(self, vehicle_id: str, advice: str, alert_level: str, pending: Optional[list] = None) -> str:
+        """Invia o accoda un messaggio C2D. Restituisce l'esito: direct (CRITICAL, consegnato in modo
+        sincrono), queued, duplicate, rate_limited, device_blocked o queue_full (coda oltre queue_max).
+        Se `pending` è una lista, vi aggiunge un evento per ogni messaggio accodato (vedi wait())."""
+        now = time.monotonic()
+        priority = PRIORITIES.get(alert_level, len(PRIORITIES) - 1)
+        with self._lock:
+            self.counts["submitted"] += 1
+            outcome = self._admit(vehicle_id, advice, alert_level, now)
+            # Un alert critico non passa dalla coda: non viene mai scartato né perso con l'host
+            if outcome == "queued" and alert_level == "CRITICAL":
+                outcome = "direct"
+                self.in_flight += 1
+            elif outcome == "queued" and self._queue.qsize() >= self.queue_max:
+                self._forget_send(vehicle_id, advice, alert_level)
+                outcome = "queue_full"
+            if outcome == "queued":
+                done = threading.Event()
+                self._queue.put_nowait((priority, next(self._sequence), vehicle_id, advice, alert_level, done))
+                self.depth_by_priority[priority] += 1
+                self.max_depth = max(self.max_depth, self._queue.qsize())
+                if pending is not None:
+                    pending.append(done)
+            self.counts[outcome] += 1
+        get_instrumentation().incr(f"c2d.{outcome}")
+        if outcome == "direct":
+            try:
+                self._deliver(vehicle_id, advice, alert_level)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+        elif outcome == "queued":
+            self._ensure_workers()
+        elif outcome == "queue_full":
+            logger.warning(f"⚠️ C2D queue full, dropping [{alert_level}] message for {vehicle_id}")
+        return outcome
+
+    def wait(self, pending: list, timeout: Optional[float] = C2D_WAIT_SEC) -> bool:
+        """Attende la consegna (riuscita o fallita) dei messaggi in `pending`, al più `timeout` secondi.
+        Da chiamare prima che l'invocazione termini. False se qualche messaggio è ancora in coda."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for done in pending:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            if not done.wait(remaining):
+                left = sum(1 for event in pending if not event.is_set())
+                with self._lock:
+                    self.counts["wait_timeout"] += 1
+                logger.warning(f"⚠️ {left} C2D messages not delivered after {timeout}s, invocation ends without them")
+                return False
+        return True
+
+    def _forget_send(self, vehicle_id: str, advice: str, alert_level: str):
+        # Un invio non riuscito non deve sopprimere il prossimo messaggio uguale
+        state = self._devices.get(vehicle_id)
+        if state is not None and state.advice == advice and state.alert_level == alert_level:
+            state.advice = state.alert_level = None
+            state.sent_at = float("-inf")
+
+    # --- Worker ---
+
+    def _ensure_workers(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"c2d-worker-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            priority, _, vehicle_id, advice, alert_level, done = self._queue.get()
+            with self._lock:
+                self.depth_by_priority[priority] -= 1
+                self.in_flight += 1
+            try:
+                self._deliver(vehicle_id, advice, alert_level)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                done.set()
+                self._queue.task_done()
+
+    def _deliver(self, vehicle_id: str, advice: str, alert_level: str):
+        metrics = get_instrumentation()
+        registry_manager = self.registry_manager_factory()
+        if registry_manager is None:
+            return
+        for attempt in range(self.max_retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            try:
+                with metrics.timer("advice.c2d"):
+                    registry_manager.send_c2d_message(vehicle_id, advice, properties={"alert_level": alert_level})
+                with self._lock:
+                    self.counts["sent"] += 1
+                logger.info(f"📤 C2D [{alert_level}] -> {vehicle_id}: {advice}")
+                return
+            except Exception as e:
+                kind = classify_error(e)
+                delay = self.backoff_base * 2 ** attempt * (1 + random.random())
+                with self._lock:
+                    if kind == "throttled":
+                        self.counts["throttled"] += 1
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                    elif kind == "queue_full":
+                        # La coda C2D del device è piena: inutile insistere, si sospende il device
+                        self.counts["device_queue_full"] += 1
+                        self._device(vehicle_id).blocked_until = time.monotonic() + self.device_backoff
+                    if kind in ("queue_full", "permanent") or attempt == self.max_retries:
+                        self.counts["failed"] += 1
+                        self._forget_send(vehicle_id, advice, alert_level)
+                    else:
+                        self.counts["retries"] += 1
+                if kind in ("queue_full", "permanent") or attempt == self.max_retries:
+                    metrics.incr("advice.c2d_errors")
+                    logger.error(f"❌ Failed to send C2D to {vehicle_id} ({kind}): {e}")
+                    return
+                logger.warning(f"⚠️ C2D to {vehicle_id} failed ({kind}), retry in {delay:.2f}s")
+                if kind != "throttled":
+                    time.sleep(delay)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Attende lo svuotamento della coda (test, benchmark, shutdown). True se svuotata."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def forget(self, vehicle_id: str):
+        """Rimuove lo stato di dedup/rate limit di un veicolo (es. dopo la cancellazione dei suoi dati)."""
+        with self._lock:
+            self._devices.pop(vehicle_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._devices.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self.counts,
+                "queue_depth": self._queue.qsize(),
+                "queue_depth_by_priority": dict(zip(PRIORITIES, self.depth_by_priority)),
+                "max_queue_depth": self.max_depth,
+                "in_flight": self.in_flight,
+                "workers": len(self._threads),
+                "tracked_devices": len(self._devices),
+                "paused": self._paused_until > time.monotonic(),
+            }
+
+
+# --- Singleton ---
+
+_dispatcher = None
+_init_lock = threading.Lock()
+
+def get_c2d_dispatcher() -> Optional[C2DDispatcher]:
+    """Lazy singleton: None se il dispatcher è disabilitato via C2D_DISPATCHER_ENABLED (invio sincrono)."""
+    global _dispatcher
+    if _dispatcher is None and C2D_DISPATCHER_ENABLED:
+        with _init_lock:
+            if _dispatcher is None:
+                _dispatcher = C2DDispatcher(get_iot_registry_manager)
+                logger.info(f"✅ C2D dispatcher initialized ({C2D_WORKERS} workers, queue {C2D_QUEUE_MAX}, "
+                            f"dedup {C2D_DEDUP_WINDOW_SEC}s, min interval {C2D_MIN_INTERVAL_SEC}s)")
+    return _dispatcher
@@ -0,0 +1,226 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from shared.instrumentation import get_instrumentation
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+PREWARM_ENABLED = os.environ.get("CLIENT_PREWARM_ENABLED", "true").lower() == "true"
+# Client precaricati all'avvio dell'host, nell'ordine indicato
+PREWARM_CLIENTS = tuple(c.strip() for c in os.environ.get(
+    "CLIENT_PREWARM_CLIENTS", "credential,cosmos,vehicle_registry,iot_hub,advice_queue,rules,llm").split(",") if c.strip())
+PREWARM_DELAY_SEC = float(os.environ.get("CLIENT_PREWARM_DELAY_SEC", "0"))   # attesa prima del pre-warm
+
+# Risorse raggiunte via Managed Identity: (setting con l'endpoint, scope del token o None = dall'endpoint)
+MANAGED_IDENTITY_RESOURCES = (
+    ("CosmosDBConnectionString__accountEndpoint", None),
+    ("IotHubHostName", "https://iothubs.azure.net/.default"),
+    ("AzureStorageQueueConnectionString__queueServiceUri", "https://storage.azure.com/.default"),
+)
+
+
+# --- Credenziale condivisa ---
+
+_credential = None
+_credential_lock = threading.Lock()
+
+def get_credential():
+    """Lazy singleton: una sola DefaultAzureCredential per processo, condivisa da Cosmos, IoT Hub e Storage
+    (la catena di credenziali viene risolta una volta e la cache dei token è comune)."""
+    global _credential
+    if _credential is None:
+        with _credential_lock:
+            if _credential is None:
+                from azure.identity import DefaultAzureCredential
+                _credential = DefaultAzureCredential()
+    return _credential
+
+
+def _token_scopes():
+    scopes = []
+    for setting, scope in MANAGED_IDENTITY_RESOURCES:
+        endpoint = os.environ.get(setting)
+        if endpoint:
+            scopes.append(scope or f"{endpoint.rstrip('/')}/.default")
+    return scopes
+
+
+# --- Registro ---
+
+class ClientRegistry:
+    """Registro dei client SDK condivisi. Ogni voce è una factory idempotente (i lazy singleton di shared/):
+    get() la invoca e ne misura la prima inizializzazione, prewarm() le esegue in un thread in background
+    all'avvio dell'host così import pesanti, risoluzione della credenziale e primi round-trip non pesano
+    sulla prima invocazione. Una richiesta che arriva durante il pre-warm attende sul lock del singleton."""
+
+    def __init__(self):
+        self._factories = {}   # nome -> factory
+        self._status = {}      # nome -> {"state", "init_ms", "error"}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._done = threading.Event()
+        self.prewarm_ms = None
+
+    def register(self, name: str, factory: Callable[[], object]):
+        with self._lock:
+            self._factories[name] = factory
+            self._status.setdefault(name, {"state": "pending", "init_ms": None, "error": None})
+
+    def names(self):
+        with self._lock:
+            return list(self._factories)
+
+    def get(self, name: str):
+        """Client della voce `name` (None se la risorsa non è configurata)."""
+        with self._lock:
+            factory = self._factories[name]
+            status = self._status[name]
+        if status["state"] != "pending":
+            return factory()
+        start = time.perf_counter()
+        try:
+            client = factory()
+        except Exception as e:
+            with self._lock:
+                status.update(state="failed", error=str(e))
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        with self._lock:
+            if status["state"] == "pending":
+                status.update(state="ready" if client is not None else "unavailable", init_ms=round(elapsed_ms, 1))
+                get_instrumentation().observe(f"startup.client.{name}", elapsed_ms)
+        return client
+
+    def warm(self, names: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        """Inizializza le voci indicate (tutte se None) nel thread corrente; un errore non blocca le altre."""
+        start = time.perf_counter()
+        for name in names or self.names():
+            if name not in self._factories:
+                logger.warning(f"⚠️ Unknown client in CLIENT_PREWARM_CLIENTS: {name}")
+                continue
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning(f"⚠️ Pre-warm of {name} failed: {e}")
+        self.prewarm_ms = round((time.perf_counter() - start) * 1000.0, 1)
+        self._done.set()
+        return {name: status["state"] for name, status in self.stats()["clients"].items()}
+
+    def prewarm(self, names: Optional[Iterable[str]] = None, delay: float = PREWARM_DELAY_SEC) -> threading.Thread:
+        """Avvia warm() in un thread daemon (una sola volta per processo)."""
+        names = tuple(names or PREWARM_CLIENTS)
+
+        def run():
+            if delay > 0:
+                time.sleep(delay)
+            states = self.warm(names)
+            logger.info(f"🔥 Clients pre-warmed in {self.prewarm_ms:.0f} ms: "
+                        + ", ".join(f"{name}={state}" for name, state in states.items()))
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=run, name="client-prewarm", daemon=True)
+                self._thread.start()
+            return self._thread
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Attende la fine del pre-warm (True se completato)."""
+        return self._done.wait(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "prewarm_started": self._thread is not None,
+                "prewarm_done": self._done.is_set(),
+                "prewarm_ms": self.prewarm_ms,
+                "clients": {name: dict(status) for name, status in self._status.items()},
+            }
+
+
+# --- Factory di default (import differiti: il modulo resta leggero) ---
+
+def _warm_credential():
+    """Risolve la catena della credenziale e mette in cache i token delle risorse configurate."""
+    scopes = _token_scopes()
+    if not scopes:
+        return None
+    credential = get_credential()
+    for scope in scopes:
+        credential.get_token(scope)
+    return credential
+
+
+def _warm_cosmos():
+    from shared.cosmos_client import get_cosmos_container
+    container = get_cosmos_container()
+    if container is not None:
+        # Il client aio è legato all'event loop: qui se ne precarica solo il modulo
+        import azure.cosmos.aio  # noqa: F401
+    return container
+
+
+def _warm_vehicle_registry():
+    from shared.vehicle_registry import get_vehicle_registry
+    return get_vehicle_registry()
+
+
+def _warm_iot_hub():
+    from shared.iot_hub import get_iot_registry_manager
+    return get_iot_registry_manager()
+
+
+def _warm_advice_queue():
+    from shared.advice_queue import get_advice_queue_client
+    return get_advice_queue_client()
+
+
+def _warm_rules():
+    from shared.rule_engine import get_rule_engine
+    return get_rule_engine()
+
+
+def _warm_llm():
+    from shared.ai_advisor import _get_structured_batch_llm, _get_structured_llm
+    _get_structured_batch_llm()
+    return _get_structured_llm()
+
+
+DEFAULT_CLIENTS = {
+    "credential": _warm_credential,
+    "cosmos": _warm_cosmos,
+    "vehicle_registry": _warm_vehicle_registry,
+    "iot_hub": _warm_iot_hub,
+    "advice_queue": _warm_advice_queue,
+    "rules": _warm_rules,
+    "llm": _warm_llm,
+}
+
+
+# --- Singleton ---
+
+_registry = None
+_init_lock = threading.Lock()
+
+def get_client_registry() -> ClientRegistry:
+    """Lazy singleton con le factory di default registrate."""
+    global _registry
+    if _registry is None:
+        with _init_lock:
+            if _registry is None:
+                registry = ClientRegistry()
+                for name, factory in DEFAULT_CLIENTS.items():
+                    registry.register(name, factory)
+                _registry = registry
+    return _registry
+
+
+def prewarm_clients() -> Optional[threading.Thread]:
+    """Pre-warm in background all'avvio dell'host (no-op con CLIENT_PREWARM_ENABLED=false)."""
+    if not PREWARM_ENABLED:
+        return None
+    return get_client_registry().prewarm()
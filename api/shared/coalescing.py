@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+COALESCING_ENABLED = os.environ.get("ADVICE_COALESCING_ENABLED", "true").lower() == "true"
+REGISTRY_MAX_VEHICLES = int(os.environ.get("ADVICE_COALESCING_MAX_VEHICLES", "10000"))
+
+
+# --- Registry "ultima sequenza" per veicolo ---
+
+class InMemorySequenceRegistry:
+    """Registry in-process dell'ultima richiesta advice accodata per ogni veicolo.
+    Le sequenze sono timestamp in ns resi monotoni per veicolo. Lo stato è per processo: il coalescing
+    funziona solo se la richiesta viene consumata dall'istanza che l'ha accodata. Con lo scale-out un consumer
+    su un'altra istanza non vede l'ultima sequenza del producer e non scarta nulla (nessun errore, solo
+    nessun risparmio); le richieste vengono comunque deduplicate all'interno di un batch drenato."""
+
+    def __init__(self, max_vehicles: int = REGISTRY_MAX_VEHICLES):
+        self.max_vehicles = max_vehicles
+        self._latest = OrderedDict()  # vehicle_id -> ultima sequenza
+        self._lock = threading.Lock()
+        self.registered = 0
+        self.processed = 0
+        self.coalesced = 0
+
+    def next_sequence(self, vehicle_id: str) -> int:
+        """Assegna la sequenza alla nuova richiesta e la registra come ultima per il veicolo."""
+        with self._lock:
+            seq = max(time.time_ns(), self._latest.get(vehicle_id, 0) + 1)
+            self._latest[vehicle_id] = seq
+            self._latest.move_to_end(vehicle_id)
+            if len(self._latest) > self.max_vehicles:
+                self._latest.popitem(last=False)  # veicolo inattivo da più tempo
+            self.registered += 1
+            return seq
+
+    def latest(self, vehicle_id: str) -> Optional[int]:
+        with self._lock:
+            return self._latest.get(vehicle_id)
+
+    def is_superseded(self, vehicle_id: str, seq: Optional[int]) -> bool:
+        """True se per il veicolo è già stata accodata una richiesta più recente."""
+        if vehicle_id is None or seq is None:
+            return False
+        latest = self.latest(vehicle_id)
+        return latest is not None and latest > seq
+
+    def record(self, processed: int = 0, coalesced: int = 0):
+        with self._lock:
+            self.processed += processed
+            self.coalesced += coalesced
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.processed + self.coalesced
+            return {
+                "tracked_vehicles": len(self._latest),
+                "registered": self.registered,
+                "processed": self.processed,
+                "coalesced": self.coalesced,
+                "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+            }
+
+
+def coalesce_requests(requests: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """Tiene solo la richiesta più recente (per coalesce_seq, altrimenti per ordine di arrivo) di ogni veicolo.
+    Restituisce (da_elaborare, superate)."""
+    latest = {}
+    superseded = []
+    for index, request in enumerate(requests):
+        key = request.get("vehicle_id") or f"__anon_{index}"
+        current = latest.get(key)
+        if current is None:
+            latest[key] = request
+        elif request.get("coalesce_seq", 0) >= current.get("coalesce_seq", 0):
+            superseded.append(current)
+            latest[key] = request
+        else:
+            superseded.append(request)
+    return list(latest.values()), superseded
+
+
+# --- Singleton ---
+
+_registry = None
+
+def get_sequence_registry() -> Optional[InMemorySequenceRegistry]:
+    """Lazy singleton: None se il coalescing è disabilitato via ADVICE_COALESCING_ENABLED."""
+    global _registry
+    if _registry is None and COALESCING_ENABLED:
+        _registry = InMemorySequenceRegistry()
+        logger.info(f"✅ Advice coalescing registry initialized (max {REGISTRY_MAX_VEHICLES} vehicles)")
+    return _registry
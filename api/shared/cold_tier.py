@@ -0,0 +1,456 @@
+"""Tiering della telemetria: container Telemetry "hot" con TTL per documento e archivio "cold" in Parquet.
+
+ArchiveTelemetry (timer) copia nell'archivio i documenti più vecchi di COLD_TIER_ARCHIVE_AFTER_SEC, prima che
+il TTL (TELEMETRY_HOT_TTL_SEC) li rimuova da Cosmos. L'archivio è partizionato stile Hive per veicolo e giorno
+(ora del device), leggibile anche da pyarrow.dataset / Spark / DuckDB:
+
+    <COLD_TIER_URL>/vehicle_id=Bus-01/date=2026-10-17/part-20261017T001500Z-1a2b3c4d-0000.parquet
+    <COLD_TIER_URL>/_checkpoint.json      (watermark su processed_at dell'ultimo export)
+
+COLD_TIER_URL è una cartella locale o un container Blob (https://<account>.blob.core.windows.net/<container>[/prefisso],
+via Managed Identity). pyarrow e azure-storage-blob sono importati al primo export/lettura."""
+
+import datetime
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import List, Optional
+from urllib.parse import quote, urlparse
+
+from shared.client_registry import get_credential
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+HOT_TTL_SEC = int(os.environ.get("TELEMETRY_HOT_TTL_SEC", "0"))            # 0 = nessun TTL sui documenti
+COLD_TIER_URL = os.environ.get("COLD_TIER_URL", "")                          # vuoto = archivio disabilitato
+# Età oltre cui un documento viene archiviato: deve lasciare un margine prima della scadenza del TTL
+COLD_TIER_ARCHIVE_AFTER_SEC = float(os.environ.get(
+    "COLD_TIER_ARCHIVE_AFTER_SEC", str(max(HOT_TTL_SEC - 86400, HOT_TTL_SEC // 2) if HOT_TTL_SEC else 86400)))
+COLD_TIER_PAGE_SIZE = int(os.environ.get("COLD_TIER_PAGE_SIZE", "1000"))          # documenti per pagina di query
+COLD_TIER_FLUSH_ROWS = int(os.environ.get("COLD_TIER_FLUSH_ROWS", "50000"))       # righe in memoria prima di scrivere
+COLD_TIER_MAX_ROWS_PER_RUN = int(os.environ.get("COLD_TIER_MAX_ROWS_PER_RUN", "1000000"))
+COLD_TIER_COMPRESSION = os.environ.get("COLD_TIER_COMPRESSION", "zstd")
+COLD_TIER_MAX_READ_DAYS = float(os.environ.get("COLD_TIER_MAX_READ_DAYS", "7"))    # finestra massima di /archive
+COLD_TIER_COMPACT_MIN_FILES = int(os.environ.get("COLD_TIER_COMPACT_MIN_FILES", "4"))  # file per partizione oltre cui compattare
+
+CHECKPOINT_PATH = "_checkpoint.json"
+
+# Colonne dell'archivio: (campo, tipo Arrow). timestamp/processed_at diventano timestamp UTC nativi
+ARCHIVE_COLUMNS = (
+    ("id", "string"), ("vehicle_id", "string"), ("timestamp", "timestamp"), ("speed", "float64"),
+    ("rpm", "float64"), ("fuel_level", "float64"), ("ai_advice", "string"), ("alert_level", "string"),
+    ("processed_at", "timestamp"), ("seq", "int64"), ("boot_id", "string"), ("late", "bool"),
+)
+TIMESTAMP_COLUMNS = {name for name, kind in ARCHIVE_COLUMNS if kind == "timestamp"}
+
+
+def _parse_iso(value) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return parsed.replace(tzinfo=datetime.timezone.utc) if parsed.tzinfo is None else parsed
+
+
+def _iso(epoch: float) -> str:
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat()
+
+
+def hot_window_start(now: Optional[float] = None) -> Optional[str]:
+    """Istante (ISO) prima del quale lo storico può trovarsi solo nell'archivio; None senza TTL."""
+    if HOT_TTL_SEC <= 0:
+        return None
+    return _iso((now or time.time()) - HOT_TTL_SEC)
+
+
+def partition_path(vehicle_id: str, day: str) -> str:
+    return f"vehicle_id={quote(vehicle_id, safe='')}/date={day}/"
+
+
+def read_window(date_from: Optional[str], date_to: Optional[str], now: Optional[float] = None,
+                max_days: float = COLD_TIER_MAX_READ_DAYS) -> tuple:
+    """Intervallo [from, to) di una lettura dell'archivio, limitato a max_days giorni: senza `to` fino
+    all'inizio della finestra hot (o a ora), senza `from` i max_days giorni precedenti. ValueError se più ampio."""
+    end = _parse_iso(date_to) or _parse_iso(hot_window_start(now)) or _parse_iso(_iso(now or time.time()))
+    start = _parse_iso(date_from) or end - datetime.timedelta(days=max_days)
+    if end - start > datetime.timedelta(days=max_days):
+        raise ValueError(f"l'intervallo from/to dell'archivio non può superare {max_days:g} giorni")
+    return start.isoformat(), end.isoformat()
+
+
+# --- Storage: cartella locale o container Blob ---
+
+class LocalStore:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _full(self, path):
+        return os.path.join(self.root, *path.split("/"))
+
+    def write(self, path: str, data: bytes):
+        full = self._full(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f"{full}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, full)  # i lettori non vedono mai file parziali
+
+    def read(self, path: str) -> Optional[bytes]:
+        try:
+            with open(self._full(path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def open(self, path: str):
+        return open(self._full(path), "rb")
+
+    def list(self, prefix: str = "") -> List[str]:
+        base = self._full(prefix) if prefix else self.root
+        paths = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    paths.append(os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/"))
+        return sorted(paths)
+
+    def delete(self, paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(self._full(path))
+            except FileNotFoundError:
+                pass
+
+
+class BlobStore:
+    """Container Azure Blob (Managed Identity, credenziale condivisa)."""
+
+    DELETE_BATCH = 256  # limite di delete_blobs per chiamata
+
+    def __init__(self, url: str):
+        from azure.storage.blob import ContainerClient
+        parsed = urlparse(url)
+        container, _, prefix = parsed.path.lstrip("/").partition("/")
+        self.client = ContainerClient(f"{parsed.scheme}://{parsed.netloc}", container, credential=get_credential())
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+
+    def write(self, path: str, data: bytes):
+        self.client.upload_blob(self.prefix + path, data, overwrite=True)
+
+    def read(self, path: str) -> Optional[bytes]:
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            return self.client.download_blob(self.prefix + path).readall()
+        except ResourceNotFoundError:
+            return None
+
+    def open(self, path: str):
+        return io.BytesIO(self.client.download_blob(self.prefix + path).readall())
+
+    def list(self, prefix: str = "") -> List[str]:
+        start = len(self.prefix)
+        return sorted(blob.name[start:] for blob in self.client.list_blobs(name_starts_with=self.prefix + prefix))
+
+    def delete(self, paths: List[str]):
+        for i in range(0, len(paths), self.DELETE_BATCH):
+            self.client.delete_blobs(*(self.prefix + path for path in paths[i:i + self.DELETE_BATCH]))
+
+
+def open_store(url: str):
+    return BlobStore(url) if url.startswith(("https://", "http://")) else LocalStore(url)
+
+
+# --- Conversione documenti <-> Arrow ---
+
+def _coerce(kind, value):
+    if value is None or value == "":
+        return None if kind != "string" else value
+    if kind == "timestamp":
+        return _parse_iso(value)
+    if kind == "float64":
+        return float(value)
+    if kind == "int64":
+        return int(value)
+    if kind == "bool":
+        return bool(value)
+    return str(value)
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    types = {"string": pa.string(), "float64": pa.float64(), "int64": pa.int64(), "bool": pa.bool_(),
+             "timestamp": pa.timestamp("us", tz="UTC")}
+    return pa.schema([(name, types[kind]) for name, kind in ARCHIVE_COLUMNS])
+
+
+def _to_parquet(docs: List[dict]) -> bytes:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = {name: [_coerce(kind, doc.get(name)) for doc in docs] for name, kind in ARCHIVE_COLUMNS}
+    table = pa.Table.from_pydict(columns, schema=_arrow_schema())
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression=COLD_TIER_COMPRESSION)
+    return sink.getvalue().to_pybytes()
+
+
+def _from_arrow(row: dict) -> dict:
+    """Riga Arrow -> documento come quelli di /history (timestamp ISO, rpm intero)."""
+    doc = {}
+    for name, value in row.items():
+        if value is None:
+            continue
+        if name in TIMESTAMP_COLUMNS:
+            value = value.isoformat()
+        elif name == "rpm" and float(value).is_integer():
+            value = int(value)
+        doc[name] = value
+    return doc
+
+
+# --- Archivio ---
+
+class ColdTier:
+    """Export incrementale (watermark su processed_at) e lettura dello storico archiviato."""
+
+    def __init__(self, store):
+        self.store = store
+        self._export_lock = threading.Lock()  # un solo export per volta nel worker
+        self._lock = threading.Lock()         # contatori
+        self.exported_rows = 0
+        self.files_written = 0
+        self.exports = 0
+        self.reads = 0
+        self.files_read = 0
+        self.compactions = 0
+        self.files_compacted = 0
+        self.last_export = None
+        self._ttl_checked = False
+
+    # --- Checkpoint ---
+
+    def checkpoint(self) -> dict:
+        data = self.store.read(CHECKPOINT_PATH)
+        return json.loads(data) if data else {}
+
+    def _save_checkpoint(self, watermark, **extra):
+        self.store.write(CHECKPOINT_PATH, json.dumps({"watermark": watermark, **extra}).encode("utf-8"))
+
+    # --- Export ---
+
+    def _check_container_ttl(self, container):
+        """Il TTL per documento ha effetto solo se il container ha il TTL abilitato (defaultTtl, anche -1)."""
+        if self._ttl_checked or HOT_TTL_SEC <= 0:
+            return
+        self._ttl_checked = True
+        try:
+            if container.read().get("defaultTtl") is None:
+                logger.warning("⚠️ TELEMETRY_HOT_TTL_SEC is set but TTL is disabled on the Telemetry container "
+                               "(set defaultTtl, e.g. -1): documents will not expire")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read Telemetry container TTL settings: {e}")
+
+    def _flush(self, buffers: dict, run: str, part: int) -> int:
+        for (vehicle_id, day), docs in buffers.items():
+            self.store.write(f"{partition_path(vehicle_id, day)}part-{run}-{part:04d}.parquet", _to_parquet(docs))
+        return len(buffers)
+
+    def export(self, container, now: Optional[float] = None, max_rows: int = COLD_TIER_MAX_ROWS_PER_RUN) -> dict:
+        """Copia nell'archivio i documenti con processed_at in [watermark, now - COLD_TIER_ARCHIVE_AFTER_SEC),
+        un file per veicolo e giorno a ogni flush. Il watermark avanza a ogni flush: un export interrotto
+        riprende da lì (le righe ripetute hanno lo stesso id e vengono scartate in lettura)."""
+        with self._export_lock:
+            self._check_container_ttl(container)
+            now = now or time.time()
+            # Nome univoco per export: due run non sovrascrivono mai i rispettivi file
+            run = f"{datetime.datetime.fromtimestamp(now, datetime.timezone.utc):%Y%m%dT%H%M%SZ}-{uuid.uuid4().hex[:8]}"
+            since = self.checkpoint().get("watermark")
+            cutoff = _iso(now - COLD_TIER_ARCHIVE_AFTER_SEC)
+
+            conditions = ["c.processed_at < @cutoff"]
+            params = [{"name": "@cutoff", "value": cutoff}]
+            if since:
+                conditions.append("c.processed_at >= @since")
+                params.append({"name": "@since", "value": since})
+            # L'iterazione segue le pagine di query (COLD_TIER_PAGE_SIZE): in memoria solo il buffer corrente
+            docs = container.query_items(
+                query=f"SELECT * FROM c WHERE {' AND '.join(conditions)} ORDER BY c.processed_at ASC",
+                parameters=params, enable_cross_partition_query=True, max_item_count=COLD_TIER_PAGE_SIZE,
+            )
+
+            start = time.perf_counter()
+            buffers, buffered, rows, files, part, watermark = {}, 0, 0, 0, 0, since
+            complete = True
+            for doc in docs:
+                if rows >= max_rows:
+                    complete = False
+                    break
+                measured = _parse_iso(doc.get("timestamp")) or _parse_iso(doc.get("processed_at"))
+                key = (doc.get("vehicle_id") or "unknown", measured.astimezone(datetime.timezone.utc).date().isoformat())
+                buffers.setdefault(key, []).append(doc)
+                buffered += 1
+                rows += 1
+                watermark = doc.get("processed_at") or watermark
+                if buffered >= COLD_TIER_FLUSH_ROWS:
+                    files += self._flush(buffers, run, part)
+                    self._save_checkpoint(watermark, updated_at=_iso(time.time()))
+                    buffers, buffered, part = {}, 0, part + 1
+            if buffers:
+                files += self._flush(buffers, run, part)
+            # Intervallo esaurito: il prossimo export parte dal cutoff, senza rileggere i documenti al confine
+            watermark = cutoff if complete else watermark
+            if watermark != since:
+                self._save_checkpoint(watermark, updated_at=_iso(time.time()))
+
+            result = {"rows": rows, "files": files, "watermark": watermark, "complete": complete,
+                      "elapsed_ms": round((time.perf_counter() - start) * 1000.0, 1)}
+            with self._lock:
+                self.exports += 1
+                self.exported_rows += rows
+                self.files_written += files
+                self.last_export = {"at": _iso(now), **result}
+            return result
+
+    # --- Lettura ---
+
+    def _partitions(self, prefix: str) -> dict:
+        """File Parquet per partizione: {(percorso della partizione, giorno): [file in ordine di scrittura]}."""
+        partitions = {}
+        for path in self.store.list(prefix):
+            if not path.endswith(".parquet"):
+                continue
+            directory, _, _ = path.rpartition("/")
+            day = directory.rpartition("/")[2].partition("=")[2]
+            partitions.setdefault((directory + "/", day), []).append(path)
+        return partitions
+
+    def _read_partition(self, paths: List[str], columns: Optional[List[str]] = None):
+        """Tabella di una partizione senza id ripetuti (export ripresi): vale la copia del file più recente."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        tables = []
+        for path in paths:
+            with self.store.open(path) as f:
+                tables.append(pq.read_table(f, columns=columns))
+        table = pa.concat_tables(tables)
+        if len(tables) == 1:
+            return table
+        table = table.append_column("_row", pa.array(range(table.num_rows), pa.int64()))
+        last = table.group_by("id", use_threads=False).aggregate([("_row", "max")])["_row_max"]
+        return table.take(last).drop_columns(["_row"])
+
+    def read_history(self, vehicle_id: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                     fields: Optional[List[str]] = None, limit: Optional[int] = None) -> List[dict]:
+        """Storico archiviato del veicolo in [date_from, date_to) (ISO), più recente prima.
+        Legge le partizioni dei giorni dell'intervallo dalla più recente, solo le colonne richieste, e si
+        ferma quando ha `limit` righe: filtro, ordinamento e limite restano in Arrow."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        start, end = _parse_iso(date_from), _parse_iso(date_to)
+        first_day = start.astimezone(datetime.timezone.utc).date().isoformat() if start else None
+        last_day = end.astimezone(datetime.timezone.utc).date().isoformat() if end else None
+        columns = list(dict.fromkeys(["id", "timestamp"] + list(fields or [name for name, _ in ARCHIVE_COLUMNS])))
+
+        # Le partizioni sono per giorno del timestamp: dalla più recente, ogni giorno precede i successivi
+        partitions = sorted(((day, paths) for (_, day), paths in self._partitions(f"vehicle_id={quote(vehicle_id, safe='')}/").items()
+                             if not (first_day and day < first_day) and not (last_day and day > last_day)), reverse=True)
+        tables, rows, files = [], 0, 0
+        for _, paths in partitions:
+            table = self._read_partition(paths, columns)
+            files += len(paths)
+            ts_type = table.schema.field("timestamp").type
+            if start:
+                table = table.filter(pc.greater_equal(table["timestamp"], pa.scalar(start, ts_type)))
+            if end:
+                table = table.filter(pc.less(table["timestamp"], pa.scalar(end, ts_type)))
+            tables.append(table)
+            rows += table.num_rows
+            if limit and rows >= limit:
+                break
+        with self._lock:
+            self.reads += 1
+            self.files_read += files
+        if not tables:
+            return []
+
+        table = pa.concat_tables(tables)
+        order = pc.sort_indices(table, sort_keys=[("timestamp", "descending")])
+        if limit:
+            order = order[:limit]
+        table = table.take(order)
+        if fields:
+            table = table.select([name for name in table.column_names if name in set(fields)])
+        return [_from_arrow(row) for row in table.to_pylist()]
+
+    # --- Compattazione ---
+
+    def compact(self, vehicle_id: Optional[str] = None, min_files: int = COLD_TIER_COMPACT_MIN_FILES,
+                today: Optional[str] = None) -> dict:
+        """Riscrive in un solo file (senza id ripetuti) le partizioni dei giorni chiusi con almeno
+        `min_files` file: ogni export ne aggiunge uno per veicolo e giorno. Il nuovo file viene scritto
+        prima di cancellare quelli letti; un export concorrente aggiunge file nuovi, che non vengono toccati."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        today = today or datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        run = f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%SZ}-{uuid.uuid4().hex[:8]}"
+        prefix = f"vehicle_id={quote(vehicle_id, safe='')}/" if vehicle_id else ""
+        partitions, removed = 0, 0
+        for (directory, day), paths in self._partitions(prefix).items():
+            if day >= today or len(paths) < max(2, min_files):
+                continue
+            table = self._read_partition(paths)
+            sink = pa.BufferOutputStream()
+            pq.write_table(table, sink, compression=COLD_TIER_COMPRESSION)
+            self.store.write(f"{directory}part-{run}-compacted.parquet", sink.getvalue().to_pybytes())
+            self.store.delete(paths)
+            partitions += 1
+            removed += len(paths)
+        with self._lock:
+            self.compactions += 1
+            self.files_compacted += removed
+        return {"partitions": partitions, "files_removed": removed}
+
+    # --- Manutenzione ---
+
+    def delete(self, vehicle_id: Optional[str] = None) -> int:
+        """Cancella l'archivio di un veicolo o, se None, tutti i file di dati. Restituisce i file rimossi."""
+        prefix = f"vehicle_id={quote(vehicle_id, safe='')}/" if vehicle_id else ""
+        paths = [path for path in self.store.list(prefix) if path != CHECKPOINT_PATH]
+        self.store.delete(paths)
+        return len(paths)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hot_ttl_sec": HOT_TTL_SEC,
+                "archive_after_sec": COLD_TIER_ARCHIVE_AFTER_SEC,
+                "exports": self.exports,
+                "exported_rows": self.exported_rows,
+                "files_written": self.files_written,
+                "reads": self.reads,
+                "files_read": self.files_read,
+                "compactions": self.compactions,
+                "files_compacted": self.files_compacted,
+                "last_export": dict(self.last_export) if self.last_export else None,
+            }
+
+
+# --- Singleton ---
+
+_cold_tier = None
+_init_lock = threading.Lock()
+
+def get_cold_tier() -> Optional[ColdTier]:
+    """Lazy singleton (None se COLD_TIER_URL non è configurato)."""
+    global _cold_tier
+    if _cold_tier is None and COLD_TIER_URL:
+        with _init_lock:
+            if _cold_tier is None:
+                _cold_tier = ColdTier(open_store(COLD_TIER_URL))
+                logger.info(f"✅ Cold tier ready ({COLD_TIER_URL}, archive after {COLD_TIER_ARCHIVE_AFTER_SEC:.0f}s)")
+    return _cold_tier
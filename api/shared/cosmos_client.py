@@ -1,36 +1,328 @@
+import asyncio
 import logging
 import os
+import threading
+from collections import Counter
 
-from azure.identity import DefaultAzureCredential
-from azure.cosmos import CosmosClient
+from shared.client_registry import get_credential
+from shared.local_backend import get_local_backend
+
+# Gli SDK azure.cosmos / azure.identity sono importati dentro le funzioni: il costo resta fuori
+# dall'indicizzazione delle Functions e viene pagato dal primo uso (o dal pre-warm in background)
 
 _cosmos_client = None
 _container = None
-_partition_key_field = None
+_partition_key_field = os.environ.get("COSMOS_PARTITION_KEY_FIELD") or None  # se noto, niente read() all'avvio
+_init_lock = threading.Lock()
 
 DATABASE_NAME = "EcoFleetDB"
 CONTAINER_NAME = "Telemetry"
 
+def _partition_key_from(props):
+    pk_paths = props.get("partitionKey", {}).get("paths", ["/id"])
+    return pk_paths[0].lstrip("/")  # es. "id" o "vehicle_id"
+
+
 def get_cosmos_container():
-    """Lazy singleton: crea il CosmosClient via Managed Identity."""
+    """Lazy singleton: crea il CosmosClient via Managed Identity (o il container locale con LOCAL_BACKEND)."""
     global _cosmos_client, _container, _partition_key_field
     if _container is None:
-        endpoint = os.environ.get("CosmosDBConnectionString__accountEndpoint")
-        if endpoint:
-            credential = DefaultAzureCredential()
-            _cosmos_client = CosmosClient(url=endpoint, credential=credential)
-            db = _cosmos_client.get_database_client(DATABASE_NAME)
-            _container = db.get_container_client(CONTAINER_NAME)
-
-            # Rileva partition key path
-            props = _container.read()
-            pk_paths = props.get("partitionKey", {}).get("paths", ["/id"])
-            _partition_key_field = pk_paths[0].lstrip("/")  # es. "id" o "vehicle_id"
-            logging.info(f"✅ CosmosClient initialized (PK field: {_partition_key_field})")
-        else:
-            logging.warning("⚠️ CosmosDBConnectionString__accountEndpoint not configured.")
+        with _init_lock:
+            if _container is not None:
+                return _container
+            local = get_local_backend()
+            if local is not None:
+                _container = local.container(CONTAINER_NAME, get_partition_key_field())
+                logging.info(f"🧪 Local Cosmos container {CONTAINER_NAME} (PK field: {get_partition_key_field()})")
+                return _container
+            endpoint = os.environ.get("CosmosDBConnectionString__accountEndpoint")
+            if endpoint:
+                from azure.cosmos import CosmosClient
+                client = CosmosClient(url=endpoint, credential=get_credential())
+                container = client.get_database_client(DATABASE_NAME).get_container_client(CONTAINER_NAME)
+
+                # Rileva partition key path (round-trip evitato con COSMOS_PARTITION_KEY_FIELD)
+                if _partition_key_field is None:
+                    _partition_key_field = _partition_key_from(container.read())
+                _check_sdk_support(container)
+                _cosmos_client, _container = client, container
+                logging.info(f"✅ CosmosClient initialized (PK field: {_partition_key_field})")
+            else:
+                logging.warning("⚠️ CosmosDBConnectionString__accountEndpoint not configured.")
     return _container
 
 def get_partition_key_field():
     """Restituisce il nome del campo usato come partition key."""
     return _partition_key_field or "id"
+
+
+# --- Container del registro veicoli (materializzato da ProcessTelemetry) ---
+
+VEHICLES_CONTAINER_NAME = "Vehicles"
+
+_vehicles_container = None
+
+def get_vehicles_container():
+    """Lazy singleton: container Vehicles (PK /id = vehicle_id), creato se non esiste."""
+    global _vehicles_container
+    local = get_local_backend()
+    if _vehicles_container is None and local is not None:
+        _vehicles_container = local.container(VEHICLES_CONTAINER_NAME, "id")
+    if _vehicles_container is None and get_cosmos_container() is not None:
+        from azure.cosmos import PartitionKey
+        with _init_lock:
+            if _vehicles_container is None:
+                db = _cosmos_client.get_database_client(DATABASE_NAME)
+                _vehicles_container = db.create_container_if_not_exists(
+                    id=VEHICLES_CONTAINER_NAME, partition_key=PartitionKey(path="/id")
+                )
+                logging.info(f"✅ Vehicles registry container ready ({VEHICLES_CONTAINER_NAME})")
+    return _vehicles_container
+
+
+# --- Container delle rollup (aggregati per veicolo e bucket temporale) ---
+
+ROLLUPS_CONTAINER_NAME = "Rollups"
+
+_rollups_container = None
+
+def get_rollups_container():
+    """Lazy singleton: container Rollups (PK /vehicle_id), creato se non esiste."""
+    global _rollups_container
+    local = get_local_backend()
+    if _rollups_container is None and local is not None:
+        _rollups_container = local.container(ROLLUPS_CONTAINER_NAME, "vehicle_id")
+    if _rollups_container is None and get_cosmos_container() is not None:
+        from azure.cosmos import PartitionKey
+        with _init_lock:
+            if _rollups_container is None:
+                db = _cosmos_client.get_database_client(DATABASE_NAME)
+                _rollups_container = db.create_container_if_not_exists(
+                    id=ROLLUPS_CONTAINER_NAME, partition_key=PartitionKey(path="/vehicle_id")
+                )
+                logging.info(f"✅ Rollups container ready ({ROLLUPS_CONTAINER_NAME})")
+    return _rollups_container
+
+
+# --- Container dei job amministrativi (stato e checkpoint delle cancellazioni bulk) ---
+
+JOBS_CONTAINER_NAME = "Jobs"
+
+_jobs_container = None
+
+def get_jobs_container():
+    """Lazy singleton: container Jobs (PK /id), creato se non esiste. Condiviso tra le istanze:
+    lo stato di un job è leggibile e riprendibile da qualsiasi worker."""
+    global _jobs_container
+    local = get_local_backend()
+    if _jobs_container is None and local is not None:
+        _jobs_container = local.container(JOBS_CONTAINER_NAME, "id")
+    if _jobs_container is None and get_cosmos_container() is not None:
+        from azure.cosmos import PartitionKey
+        with _init_lock:
+            if _jobs_container is None:
+                db = _cosmos_client.get_database_client(DATABASE_NAME)
+                _jobs_container = db.create_container_if_not_exists(
+                    id=JOBS_CONTAINER_NAME, partition_key=PartitionKey(path="/id")
+                )
+                logging.info(f"✅ Jobs container ready ({JOBS_CONTAINER_NAME})")
+    return _jobs_container
+
+
+# --- Client asincrono (azure.cosmos.aio) per la pipeline GenerateAdvice async ---
+
+_async_cosmos_client = None
+_async_credential = None
+_async_container = None
+_async_init_lock = None  # asyncio.Lock, creato sull'event loop del worker al primo uso
+
+async def get_async_cosmos_container():
+    """Lazy singleton asincrono: crea il CosmosClient aio via Managed Identity. Il lock evita che coroutine
+    concorrenti, in attesa della lettura delle proprietà del container, creino client duplicati."""
+    global _async_cosmos_client, _async_credential, _async_container, _async_init_lock, _partition_key_field
+    if _async_container is not None:
+        return _async_container
+    local = get_local_backend()
+    if local is not None:
+        _async_container = local.async_container(CONTAINER_NAME, get_partition_key_field())
+        return _async_container
+    if _async_init_lock is None:
+        _async_init_lock = asyncio.Lock()
+    async with _async_init_lock:
+        if _async_container is not None:
+            return _async_container
+        endpoint = os.environ.get("CosmosDBConnectionString__accountEndpoint")
+        if not endpoint:
+            logging.warning("⚠️ CosmosDBConnectionString__accountEndpoint not configured.")
+            return None
+        from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+        from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+        credential = AsyncDefaultAzureCredential()
+        client = AsyncCosmosClient(url=endpoint, credential=credential)
+        try:
+            container = client.get_database_client(DATABASE_NAME).get_container_client(CONTAINER_NAME)
+            if _partition_key_field is None:
+                _partition_key_field = _partition_key_from(await container.read())
+        except Exception:
+            await client.close()
+            await credential.close()
+            raise
+        _check_sdk_support(container)
+        _async_cosmos_client, _async_credential, _async_container = client, credential, container
+        logging.info(f"✅ Async CosmosClient initialized (PK field: {_partition_key_field})")
+    return _async_container
+
+
+async def close_async_cosmos_client():
+    """Chiude client aio e credenziale (sessioni HTTP aperte); il prossimo uso li ricrea."""
+    global _async_cosmos_client, _async_credential, _async_container
+    client, credential = _async_cosmos_client, _async_credential
+    _async_cosmos_client = _async_credential = _async_container = None
+    if client is not None:
+        await client.close()
+    if credential is not None:
+        await credential.close()
+
+
+# --- Aggiornamento advice: patch parziale (set) con precondizione ---
+
+# Precondizione: l'advice viene scritto solo se il documento non ne ha già uno (redelivery idempotenti).
+# Stringa vuota = patch incondizionata.
+ADVICE_PATCH_PRECONDITION = os.environ.get(
+    "ADVICE_PATCH_PRECONDITION", "FROM c WHERE NOT IS_DEFINED(c.ai_advice) OR c.ai_advice = ''"
+)
+MAX_BATCH_OPERATIONS = 100  # limite Cosmos per batch transazionale
+
+_patch_supported = True
+_batch_supported = True
+
+
+def _check_sdk_support(container):
+    """SDK senza patch_item/execute_item_batch (azure-cosmos < 4.4): il fallback viene deciso una volta,
+    all'inizializzazione del client, invece di interpretare un AttributeError qualsiasi a runtime."""
+    global _patch_supported, _batch_supported
+    if _patch_supported and not hasattr(container, "patch_item"):
+        _disable_patch("patch_item missing from the Cosmos SDK")
+    if _batch_supported and not hasattr(container, "execute_item_batch"):
+        _batch_supported = False
+        logging.warning("⚠️ Cosmos transactional batch not available in the SDK, advice updated per item")
+
+def advice_partition_key(doc_id, vehicle_id):
+    """Valore di partition key del documento telemetria (id o vehicle_id a seconda del container)."""
+    return doc_id if get_partition_key_field() == "id" else vehicle_id
+
+
+def _advice_operations(advice, alert_level):
+    return [
+        {"op": "set", "path": "/ai_advice", "value": advice},
+        {"op": "set", "path": "/alert_level", "value": alert_level},
+    ]
+
+
+def _patch_options():
+    return {"filter_predicate": ADVICE_PATCH_PRECONDITION} if ADVICE_PATCH_PRECONDITION else {}
+
+
+def _is_patch_unsupported(e):
+    """Patch non disponibile: account/emulatore che risponde 405/501 (l'SDK è verificato all'init)."""
+    from azure.cosmos.exceptions import CosmosHttpResponseError
+    return isinstance(e, CosmosHttpResponseError) and e.status_code in (405, 501)
+
+
+def _disable_patch(e):
+    global _patch_supported
+    _patch_supported = False
+    logging.warning(f"⚠️ Cosmos patch not supported, falling back to read+upsert: {e}")
+
+
+def _upsert_advice(container, doc_id, pk, advice, alert_level):
+    """Fallback read-modify-upsert, con la stessa precondizione della patch."""
+    existing = container.read_item(item=doc_id, partition_key=pk)
+    if ADVICE_PATCH_PRECONDITION and existing.get("ai_advice"):
+        return "skipped"
+    existing["ai_advice"] = advice
+    existing["alert_level"] = alert_level
+    container.upsert_item(existing)
+    return "upserted"
+
+
+def update_advice(container, doc_id, vehicle_id, advice, alert_level):
+    """Imposta ai_advice/alert_level con una sola patch_item. Restituisce "patched", "skipped"
+    (precondizione non soddisfatta) o "upserted" (fallback)."""
+    from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+    pk = advice_partition_key(doc_id, vehicle_id)
+    if _patch_supported:
+        try:
+            container.patch_item(item=doc_id, partition_key=pk,
+                                 patch_operations=_advice_operations(advice, alert_level), **_patch_options())
+            return "patched"
+        except CosmosAccessConditionFailedError:
+            return "skipped"
+        except Exception as e:
+            if not _is_patch_unsupported(e):
+                raise
+            _disable_patch(e)
+    return _upsert_advice(container, doc_id, pk, advice, alert_level)
+
+
+def update_advice_batch(container, updates):
+    """Aggiorna più documenti: quelli nella stessa partizione vanno in un batch transazionale di patch.
+    `updates` è una lista di (doc_id, vehicle_id, advice, alert_level). Restituisce i conteggi per esito."""
+    from azure.cosmos.exceptions import CosmosBatchOperationError
+    outcomes = Counter()
+    by_partition = {}
+    for update in updates:
+        by_partition.setdefault(advice_partition_key(update[0], update[1]), []).append(update)
+
+    for pk, group in by_partition.items():
+        for start in range(0, len(group), MAX_BATCH_OPERATIONS):
+            chunk = group[start:start + MAX_BATCH_OPERATIONS]
+            if len(chunk) > 1 and _patch_supported and _batch_supported:
+                try:
+                    container.execute_item_batch(
+                        batch_operations=[
+                            ("patch", (doc_id, _advice_operations(advice, alert_level)), _patch_options())
+                            for doc_id, _, advice, alert_level in chunk
+                        ],
+                        partition_key=pk,
+                    )
+                    outcomes["patched"] += len(chunk)
+                    continue
+                except CosmosBatchOperationError as e:
+                    # Transazione annullata (es. precondizione fallita su un elemento): si riprova per-item
+                    logging.info(f"Advice batch on partition {pk} rolled back at op {e.error_index}, retrying per item")
+                except Exception as e:
+                    if not _is_patch_unsupported(e):
+                        raise
+                    _disable_patch(e)
+            for doc_id, vehicle_id, advice, alert_level in chunk:
+                try:
+                    outcomes[update_advice(container, doc_id, vehicle_id, advice, alert_level)] += 1
+                except Exception as e:
+                    outcomes["failed"] += 1
+                    logging.warning(f"⚠️ Could not update Cosmos doc {doc_id} with advice: {e}")
+    return dict(outcomes)
+
+
+async def update_advice_async(container, doc_id, vehicle_id, advice, alert_level):
+    """Variante asincrona di update_advice (client azure.cosmos.aio)."""
+    from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+    pk = advice_partition_key(doc_id, vehicle_id)
+    if _patch_supported:
+        try:
+            await container.patch_item(item=doc_id, partition_key=pk,
+                                       patch_operations=_advice_operations(advice, alert_level), **_patch_options())
+            return "patched"
+        except CosmosAccessConditionFailedError:
+            return "skipped"
+        except Exception as e:
+            if not _is_patch_unsupported(e):
+                raise
+            _disable_patch(e)
+    existing = await container.read_item(item=doc_id, partition_key=pk)
+    if ADVICE_PATCH_PRECONDITION and existing.get("ai_advice"):
+        return "skipped"
+    existing["ai_advice"] = advice
+    existing["alert_level"] = alert_level
+    await container.upsert_item(existing)
+    return "upserted"
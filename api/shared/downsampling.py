@@ -0,0 +1,97 @@
+import datetime
+from typing import Iterable, List
+
+
+# --- Downsampling della telemetria per i grafici ---
+# I punti sono dict con "timestamp" ISO 8601 e campi numerici (speed, rpm, fuel_level).
+
+def _epoch(timestamp: str) -> float:
+    return datetime.datetime.fromisoformat(timestamp).timestamp()
+
+
+def _iso(epoch: float) -> str:
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat()
+
+
+def bucket_aggregate(points: Iterable[dict], bucket_sec: float, fields: List[str], mode: str = "minmax") -> List[dict]:
+    """Aggrega i punti in bucket temporali di bucket_sec secondi in un'unica passata (memoria O(bucket)).
+    mode="minmax": {campo: {min, max, avg}} per bucket; mode="avg": {campo: media}, stessa forma dei punti raw."""
+    buckets = {}
+    for point in points:
+        start = _epoch(point["timestamp"]) // bucket_sec * bucket_sec
+        acc = buckets.get(start)
+        if acc is None:
+            acc = buckets[start] = {"count": 0, "stats": {f: [float("inf"), float("-inf"), 0.0, 0] for f in fields}}
+        acc["count"] += 1
+        for field in fields:
+            value = point.get(field)
+            if value is None:
+                continue
+            stat = acc["stats"][field]
+            stat[0] = min(stat[0], value)
+            stat[1] = max(stat[1], value)
+            stat[2] += value
+            stat[3] += 1
+
+    result = []
+    for start in sorted(buckets):
+        acc = buckets[start]
+        row = {"timestamp": _iso(start), "count": acc["count"]}
+        for field, (lo, hi, total, n) in acc["stats"].items():
+            if n == 0:
+                row[field] = None
+            elif mode == "avg":
+                row[field] = round(total / n, 2)
+            else:
+                row[field] = {"min": lo, "max": hi, "avg": round(total / n, 2)}
+        result.append(row)
+    return result
+
+
+def lttb(points: Iterable[dict], threshold: int, field: str, start: str, end: str) -> List[dict]:
+    """Largest-Triangle-Three-Buckets in streaming: seleziona al più `threshold` punti originali preservando
+    la forma della serie `field`. I bucket sono intervalli di tempo di pari ampiezza su [start, end), così i punti
+    (in ordine cronologico) si consumano pagina per pagina tenendo in memoria solo il bucket corrente e il successivo."""
+    if threshold < 3:
+        raise ValueError("threshold deve essere >= 3")
+    origin = _epoch(start)
+    width = max((_epoch(end) - origin) / (threshold - 2), 1e-6)
+    sampled = []           # punti selezionati come (x, y, punto)
+    current = following = None  # (indice bucket, [(x, y, punto)])
+
+    def select(bucket, c_x, c_y):
+        # Nel bucket, il punto che forma il triangolo di area massima con A (ultimo selezionato) e C
+        a_x, a_y, _ = sampled[-1]
+        sampled.append(max(bucket, key=lambda e: abs((a_x - c_x) * (e[1] - a_y) - (a_x - e[0]) * (c_y - a_y))))
+
+    def centroid(bucket):
+        return sum(e[0] for e in bucket) / len(bucket), sum(e[1] for e in bucket) / len(bucket)
+
+    pending = None  # l'ultimo punto letto entra in un bucket solo quando ne arriva un altro
+    for point in points:
+        entry = (_epoch(point["timestamp"]), point.get(field) or 0, point)
+        if not sampled:
+            sampled.append(entry)
+            continue
+        if pending is not None:
+            index = min(max(int((pending[0] - origin) // width), 0), threshold - 3)
+            if current is None or index == current[0]:
+                current = current or (index, [])
+                current[1].append(pending)
+            elif following is None or index == following[0]:
+                following = following or (index, [])
+                following[1].append(pending)
+            else:
+                select(current[1], *centroid(following[1]))
+                current, following = following, (index, [pending])
+        pending = entry
+
+    if pending is None:
+        return [e[2] for e in sampled]
+    if current is not None:
+        if following is not None:
+            select(current[1], *centroid(following[1]))
+            current = following
+        select(current[1], pending[0], pending[1])
+    sampled.append(pending)
+    return [e[2] for e in sampled]
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from shared.rules import classify
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+FAKE_LLM_LATENCY_MS = float(os.environ.get("FAKE_LLM_LATENCY_MS", "0"))                   # latenza fissa per chiamata
+FAKE_LLM_PER_ITEM_LATENCY_MS = float(os.environ.get("FAKE_LLM_PER_ITEM_LATENCY_MS", "0"))  # costo aggiuntivo per lettura
+FAKE_LLM_MALFORMED_RATE = float(os.environ.get("FAKE_LLM_MALFORMED_RATE", "0"))            # probabilità di risposta batch incompleta
+FAKE_LLM_ERROR_RATE = float(os.environ.get("FAKE_LLM_ERROR_RATE", "0"))                    # probabilità di errore 500
+FAKE_LLM_THROTTLE_RATE = float(os.environ.get("FAKE_LLM_THROTTLE_RATE", "0"))              # probabilità di 429
+
+_NUMBER = r"(-?\d+(?:\.\d+)?)"
+_SPEED_RE = re.compile(rf"Velocità:\s*{_NUMBER}")
+_RPM_RE = re.compile(rf"RPM:\s*{_NUMBER}")
+_FUEL_RE = re.compile(rf"carburante:\s*{_NUMBER}")
+
+
+class FakeLLMError(Exception):
+    """Errore simulato del provider, con status_code come le eccezioni HTTP dei client reali."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code} {message}")
+        self.status_code = status_code
+
+
+def _extract(pattern, text, default):
+    match = pattern.search(text)
+    return float(match.group(1)) if match else default
+
+
+class FakeStructuredLLM:
+    """Sostituto locale di `llm.with_structured_output(schema)`: risponde con le regole di shared/rules
+    (senza passare dal fallback di ai_advisor, così i contatori llm.fallback restano quelli reali), simulando latenza, errori/429 e risposte batch malformate. Nessuna chiamata di rete."""
+
+    def __init__(self, schema, latency_ms=FAKE_LLM_LATENCY_MS, per_item_latency_ms=FAKE_LLM_PER_ITEM_LATENCY_MS,
+                 malformed_rate=FAKE_LLM_MALFORMED_RATE, error_rate=FAKE_LLM_ERROR_RATE,
+                 throttle_rate=FAKE_LLM_THROTTLE_RATE, seed=None):
+        self.schema = schema
+        self.latency_ms = latency_ms
+        self.per_item_latency_ms = per_item_latency_ms
+        self.malformed_rate = malformed_rate
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self._rng = random.Random(seed)
+
+    def _respond(self, messages):
+        # Import locale: ai_advisor importa questo modulo in modo lazy
+        from shared.ai_advisor import BatchTelemetryAdvice, TelemetryAdvice, TelemetryAdviceItem
+        from shared.rule_engine import get_rule_engine
+
+        self.calls += 1
+        content = messages[-1].content
+        roll = self._rng.random()
+        if roll < self.throttle_rate:
+            raise FakeLLMError(429, "Resource has been exhausted (e.g. check quota).")
+        if roll < self.throttle_rate + self.error_rate:
+            raise FakeLLMError(500, "Internal error encountered.")
+
+        if self.schema is BatchTelemetryAdvice:
+            readings = json.loads(content)
+            rules = get_rule_engine().classify_docs(readings)
+            items = [TelemetryAdviceItem(doc_id=r["doc_id"], advice=rule.advice, alert_level=rule.alert_level)
+                     for r, rule in zip(readings, rules)]
+            if items and self._rng.random() < self.malformed_rate:
+                items = items[: self._rng.randrange(len(items))]  # risposta troncata
+            return BatchTelemetryAdvice(items=items), len(readings)
+
+        speed = _extract(_SPEED_RE, content, 0)
+        rpm = _extract(_RPM_RE, content, 0)
+        fuel_level = _extract(_FUEL_RE, content, 100)
+        rule = classify(speed, rpm, fuel_level)
+        return TelemetryAdvice(advice=rule.advice, alert_level=rule.alert_level), 1
+
+    def _delay(self, item_count):
+        return (self.latency_ms + self.per_item_latency_ms * item_count) / 1000.0
+
+    def invoke(self, messages):
+        result, item_count = self._respond(messages)
+        delay = self._delay(item_count)
+        if delay > 0:
+            time.sleep(delay)
+        return result
+
+    async def ainvoke(self, messages):
+        result, item_count = self._respond(messages)
+        delay = self._delay(item_count)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return result
+
+
+class FakeChatModel:
+    """Sostituto locale di ChatGoogleGenerativeAI (solo `with_structured_output`)."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def with_structured_output(self, schema):
+        return FakeStructuredLLM(schema, **self.kwargs)
@@ -0,0 +1,307 @@
+import datetime
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+INGEST_DEDUP_ENABLED = os.environ.get("INGEST_DEDUP_ENABLED", "true").lower() == "true"
+INGEST_SEQ_WINDOW = int(os.environ.get("INGEST_SEQ_WINDOW", "1024"))                     # sequenze ricordate per veicolo
+INGEST_DEDUP_RECENT = int(os.environ.get("INGEST_DEDUP_RECENT", "50000"))                # id recenti (confronto esatto)
+INGEST_DEDUP_BLOOM_CAPACITY = int(os.environ.get("INGEST_DEDUP_BLOOM_CAPACITY", "200000"))  # id per generazione del Bloom
+INGEST_DEDUP_BLOOM_FPR = float(os.environ.get("INGEST_DEDUP_BLOOM_FPR", "0.001"))
+INGEST_MAX_VEHICLES = int(os.environ.get("INGEST_MAX_VEHICLES", "100000"))
+INGEST_DEVICE_TIME = os.environ.get("INGEST_DEVICE_TIME", "true").lower() == "true"    # timestamp = ora del device
+INGEST_MAX_CLOCK_SKEW_SEC = float(os.environ.get("INGEST_MAX_CLOCK_SKEW_SEC", "300"))  # oltre: ora del server
+
+# Esiti dello screening
+NEW = "new"
+LATE = "late"                              # fuori ordine: salvato (flag "late"), escluso dallo stato live
+DUPLICATE = "duplicate"                    # già elaborato: scartato
+PROBABLE_DUPLICATE = "probable_duplicate"  # solo il Bloom lo ricorda: salvato (upsert idempotente), niente advice
+
+
+# --- Identità e tempo della lettura ---
+
+def document_id(raw: bytes, telemetry: dict, index: int = 0) -> str:
+    """id del documento: (veicolo, boot, seq) se il device numera le letture, altrimenti hash del body
+    (più la posizione `index` della lettura nei messaggi che ne trasportano diverse).
+    Con la sequenza l'id non dipende dalla serializzazione: le redelivery fanno sempre upsert dello stesso documento."""
+    seq = telemetry.get("seq")
+    if seq is None:
+        return hashlib.sha256(raw + b"#%d" % index if index else raw).hexdigest()
+    key = f"{telemetry.get('vehicle_id')}|{telemetry.get('boot_id', '')}|{seq}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _parse_time(value) -> datetime.datetime:
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+            return parsed.replace(tzinfo=datetime.timezone.utc) if parsed.tzinfo is None else parsed.astimezone(datetime.timezone.utc)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"Unsupported timestamp: {value!r}")
+    return datetime.datetime.fromtimestamp(value / 1000.0 if value > 1e12 else value, datetime.timezone.utc)
+
+
+def device_timestamp(value, now: datetime.datetime) -> Optional[datetime.datetime]:
+    """Ora del device (epoch in s/ms o ISO 8601) se plausibile; None se assente, malformata o troppo avanti."""
+    if value is None or not INGEST_DEVICE_TIME:
+        return None
+    try:
+        ts = _parse_time(value)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+    if (ts - now).total_seconds() > INGEST_MAX_CLOCK_SKEW_SEC:
+        return None
+    return ts
+
+
+# --- Bloom filter a due generazioni ---
+
+class BloomFilter:
+    """Bloom filter a rotazione: quando la generazione corrente raggiunge `capacity` elementi diventa la
+    precedente e se ne apre una vuota. Memoria costante, finestra tra capacity e 2*capacity id,
+    falsi positivi ~fpr per generazione. Nessun falso negativo dentro la finestra."""
+
+    def __init__(self, capacity: int = INGEST_DEDUP_BLOOM_CAPACITY, fpr: float = INGEST_DEDUP_BLOOM_FPR):
+        self.capacity = max(1, capacity)
+        self.fpr = fpr
+        self.bits = max(64, int(-self.capacity * math.log(fpr) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = None
+        self.count = 0
+        self.rotations = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _test(array, positions) -> bool:
+        return all(array[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def __contains__(self, key: str) -> bool:
+        positions = self._positions(key)
+        return self._test(self._current, positions) or (self._previous is not None and self._test(self._previous, positions))
+
+    def add(self, key: str):
+        if self.count >= self.capacity:
+            self._previous, self._current = self._current, bytearray(len(self._current))
+            self.count = 0
+            self.rotations += 1
+        for p in self._positions(key):
+            self._current[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def stats(self) -> dict:
+        return {"capacity": self.capacity, "bits": self.bits, "hashes": self.hashes,
+                "count": self.count, "rotations": self.rotations,
+                "memory_kib": round(len(self._current) * (2 if self._previous is not None else 1) / 1024, 1)}
+
+
+# --- Stato per veicolo ---
+
+class _Stream:
+    """Sequenze viste di un veicolo: massimo `high` e bitmap anti-replay delle `window` precedenti
+    (bit i = sequenza high - i già vista)."""
+
+    __slots__ = ("boot", "high", "seen", "last_ts")
+
+    def __init__(self, boot=None, high=None, last_ts=None):
+        self.boot = boot
+        self.high = high
+        self.seen = 1 if high is not None else 0
+        self.last_ts = last_ts
+
+    def contains(self, seq: int, window: int) -> Optional[bool]:
+        """True/False se seq è nella finestra, None se è più vecchia della finestra."""
+        offset = self.high - seq
+        if offset < 0:
+            return False
+        if offset >= window:
+            return None
+        return bool(self.seen >> offset & 1)
+
+
+class IngestSequencer:
+    """Dedup e ordinamento della telemetria in ingresso, per worker. Le letture con sequenza (`seq`, monotona
+    per veicolo e per `boot_id` dell'emulatore) sono confrontate con la bitmap del veicolo: già viste →
+    duplicato, più vecchie del massimo → fuori ordine. Senza sequenza si usano gli id recenti (esatti) e il
+    Bloom filter (finestra più lunga, probabilistica), con l'ora del device per riconoscere i ritardi.
+
+    screen() non modifica lo stato: commit() registra le letture a fine elaborazione, così un batch
+    rieseguito dopo un errore nel corpo della funzione non viene scartato come duplicato. Il commit precede
+    però la scrittura degli output binding da parte dell'host: ProcessTelemetry verifica in Cosmos i
+    duplicati prima di scartarli. IoT Hub instrada i messaggi di un
+    device sempre sulla stessa partizione, quindi lo stato di un veicolo vive in un solo worker alla volta."""
+
+    def __init__(self, window: int = INGEST_SEQ_WINDOW, recent: int = INGEST_DEDUP_RECENT,
+                 bloom_capacity: int = INGEST_DEDUP_BLOOM_CAPACITY, bloom_fpr: float = INGEST_DEDUP_BLOOM_FPR,
+                 max_vehicles: int = INGEST_MAX_VEHICLES):
+        self.window = max(1, window)
+        self.recent = recent
+        self.max_vehicles = max_vehicles
+        self._mask = (1 << self.window) - 1
+        self._bloom = BloomFilter(bloom_capacity, bloom_fpr)
+        self._recent = OrderedDict()    # id -> None, ultimi `recent` id (FIFO)
+        self._streams = OrderedDict()   # vehicle_id -> _Stream (LRU)
+        self._lock = threading.Lock()
+        self.screened = 0
+        self.duplicates = 0
+        self.probable_duplicates = 0
+        self.late = 0
+        self.gaps = 0
+        self.restarts = 0
+
+    @staticmethod
+    def order(docs: List[dict]) -> List[dict]:
+        """Ordine del device: per veicolo, per timestamp e sequenza (l'ordine tra veicoli non conta)."""
+        return sorted(docs, key=lambda d: (d.get("vehicle_id") or "", d.get("timestamp") or "", d.get("seq", -1)))
+
+    def screen(self, docs: List[dict]) -> List[str]:
+        """Esito di ogni documento (NEW, LATE, DUPLICATE, PROBABLE_DUPLICATE), nell'ordine ricevuto.
+        I duplicati interni al batch sono riconosciuti; i documenti LATE ricevono il flag "late"."""
+        verdicts = []
+        batch_ids = set()
+        batch_high = {}   # vehicle_id -> (boot, massima sequenza già nel batch)
+        batch_ts = {}     # vehicle_id -> timestamp più recente già nel batch
+        with self._lock:
+            for doc in docs:
+                verdict = self._verdict(doc, batch_ids, batch_high, batch_ts)
+                if verdict == LATE:
+                    doc["late"] = True
+                verdicts.append(verdict)
+            self.screened += len(docs)
+            self.duplicates += verdicts.count(DUPLICATE)
+            self.probable_duplicates += verdicts.count(PROBABLE_DUPLICATE)
+            self.late += verdicts.count(LATE)
+        return verdicts
+
+    def _verdict(self, doc, batch_ids, batch_high, batch_ts) -> str:
+        key = doc["id"]
+        if key in batch_ids:
+            return DUPLICATE
+        batch_ids.add(key)
+        vehicle_id, seq, ts = doc.get("vehicle_id"), doc.get("seq"), doc.get("timestamp")
+        stream = self._streams.get(vehicle_id) if vehicle_id else None
+
+        if seq is not None and vehicle_id:
+            boot = doc.get("boot_id")
+            if stream is not None and (stream.boot != boot or stream.high is None):
+                stream = None  # emulatore riavviato: nuova numerazione
+            high = stream.high if stream is not None else None
+            in_batch = batch_high.get(vehicle_id)
+            if in_batch is not None and in_batch[0] == boot:
+                high = in_batch[1] if high is None else max(high, in_batch[1])
+            if high is None or seq > high:
+                batch_high[vehicle_id] = (boot, seq)
+                return NEW
+            seen = stream.contains(seq, self.window) if stream is not None else False
+            if seen:
+                return DUPLICATE
+            if seen is None and key in self._bloom:
+                return PROBABLE_DUPLICATE
+            return LATE
+
+        if key in self._recent:
+            return DUPLICATE
+        if key in self._bloom:
+            return PROBABLE_DUPLICATE
+        if vehicle_id and ts:
+            last = max(filter(None, (stream.last_ts if stream else None, batch_ts.get(vehicle_id))), default=None)
+            if last is not None and ts < last:
+                return LATE
+            batch_ts[vehicle_id] = ts
+        return NEW
+
+    def commit(self, docs: List[dict]):
+        """Registra come elaborati i documenti salvati (NEW, LATE e PROBABLE_DUPLICATE)."""
+        with self._lock:
+            for doc in docs:
+                key = doc["id"]
+                self._bloom.add(key)
+                if doc.get("seq") is None:
+                    self._recent[key] = None
+                    if len(self._recent) > self.recent:
+                        self._recent.popitem(last=False)
+                vehicle_id = doc.get("vehicle_id")
+                if vehicle_id:
+                    self._track(vehicle_id, doc.get("boot_id"), doc.get("seq"), doc.get("timestamp"))
+            while len(self._streams) > self.max_vehicles:
+                self._streams.popitem(last=False)  # veicolo inattivo da più tempo
+
+    def _track(self, vehicle_id, boot, seq, ts):
+        stream = self._streams.get(vehicle_id)
+        if stream is None:
+            stream = self._streams[vehicle_id] = _Stream(boot)
+        else:
+            self._streams.move_to_end(vehicle_id)
+        if ts and (stream.last_ts is None or ts > stream.last_ts):
+            stream.last_ts = ts
+        if seq is None:
+            return
+        if stream.high is None or stream.boot != boot:
+            if stream.high is not None:
+                self.restarts += 1
+            stream.boot, stream.high, stream.seen = boot, seq, 1
+        elif seq > stream.high:
+            shift = seq - stream.high
+            self.gaps += shift - 1
+            stream.seen = ((stream.seen << shift) | 1) & self._mask if shift < self.window else 1
+            stream.high = seq
+        elif stream.high - seq < self.window:
+            stream.seen |= 1 << (stream.high - seq)
+            self.gaps -= 1  # la lettura mancante è arrivata in ritardo
+
+    def forget(self, vehicle_id: str = None):
+        """Dimentica le sequenze di un veicolo o, se None, tutto lo stato (es. dopo la cancellazione dei dati)."""
+        with self._lock:
+            if vehicle_id:
+                self._streams.pop(vehicle_id, None)
+            else:
+                self._streams.clear()
+                self._recent.clear()
+                self._bloom = BloomFilter(self._bloom.capacity, self._bloom.fpr)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "screened": self.screened,
+                "duplicates": self.duplicates,
+                "probable_duplicates": self.probable_duplicates,
+                "late": self.late,
+                "missing": max(0, self.gaps),
+                "restarts": self.restarts,
+                "duplicate_ratio": round(self.duplicates / self.screened, 4) if self.screened else 0.0,
+                "tracked_vehicles": len(self._streams),
+                "recent_ids": len(self._recent),
+                "bloom": self._bloom.stats(),
+            }
+
+
+# --- Singleton ---
+
+_sequencer = None
+_init_lock = threading.Lock()
+
+def get_ingest_sequencer() -> Optional[IngestSequencer]:
+    """Lazy singleton: None se disabilitato via INGEST_DEDUP_ENABLED."""
+    global _sequencer
+    if _sequencer is None and INGEST_DEDUP_ENABLED:
+        with _init_lock:
+            if _sequencer is None:
+                _sequencer = IngestSequencer()
+                logger.info(f"✅ Ingest sequencer initialized (window {INGEST_SEQ_WINDOW}, recent ids {INGEST_DEDUP_RECENT}, "
+                            f"bloom {_sequencer._bloom.bits // 8 // 1024} KiB x2)")
+    return _sequencer
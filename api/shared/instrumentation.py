@@ -0,0 +1,235 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+INSTRUMENTATION_ENABLED = os.environ.get("INSTRUMENTATION_ENABLED", "true").lower() == "true"
+LOG_SAMPLE_EVERY = int(os.environ.get("INSTRUMENTATION_LOG_SAMPLE_EVERY", "100"))   # 1 body loggato ogni N (0 = mai)
+EXPORT_MODE = os.environ.get("INSTRUMENTATION_EXPORT", "none").lower()              # none | log | otel
+EXPORT_INTERVAL_SEC = float(os.environ.get("INSTRUMENTATION_EXPORT_INTERVAL_SEC", "60"))
+
+# Bucket esponenziali in ms (0.05 ms … ~105 s, fattore 2): una bisect per osservazione
+BUCKETS_MS = tuple(0.05 * 2 ** i for i in range(22))
+
+
+class Histogram:
+    """Istogramma a bucket fissi: costo O(log bucket) per osservazione, memoria costante."""
+
+    __slots__ = ("counts", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)  # ultimo bucket = +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS_MS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Stima dal limite superiore del bucket (limitata al massimo osservato)."""
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        cumulative = 0
+        for index, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= rank and n:
+                upper = BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max
+                return round(min(upper, self.max), 3)
+        return round(self.max, 3)
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count, 3) if self.count else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max, 3) if self.max is not None else None,
+        }
+
+
+# --- Exporter ---
+
+class LogExporter:
+    """Scrive periodicamente un riepilogo JSON nei log (su Azure finisce in Application Insights come trace)."""
+
+    def export(self, stats: dict):
+        logger.info(f"📊 Instrumentation: {json.dumps(stats)}")
+
+
+class OpenTelemetryExporter:
+    """Registra ogni osservazione su strumenti OpenTelemetry. Se è installata la distro Azure Monitor e
+    APPLICATIONINSIGHTS_CONNECTION_STRING è configurata, le metriche arrivano ad Application Insights."""
+
+    def __init__(self):
+        from opentelemetry import metrics
+        if os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+            try:
+                from azure.monitor.opentelemetry import configure_azure_monitor
+                configure_azure_monitor()
+            except ImportError:
+                logger.warning("⚠️ azure-monitor-opentelemetry not installed, using the global OpenTelemetry provider")
+        meter = metrics.get_meter("ecofleet")
+        self._duration = meter.create_histogram("ecofleet.stage.duration", unit="ms", description="Durata per stage")
+        self._events = meter.create_counter("ecofleet.events", description="Contatori della pipeline")
+
+    def observe(self, stage: str, value_ms: float):
+        self._duration.record(value_ms, {"stage": stage})
+
+    def incr(self, name: str, n: int):
+        self._events.add(n, {"name": name})
+
+
+class Instrumentation:
+    """Timer per stage, contatori e logging campionato, per worker. Gli exporter possono implementare
+    observe/incr (per osservazione) e/o export (riepilogo periodico)."""
+
+    def __init__(self, enabled: bool = INSTRUMENTATION_ENABLED, sample_every: int = LOG_SAMPLE_EVERY,
+                 export_interval: float = EXPORT_INTERVAL_SEC):
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.export_interval = export_interval
+        self._histograms = {}
+        self._counters = {}
+        self._samples = {}
+        self._exporters = []
+        self._lock = threading.Lock()
+        self._last_export = time.monotonic()
+
+    # --- Registrazione ---
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Misura la durata del blocco (anche con await all'interno) nello stage indicato."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, (time.perf_counter() - start) * 1000.0)
+
+    def observe(self, stage: str, value_ms: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(value_ms)
+        for exporter in self._exporters:
+            if hasattr(exporter, "observe"):
+                exporter.observe(stage, value_ms)
+        self._maybe_export()
+
+    def incr(self, name: str, n: int = 1):
+        if not self.enabled or not n:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+        for exporter in self._exporters:
+            if hasattr(exporter, "incr"):
+                exporter.incr(name, n)
+
+    def sample(self, key: str) -> bool:
+        """True una volta ogni `sample_every` chiamate per chiave: per loggare payload senza farlo a ogni messaggio."""
+        if self.sample_every <= 0:
+            return False
+        with self._lock:
+            count = self._samples.get(key, 0)
+            self._samples[key] = count + 1
+        return count % self.sample_every == 0
+
+    # --- Export ---
+
+    def add_exporter(self, exporter):
+        self._exporters.append(exporter)
+
+    def _maybe_export(self):
+        now = time.monotonic()
+        if now - self._last_export < self.export_interval:
+            return
+        with self._lock:
+            if now - self._last_export < self.export_interval:
+                return
+            self._last_export = now
+        periodic = [e for e in self._exporters if hasattr(e, "export")]
+        if periodic:
+            stats = self.stats()
+            for exporter in periodic:
+                try:
+                    exporter.export(stats)
+                except Exception as e:
+                    logger.warning(f"⚠️ Instrumentation export failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {stage: h.summary() for stage, h in sorted(self._histograms.items())},
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def prometheus_text(self) -> str:
+        """Formato testo Prometheus 0.0.4: istogrammi di durata per stage e contatori."""
+        lines = ["# TYPE ecofleet_stage_duration_ms histogram"]
+        with self._lock:
+            histograms = sorted((stage, list(h.counts), h.sum, h.count) for stage, h in self._histograms.items())
+            counters = sorted(self._counters.items())
+        for stage, counts, total, count in histograms:
+            cumulative = 0
+            for upper, n in zip(BUCKETS_MS, counts):
+                cumulative += n
+                lines.append(f'ecofleet_stage_duration_ms_bucket{{stage="{stage}",le="{upper:g}"}} {cumulative}')
+            lines.append(f'ecofleet_stage_duration_ms_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'ecofleet_stage_duration_ms_sum{{stage="{stage}"}} {total:.3f}')
+            lines.append(f'ecofleet_stage_duration_ms_count{{stage="{stage}"}} {count}')
+        lines.append("# TYPE ecofleet_events_total counter")
+        for name, value in counters:
+            lines.append(f'ecofleet_events_total{{name="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._samples.clear()
+
+
+# --- Singleton ---
+
+_instrumentation = None
+_init_lock = threading.Lock()
+
+def get_instrumentation() -> Instrumentation:
+    """Lazy singleton (sempre disponibile: se disabilitato i timer sono no-op)."""
+    global _instrumentation
+    if _instrumentation is None:
+        with _init_lock:
+            if _instrumentation is None:
+                instrumentation = Instrumentation()
+                if instrumentation.enabled and EXPORT_MODE == "log":
+                    instrumentation.add_exporter(LogExporter())
+                elif instrumentation.enabled and EXPORT_MODE == "otel":
+                    try:
+                        instrumentation.add_exporter(OpenTelemetryExporter())
+                    except ImportError:
+                        logger.warning("⚠️ opentelemetry not installed, INSTRUMENTATION_EXPORT=otel ignored")
+                _instrumentation = instrumentation
+                logger.info(f"✅ Instrumentation initialized (enabled: {instrumentation.enabled}, export: {EXPORT_MODE})")
+    return _instrumentation
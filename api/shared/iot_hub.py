@@ -1,22 +1,31 @@
 import logging
 import os
+import threading
 
-from azure.identity import DefaultAzureCredential
-from azure.iot.hub import IoTHubRegistryManager
+from shared.client_registry import get_credential
+from shared.local_backend import get_local_backend
 
 _iot_registry_manager = None
+_init_lock = threading.Lock()
 
 def get_iot_registry_manager():
     """Lazy singleton: crea il client una sola volta per processo (RBAC)."""
     global _iot_registry_manager
     if _iot_registry_manager is None:
-        iot_hub_host = os.environ.get("IotHubHostName")
-        if iot_hub_host:
-            credential = DefaultAzureCredential()
-            _iot_registry_manager = IoTHubRegistryManager.from_token_credential(
-                iot_hub_host, credential
-            )
-            logging.info("✅ IoT Hub Registry Manager initialized via Managed Identity")
-        else:
-            logging.warning("⚠️ IotHubHostName not configured. C2D feedback disabled.")
+        with _init_lock:
+            if _iot_registry_manager is not None:
+                return _iot_registry_manager
+            local = get_local_backend()
+            iot_hub_host = os.environ.get("IotHubHostName")
+            if local is not None:
+                _iot_registry_manager = local.c2d
+                logging.info("🧪 C2D loopback enabled (local backend)")
+            elif iot_hub_host:
+                from azure.iot.hub import IoTHubRegistryManager  # import pesante, differito al primo uso
+                _iot_registry_manager = IoTHubRegistryManager.from_token_credential(
+                    iot_hub_host, get_credential()
+                )
+                logging.info("✅ IoT Hub Registry Manager initialized via Managed Identity")
+            else:
+                logging.warning("⚠️ IotHubHostName not configured. C2D feedback disabled.")
     return _iot_registry_manager
@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional
+
+from shared.instrumentation import get_instrumentation
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+LLM_GUARD_ENABLED = os.environ.get("LLM_GUARD_ENABLED", "true").lower() == "true"
+LLM_CALL_TIMEOUT_SEC = float(os.environ.get("LLM_CALL_TIMEOUT_SEC", "8"))             # budget per chiamata singola
+LLM_BATCH_TIMEOUT_SEC = float(os.environ.get("LLM_BATCH_TIMEOUT_SEC", "20"))          # budget per chiamata batch
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "1"))                          # retry interni del client Gemini
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("LLM_BREAKER_FAILURE_THRESHOLD", "5"))  # errori consecutivi per aprire
+BREAKER_OPEN_SEC = float(os.environ.get("LLM_BREAKER_OPEN_SEC", "15"))                 # prima pausa, raddoppia a ogni probe fallito
+BREAKER_MAX_OPEN_SEC = float(os.environ.get("LLM_BREAKER_MAX_OPEN_SEC", "300"))
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get("LLM_BREAKER_HALF_OPEN_PROBES", "1"))
+LIMITER_INITIAL = float(os.environ.get("LLM_CONCURRENCY_INITIAL", "8"))
+LIMITER_MIN = float(os.environ.get("LLM_CONCURRENCY_MIN", "1"))
+LIMITER_MAX = float(os.environ.get("LLM_CONCURRENCY_MAX", "64"))
+LIMITER_TARGET_LATENCY_MS = float(os.environ.get("LLM_TARGET_LATENCY_MS", "3000"))    # oltre: il limite scende
+LIMITER_RATE_RPS = float(os.environ.get("LLM_RATE_LIMIT_RPS", "0"))                  # token bucket (0 = disattivato)
+LIMITER_WAIT_MS = float(os.environ.get("LLM_LIMITER_WAIT_MS", "250"))                # attesa massima di uno slot
+
+# Codici numerici degli stati (per gauge Prometheus)
+STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class ShortCircuit(Exception):
+    """La chiamata LLM non è stata tentata (breaker aperto o limiter saturo): usare il fallback."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def classify_llm_error(error: Exception) -> str:
+    """'timeout', 'throttled' (429 / quota esaurita) o 'error'."""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, FutureTimeoutError)):
+        return "timeout"
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    text = f"{type(error).__name__} {error}"
+    if status == 429 or "429" in text or "ResourceExhausted" in text or "RESOURCE_EXHAUSTED" in text or "quota" in text.lower():
+        return "throttled"
+    return "error"
+
+
+class CircuitBreaker:
+    """Breaker closed → open dopo N errori consecutivi; scaduta la pausa passa a half-open e lascia
+    passare al più `half_open_probes` chiamate di prova: un successo chiude, un errore riapre con pausa doppia."""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, open_sec: float = BREAKER_OPEN_SEC,
+                 max_open_sec: float = BREAKER_MAX_OPEN_SEC, half_open_probes: int = BREAKER_HALF_OPEN_PROBES):
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.max_open_sec = max_open_sec
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.current_open_sec = open_sec
+        self.open_until = 0.0
+        self.probes_in_flight = 0
+        self.transitions = {}
+        self.short_circuited = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str):
+        key = f"{self.state}->{state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        logger.warning(f"🔌 LLM circuit breaker {self.state} → {state}")
+        get_instrumentation().incr(f"llm.breaker.{state}")
+        self.state = state
+
+    def allow(self) -> bool:
+        """True se la chiamata può partire (in half-open occupa uno slot di probe)."""
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() < self.open_until:
+                    self.short_circuited += 1
+                    return False
+                self._transition("half_open")
+                self.probes_in_flight = 0
+            if self.state == "half_open":
+                if self.probes_in_flight >= self.half_open_probes:
+                    self.short_circuited += 1
+                    return False
+                self.probes_in_flight += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state == "half_open":
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                self.current_open_sec = self.open_sec
+                self._transition("closed")
+
+    def release_probe(self):
+        """Restituisce uno slot di probe half-open non utilizzato (chiamata non partita o cancellata)."""
+        with self._lock:
+            if self.state == "half_open":
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open":
+                self.probes_in_flight = max(0, self.probes_in_flight - 1)
+                self.current_open_sec = min(self.current_open_sec * 2, self.max_open_sec)
+                self._open()
+            elif self.state == "closed" and self.consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.open_until = time.monotonic() + self.current_open_sec
+        self._transition("open")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "state_value": STATES[self.state],
+                "consecutive_failures": self.consecutive_failures,
+                "open_remaining_sec": round(max(0.0, self.open_until - time.monotonic()), 1) if self.state == "open" else 0.0,
+                "short_circuited": self.short_circuited,
+                "transitions": dict(self.transitions),
+            }
+
+
+class AdaptiveLimiter:
+    """Limite di concorrenza AIMD: +1/limite per ogni risposta entro la latenza obiettivo, ×0.9 se lenta,
+    ×0.5 su 429/timeout. Con `rate` > 0 anche un token bucket, il cui rate si dimezza sui 429."""
+
+    def __init__(self, initial: float = LIMITER_INITIAL, minimum: float = LIMITER_MIN, maximum: float = LIMITER_MAX,
+                 target_latency_ms: float = LIMITER_TARGET_LATENCY_MS, rate: float = LIMITER_RATE_RPS):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency_ms = target_latency_ms
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.in_flight = 0
+        self.abandoned = 0     # chiamate scadute ancora in esecuzione: occupano lo slot finché non terminano
+        self.shed = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            if self.max_rate > 0:
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                if self.tokens < 1:
+                    return False
+                self.tokens -= 1
+            self.in_flight += 1
+            return True
+
+    def acquire(self, wait_ms: float = LIMITER_WAIT_MS) -> bool:
+        deadline = time.monotonic() + wait_ms / 1000.0
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                with self._lock:
+                    self.shed += 1
+                return False
+            time.sleep(0.005)
+        return True
+
+    async def aacquire(self, wait_ms: float = LIMITER_WAIT_MS) -> bool:
+        deadline = time.monotonic() + wait_ms / 1000.0
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                with self._lock:
+                    self.shed += 1
+                return False
+            await asyncio.sleep(0.005)
+        return True
+
+    def release(self, latency_ms: float, outcome: str, hold: bool = False):
+        """Aggiorna il limite in base all'esito: 'ok', 'timeout', 'throttled', 'error' o 'cancelled'.
+        Con hold=True lo slot resta occupato (chiamata abbandonata ma ancora in corso) fino a free()."""
+        with self._lock:
+            if hold:
+                self.abandoned += 1
+            else:
+                self.in_flight -= 1
+            if outcome in ("throttled", "timeout"):
+                self.limit = max(self.minimum, self.limit * 0.5)
+                if outcome == "throttled":
+                    self.throttled += 1
+                    if self.max_rate > 0:
+                        self.rate = max(0.1, self.rate * 0.5)
+                else:
+                    self.timeouts += 1
+            elif outcome == "ok":
+                if latency_ms > self.target_latency_ms:
+                    self.limit = max(self.minimum, self.limit * 0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                if self.max_rate > 0:
+                    self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def free(self):
+        """Libera lo slot di una chiamata abbandonata quando questa termina davvero."""
+        with self._lock:
+            self.in_flight -= 1
+            self.abandoned -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "abandoned": self.abandoned,
+                "rate_rps": round(self.rate, 2) if self.max_rate > 0 else None,
+                "shed": self.shed,
+                "throttled": self.throttled,
+                "timeouts": self.timeouts,
+            }
+
+
+class LLMGuard:
+    """Breaker + limiter + budget di tempo attorno a una chiamata LLM. Solleva ShortCircuit se la chiamata
+    non viene tentata; gli errori della chiamata vengono registrati e rilanciati al chiamante."""
+
+    def __init__(self, breaker: CircuitBreaker = None, limiter: AdaptiveLimiter = None, workers: int = int(LIMITER_MAX)):
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveLimiter()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm-call")
+
+    def _admit(self):
+        if not self.breaker.allow():
+            get_instrumentation().incr("llm.short_circuit")
+            raise ShortCircuit("breaker_open")
+
+    def _shed(self):
+        # Slot non ottenuto: un eventuale probe half-open va restituito senza contare come errore
+        self.breaker.release_probe()
+        get_instrumentation().incr("llm.shed")
+        raise ShortCircuit("limiter_saturated")
+
+    def _record(self, start: float, error: Optional[Exception], hold: bool = False):
+        latency_ms = (time.perf_counter() - start) * 1000.0
+        outcome = "ok" if error is None else classify_llm_error(error)
+        self.limiter.release(latency_ms, outcome, hold)
+        if error is None:
+            self.breaker.record_success()
+        else:
+            get_instrumentation().incr(f"llm.{outcome}")
+            self.breaker.record_failure()
+
+    def call(self, fn, *args, timeout: float = LLM_CALL_TIMEOUT_SEC):
+        """Esegue fn(*args) entro `timeout` secondi. Allo scadere il chiamante prosegue subito; la chiamata
+        abbandonata termina in background nel pool (entro il timeout del client) e tiene occupato il suo
+        slot fino ad allora, così la concorrenza reale verso il modello resta entro il limite adattivo."""
+        self._admit()
+        if not self.limiter.acquire():
+            self._shed()
+        start = time.perf_counter()
+        future = self._executor.submit(fn, *args)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError as e:
+            self._record(start, e, hold=True)
+            future.add_done_callback(lambda _: self.limiter.free())
+            raise
+        except Exception as e:
+            self._record(start, e)
+            raise
+        self._record(start, None)
+        return result
+
+    async def acall(self, coro_fn, *args, timeout: float = LLM_CALL_TIMEOUT_SEC):
+        """Variante asincrona: la coroutine viene cancellata allo scadere del budget."""
+        self._admit()
+        if not await self.limiter.aacquire():
+            self._shed()
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(coro_fn(*args), timeout=timeout)
+        except asyncio.CancelledError:
+            # Cancellazione dall'esterno: né successo né errore del modello
+            self.limiter.release(0.0, "cancelled")
+            self.breaker.release_probe()
+            raise
+        except Exception as e:
+            self._record(start, e)
+            raise
+        self._record(start, None)
+        return result
+
+    def stats(self) -> dict:
+        return {"breaker": self.breaker.stats(), "limiter": self.limiter.stats()}
+
+
+# --- Singleton ---
+
+_guard = None
+_init_lock = threading.Lock()
+
+def get_llm_guard() -> Optional[LLMGuard]:
+    """Lazy singleton: None se LLM_GUARD_ENABLED=false (chiamate dirette, senza timeout né breaker)."""
+    global _guard
+    if _guard is None and LLM_GUARD_ENABLED:
+        with _init_lock:
+            if _guard is None:
+                _guard = LLMGuard()
+                logger.info(f"✅ LLM guard initialized (timeout {LLM_CALL_TIMEOUT_SEC}s, breaker after "
+                            f"{BREAKER_FAILURE_THRESHOLD} failures, concurrency {LIMITER_INITIAL:g})")
+    return _guard
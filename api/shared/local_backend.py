@@ -0,0 +1,492 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+# =============================================================================
+# Backend locale in-process: sostituti di Cosmos DB, advice-queue, SignalR e
+# IoT Hub (C2D) per eseguire blueprint e simulatore senza Azure né rete.
+# Ogni servizio ha latenza e throttling iniettabili, per riprodurre in locale
+# il comportamento sotto carico (code che crescono, 429, retry).
+# =============================================================================
+
+LOCAL_BACKEND = os.environ.get("LOCAL_BACKEND", "false").lower() == "true"
+# File SQLite per i container Cosmos locali (vuoto = solo memoria, persi a fine processo)
+LOCAL_COSMOS_PATH = os.environ.get("LOCAL_COSMOS_PATH", "")
+# Worker che consumano advice-queue sull'event loop locale (come le istanze del queue trigger)
+LOCAL_ADVICE_WORKERS = int(os.environ.get("LOCAL_ADVICE_WORKERS", "4"))
+# Registrazione JSONL dei messaggi SignalR (vuoto = solo gli ultimi LOCAL_SIGNALR_HISTORY in memoria)
+LOCAL_SIGNALR_LOG = os.environ.get("LOCAL_SIGNALR_LOG", "")
+LOCAL_SIGNALR_HISTORY = int(os.environ.get("LOCAL_SIGNALR_HISTORY", "200"))
+
+SERVICES = ("cosmos", "queue", "signalr", "c2d")
+
+
+class LocalThrottledError(Exception):
+    """Richiesta rifiutata dal throttling simulato (equivalente di un HTTP 429)."""
+
+    status_code = 429
+
+
+class ServiceProfile:
+    """Latenza (fissa + jitter) e throttling token bucket di un servizio locale.
+    Configurato da LOCAL_<SERVIZIO>_LATENCY_MS, _JITTER_MS e _MAX_OPS_SEC (0 = nessun limite)."""
+
+    def __init__(self, name, latency_ms=0.0, jitter_ms=0.0, max_ops_sec=0.0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.max_ops_sec = max_ops_sec
+        self._tokens = max_ops_sec
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.throttled = 0
+        self.delay_ms = 0.0
+
+    @classmethod
+    def from_env(cls, name):
+        prefix = f"LOCAL_{name.upper()}_"
+        return cls(
+            name,
+            latency_ms=float(os.environ.get(prefix + "LATENCY_MS", "0")),
+            jitter_ms=float(os.environ.get(prefix + "JITTER_MS", "0")),
+            max_ops_sec=float(os.environ.get(prefix + "MAX_OPS_SEC", "0")),
+        )
+
+    def _admit(self, operation) -> float:
+        """Conta l'operazione e restituisce la latenza da applicare; solleva se il bucket è vuoto."""
+        with self._lock:
+            self.calls[operation] += 1
+            if self.max_ops_sec > 0:
+                now = time.monotonic()
+                self._tokens = min(self.max_ops_sec, self._tokens + (now - self._refilled) * self.max_ops_sec)
+                self._refilled = now
+                if self._tokens < 1.0:
+                    self.throttled += 1
+                    raise self._throttled_error(operation)
+                self._tokens -= 1.0
+            delay = self.latency_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+            self.delay_ms += delay
+            return delay / 1000.0
+
+    def _throttled_error(self, operation):
+        message = f"Local {self.name} throttled {operation} (LOCAL_{self.name.upper()}_MAX_OPS_SEC={self.max_ops_sec:g})"
+        if self.name == "cosmos":
+            # Stessa eccezione del servizio reale: il codice che gestisce i 429 Cosmos la riconosce
+            from azure.cosmos.exceptions import CosmosHttpResponseError
+            return CosmosHttpResponseError(status_code=429, message=message)
+        return LocalThrottledError(message)
+
+    def call(self, operation):
+        delay = self._admit(operation)
+        if delay:
+            time.sleep(delay)
+
+    async def call_async(self, operation):
+        delay = self._admit(operation)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": sum(self.calls.values()),
+                "by_operation": dict(self.calls),
+                "throttled": self.throttled,
+                "injected_delay_ms": round(self.delay_ms, 1),
+                "latency_ms": self.latency_ms,
+                "jitter_ms": self.jitter_ms,
+                "max_ops_sec": self.max_ops_sec,
+            }
+
+
+class ServiceProxy:
+    """Inoltra i metodi di `target` passando prima dal profilo del servizio (latenza e throttling),
+    sia per le chiamate sincrone sia per le coroutine (client aio)."""
+
+    def __init__(self, target, profile: ServiceProfile):
+        self._target = target
+        self._profile = profile
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+        profile = self._profile
+        if asyncio.iscoroutinefunction(attr):
+            async def call_async(*args, **kwargs):
+                await profile.call_async(name)
+                return await attr(*args, **kwargs)
+            return call_async
+
+        def call(*args, **kwargs):
+            profile.call(name)
+            return attr(*args, **kwargs)
+        return call
+
+
+# --- advice-queue: asyncio.Queue su un event loop dedicato ---
+
+class LocalQueueMessage:
+    """Messaggio della coda locale, con gli attributi di azure.storage.queue.QueueMessage usati dal drain."""
+
+    def __init__(self, content: str):
+        self.id = uuid.uuid4().hex
+        self.content = content
+        self.inserted_on = time.time()
+        self.dequeue_count = 0
+
+
+class LocalAdviceQueue:
+    """advice-queue in-process. Il binding di output (put) accoda da qualsiasi thread; LOCAL_ADVICE_WORKERS
+    worker sull'event loop locale consegnano i messaggi al GenerateAdvice reale, come il queue trigger.
+    Espone anche receive_messages/delete_message, così drain_advice_requests (batching) funziona invariato."""
+
+    def __init__(self, profile: ServiceProfile, handler, workers=LOCAL_ADVICE_WORKERS):
+        self.profile = profile
+        self._handler = handler  # coroutine(LocalQueueMessage)
+        self._workers = max(1, workers)
+        self._loop = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._idle = threading.Condition()
+        self._pending = 0  # accodati e non ancora completati
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.drained = 0
+        self.max_depth = 0
+
+    def _ensure_started(self):
+        if self._loop is not None:
+            return
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            ready = threading.Event()
+
+            def run():
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                self._queue = asyncio.Queue()
+                for _ in range(self._workers):
+                    loop.create_task(self._worker())
+                self._loop = loop
+                ready.set()
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name="local-advice-queue", daemon=True)
+            self._thread.start()
+            ready.wait()
+            logging.info(f"📬 Local advice-queue started ({self._workers} workers)")
+
+    def put(self, content: str):
+        """Accoda un messaggio (thread-safe). Soggetto a latenza e throttling del profilo "queue"."""
+        self.profile.call("put")
+        self._ensure_started()
+        with self._idle:
+            self._pending += 1
+            self.enqueued += 1
+        self._loop.call_soon_threadsafe(self._enqueue, LocalQueueMessage(content))
+
+    def _enqueue(self, message):
+        self._queue.put_nowait(message)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def _done(self, count=1):
+        with self._idle:
+            self._pending -= count
+            if self._pending <= 0:
+                self._idle.notify_all()
+
+    async def _worker(self):
+        while True:
+            message = await self._queue.get()
+            message.dequeue_count += 1
+            try:
+                await self._handler(message)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Local advice-queue handler error: {e}")
+            finally:
+                self._done()
+
+    # --- Facciata QueueClient (drain_advice_requests / complete_advice_requests) ---
+
+    def receive_messages(self, messages_per_page=32, visibility_timeout=None, max_messages=None, **kwargs):
+        self.profile.call("receive_messages")
+        if self._loop is None:
+            return []
+        limit = max_messages or messages_per_page
+
+        async def take():
+            taken = []
+            while len(taken) < limit and not self._queue.empty():
+                taken.append(self._queue.get_nowait())
+            return taken
+
+        if threading.current_thread() is self._thread:
+            return []  # un handler sull'event loop non può attendere l'event loop stesso
+        messages = asyncio.run_coroutine_threadsafe(take(), self._loop).result()
+        for message in messages:
+            message.dequeue_count += 1
+        self.drained += len(messages)
+        return messages
+
+    def delete_message(self, message, *args, **kwargs):
+        self.profile.call("delete_message")
+        self._done()
+
+    def join(self, timeout=None) -> bool:
+        """Attende che tutti i messaggi accodati siano stati elaborati. False allo scadere del timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._pending > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "drained": self.drained,
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_depth": self.max_depth,
+            "workers": self._workers,
+        }
+
+
+# --- SignalR: registratore dei broadcast ---
+
+class SignalRRecorder:
+    """Riceve i payload del binding SignalR (JSON di un messaggio o di una lista) e li conta per target.
+    Conserva gli ultimi LOCAL_SIGNALR_HISTORY messaggi e, se configurato, li appende a un file JSONL."""
+
+    def __init__(self, profile: ServiceProfile, log_path=LOCAL_SIGNALR_LOG, history=LOCAL_SIGNALR_HISTORY):
+        self.profile = profile
+        self.log_path = log_path
+        self.recent = deque(maxlen=history)
+        self.by_target = Counter()
+        self.payloads = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, payload):
+        self.profile.call("send")
+        text = payload if isinstance(payload, str) else json.dumps(payload)
+        messages = json.loads(text)
+        if not isinstance(messages, list):
+            messages = [messages]
+        now = time.time()
+        with self._lock:
+            self.payloads += 1
+            self.bytes += len(text)
+            for message in messages:
+                self.by_target[message.get("target", "?") if isinstance(message, dict) else "?"] += 1
+                self.recent.append({"t": now, **message} if isinstance(message, dict) else {"t": now, "raw": message})
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps({"t": now, "message": m}, separators=(",", ":")) + "\n" for m in messages))
+
+    def stats(self):
+        with self._lock:
+            return {"payloads": self.payloads, "messages": sum(self.by_target.values()),
+                    "bytes": self.bytes, "by_target": dict(self.by_target)}
+
+
+# --- IoT Hub C2D: loopback verso l'emulatore ---
+
+class LoopbackMessage:
+    """Messaggio C2D consegnato al device, con gli attributi di azure.iot.device.Message letti dall'emulatore."""
+
+    def __init__(self, device_id, data, custom_properties=None):
+        self.device_id = device_id
+        self.data = data
+        self.custom_properties = custom_properties or {}
+
+
+class LoopbackRegistryManager:
+    """Sostituto di IoTHubRegistryManager: send_c2d_message consegna il messaggio, nello stesso processo,
+    al callback registrato per il device (o a quello di default). Senza destinatario il messaggio
+    resta in `undelivered` (ultimi 1000), come un messaggio in coda sull'hub per un device offline."""
+
+    def __init__(self, profile: ServiceProfile):
+        self.profile = profile
+        self._handlers = {}
+        self._default = None
+        self.undelivered = deque(maxlen=1000)
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def register(self, device_id, callback):
+        """callback(LoopbackMessage) per un device; device_id None = tutti i device senza callback proprio."""
+        with self._lock:
+            if device_id is None:
+                self._default = callback
+            else:
+                self._handlers[device_id] = callback
+
+    def unregister(self, device_id):
+        with self._lock:
+            if device_id is None:
+                self._default = None
+            else:
+                self._handlers.pop(device_id, None)
+
+    def send_c2d_message(self, device_id, message, properties=None):
+        self.profile.call("send_c2d_message")
+        data = message if isinstance(message, bytes) else str(message).encode("utf-8")
+        delivery = LoopbackMessage(device_id, data, dict(properties or {}))
+        with self._lock:
+            self.sent += 1
+            callback = self._handlers.get(device_id, self._default)
+            if callback is None:
+                self.undelivered.append(delivery)
+                return
+        try:
+            callback(delivery)
+            with self._lock:
+                self.delivered += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logging.warning(f"⚠️ Loopback C2D handler for {device_id} failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "delivered": self.delivered, "failed": self.failed,
+                    "undelivered": len(self.undelivered), "devices": len(self._handlers)}
+
+
+# --- Binding di output ---
+
+class LocalOut:
+    """func.Out che, oltre a memorizzare il valore, lo consegna al servizio locale (come il binding reale)."""
+
+    def __init__(self, sink):
+        self.value = None
+        self._sink = sink
+
+    def set(self, value):
+        self.value = value
+        self._sink(value)
+
+    def get(self):
+        return self.value
+
+
+class LocalBackend:
+    """Container Cosmos, advice-queue, SignalR e IoT Hub locali con un profilo di latenza/throttling ciascuno."""
+
+    def __init__(self, cosmos_path=LOCAL_COSMOS_PATH):
+        from shared.local_cosmos import SQLiteItemStore
+
+        self.profiles = {name: ServiceProfile.from_env(name) for name in SERVICES}
+        self.store = SQLiteItemStore(cosmos_path) if cosmos_path else None
+        self._containers = {}
+        self._lock = threading.Lock()
+        self.advice_queue = LocalAdviceQueue(self.profiles["queue"], self._deliver_advice)
+        self.signalr = SignalRRecorder(self.profiles["signalr"])
+        self.c2d = LoopbackRegistryManager(self.profiles["c2d"])
+        self.documents_written = 0
+
+    # --- Cosmos ---
+
+    def _local_container(self, name, partition_key_field):
+        from shared.local_cosmos import LocalContainer
+        with self._lock:
+            if name not in self._containers:
+                self._containers[name] = LocalContainer(name, partition_key_field, store=self.store)
+            return self._containers[name]
+
+    def container(self, name, partition_key_field):
+        """Container sincrono (ContainerProxy), con latenza e throttling del profilo "cosmos"."""
+        return ServiceProxy(self._local_container(name, partition_key_field), self.profiles["cosmos"])
+
+    def async_container(self, name, partition_key_field):
+        """Stesso container, con la facciata asincrona di azure.cosmos.aio."""
+        from shared.local_cosmos import LocalAsyncContainer
+        return ServiceProxy(LocalAsyncContainer(self._local_container(name, partition_key_field)),
+                            self.profiles["cosmos"])
+
+    def _write_documents(self, value):
+        """Binding di output Cosmos: Document o DocumentList → upsert (una chiamata per flush del binding)."""
+        from shared.cosmos_client import CONTAINER_NAME, get_partition_key_field
+        self.profiles["cosmos"].call("output_binding")
+        docs = [value] if isinstance(value, dict) or hasattr(value, "to_dict") else list(value)  # DocumentList
+        container = self._local_container(CONTAINER_NAME, get_partition_key_field())
+        for doc in docs:
+            container.upsert_item(doc.to_dict() if hasattr(doc, "to_dict") else dict(doc))
+        self.documents_written += len(docs)
+
+    # --- advice-queue ---
+
+    def _enqueue_advice(self, value):
+        for content in value if isinstance(value, (list, tuple)) else [value]:
+            self.advice_queue.put(content)
+
+    async def _deliver_advice(self, message):
+        """Come il queue trigger: GenerateAdvice (async o sincrono in un thread) con un binding SignalR locale."""
+        import azure.functions as func
+        from blueprints import advice
+        msg = func.QueueMessage(id=message.id, body=message.content.encode("utf-8"))
+        signalr = LocalOut(self.signalr.record)
+        if advice.ADVICE_ASYNC:
+            await advice.generate_advice_async(msg, signalr)
+        else:
+            await asyncio.to_thread(advice.generate_advice, msg, signalr)
+
+    def bindings(self):
+        """(outputDocuments, signalRMessages, adviceQueue) per un'invocazione di ProcessTelemetry."""
+        return LocalOut(self._write_documents), LocalOut(self.signalr.record), LocalOut(self._enqueue_advice)
+
+    def stats(self):
+        with self._lock:
+            containers = {name: len(container.all_items()) for name, container in self._containers.items()}
+        return {
+            "cosmos": {**self.profiles["cosmos"].stats(), "documents_written": self.documents_written,
+                       "containers": containers, "persistent": self.store is not None},
+            "queue": {**self.profiles["queue"].stats(), **self.advice_queue.stats()},
+            "signalr": {**self.profiles["signalr"].stats(), **self.signalr.stats()},
+            "c2d": {**self.profiles["c2d"].stats(), **self.c2d.stats()},
+        }
+
+    def close(self, timeout=30.0):
+        """Attende lo svuotamento di advice-queue (al massimo timeout secondi) e ferma l'event loop locale."""
+        drained = self.advice_queue.join(timeout)
+        self.advice_queue.close()
+        return drained
+
+
+_backend = None
+_init_lock = threading.Lock()
+
+def get_local_backend():
+    """Lazy singleton: None se LOCAL_BACKEND non è attivo."""
+    global _backend
+    if _backend is None and LOCAL_BACKEND:
+        with _init_lock:
+            if _backend is None:
+                _backend = LocalBackend()
+                logging.info("🧪 Local backend enabled: Cosmos, advice-queue, SignalR and C2D are in-process"
+                             + (f" (Cosmos persisted to {LOCAL_COSMOS_PATH})" if LOCAL_COSMOS_PATH else ""))
+    return _backend
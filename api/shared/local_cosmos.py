@@ -0,0 +1,582 @@
+import copy
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosBatchOperationError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+logger = logging.getLogger(__name__)
+
+# =============================================================================
+# Stand-in locale di un container Cosmos DB (in memoria, nessuna rete)
+# Replica la superficie di ContainerProxy usata dal backend, per esercitare
+# i percorsi di codice (patch, batch transazionali, fallback) senza Azure.
+# =============================================================================
+
+_UNDEFINED = object()
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<number>-?\d+(?:\.\d+)?)
+      | '(?P<string>(?:[^'\\]|\\.)*)'
+      | "(?P<dstring>(?:[^"\\]|\\.)*)"
+      | (?P<param>@\w+)
+      | (?P<op><=|>=|!=|<>|=|<|>|\(|\)|,|\*)
+      | (?P<name>[A-Za-z_][\w.]*)
+    )""", re.VERBOSE)
+
+
+def _tokenize(text):
+    tokens, pos = [], 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f"Unsupported query syntax near: {text[pos:pos + 20]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "dstring":
+            kind = "string"
+        tokens.append((kind, value))
+    return tokens
+
+
+def _resolve(doc, path):
+    """Risolve un riferimento tipo `c.a.b` sul documento (alias iniziale ignorato)."""
+    value = doc
+    for part in path.split(".")[1:]:
+        if not isinstance(value, dict) or part not in value:
+            return _UNDEFINED
+        value = value[part]
+    return value
+
+
+def _compare(op, left, right):
+    if left is _UNDEFINED or right is _UNDEFINED:
+        return False
+    if op == "=":
+        return left == right
+    if op in ("!=", "<>"):
+        return left != right
+    try:
+        return {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[op]
+    except TypeError:
+        return False
+
+
+class _ExprParser:
+    """Parser ricorsivo per le espressioni WHERE: confronti, AND/OR/NOT, IS_DEFINED, parametri @."""
+
+    def __init__(self, tokens, params):
+        self.tokens = tokens
+        self.params = params
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def keyword(self, word):
+        kind, value = self.peek()
+        if kind == "name" and value.upper() == word:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, op):
+        kind, value = self.peek()
+        if kind != "op" or value != op:
+            raise ValueError(f"Expected {op!r}, got {value!r}")
+        self.pos += 1
+
+    def parse(self):
+        return self.parse_or()
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.keyword("OR"):
+            right = self.parse_and()
+            left = (lambda l, r: lambda d: l(d) or r(d))(left, right)
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.keyword("AND"):
+            right = self.parse_not()
+            left = (lambda l, r: lambda d: l(d) and r(d))(left, right)
+        return left
+
+    def parse_not(self):
+        if self.keyword("NOT"):
+            inner = self.parse_not()
+            return lambda d: not inner(d)
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_operand()
+        kind, value = self.peek()
+        if kind == "op" and value in ("=", "!=", "<>", "<", "<=", ">", ">="):
+            self.pos += 1
+            right = self.parse_operand()
+            return (lambda l, r, op: lambda d: _compare(op, l(d), r(d)))(left, right, value)
+        return lambda d: left(d) is True
+
+    def parse_operand(self):
+        kind, value = self.peek()
+        self.pos += 1
+        if kind == "op" and value == "(":
+            inner = self.parse_or()
+            self.expect(")")
+            return inner
+        if kind in ("number", "string"):
+            return lambda d: value
+        if kind == "param":
+            if value not in self.params:
+                raise ValueError(f"Missing query parameter {value}")
+            param = self.params[value]
+            return lambda d: param
+        if kind == "name":
+            upper = value.upper()
+            if upper == "IS_DEFINED":
+                self.expect("(")
+                inner = self.parse_operand()
+                self.expect(")")
+                return lambda d: inner(d) is not _UNDEFINED
+            if upper in ("TRUE", "FALSE", "NULL"):
+                literal = {"TRUE": True, "FALSE": False, "NULL": None}[upper]
+                return lambda d: literal
+            return lambda d: _resolve(d, value)
+        raise ValueError(f"Unexpected token {value!r}")
+
+
+def compile_predicate(text, parameters=None):
+    """Compila `FROM c WHERE <expr>` (o solo `<expr>`) in una funzione doc -> bool."""
+    params = {p["name"]: p["value"] for p in (parameters or [])}
+    tokens = _tokenize(text)
+    if tokens and tokens[0][0] == "name" and tokens[0][1].upper() == "FROM":
+        tokens = tokens[2:]  # FROM <alias>
+    if tokens and tokens[0][0] == "name" and tokens[0][1].upper() == "WHERE":
+        tokens = tokens[1:]
+    if not tokens:
+        return lambda d: True
+    parser = _ExprParser(tokens, params)
+    predicate = parser.parse()
+    if parser.pos != len(tokens):
+        raise ValueError(f"Unexpected trailing tokens: {tokens[parser.pos:]}")
+    return predicate
+
+
+def _sort_key(value):
+    """Ordinamento misto come Cosmos: undefined < null < bool < numeri < stringhe."""
+    if value is _UNDEFINED:
+        return (0, 0)
+    if value is None:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (2, value)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    return (4, str(value))
+
+
+class _Query:
+    """Query compilata: SELECT [DISTINCT] (* | c.a, c.b) FROM c [WHERE expr] [ORDER BY c.x [ASC|DESC]]
+    [OFFSET n LIMIT m] (n e m letterali o parametri @)."""
+
+    def __init__(self, text, parameters=None):
+        params = {p["name"]: p["value"] for p in (parameters or [])}
+        tokens = _tokenize(text)
+        parser = _ExprParser(tokens, params)
+        if not parser.keyword("SELECT"):
+            raise ValueError("Query must start with SELECT")
+        self.distinct = parser.keyword("DISTINCT")
+
+        self.fields = None  # None = SELECT *
+        if parser.peek() == ("op", "*"):
+            parser.pos += 1
+        else:
+            self.fields = []
+            while True:
+                kind, value = parser.peek()
+                if kind != "name":
+                    raise ValueError(f"Unsupported projection near {value!r}")
+                parser.pos += 1
+                self.fields.append(value)
+                if parser.peek() != ("op", ","):
+                    break
+                parser.pos += 1
+
+        if not parser.keyword("FROM"):
+            raise ValueError("Expected FROM")
+        parser.pos += 1  # alias
+        self.predicate = parser.parse() if parser.keyword("WHERE") else (lambda d: True)
+
+        self.order = None
+        if parser.keyword("ORDER"):
+            if not parser.keyword("BY"):
+                raise ValueError("Expected BY after ORDER")
+            kind, field = parser.peek()
+            parser.pos += 1
+            descending = parser.keyword("DESC")
+            if not descending:
+                parser.keyword("ASC")
+            self.order = (field, descending)
+
+        self.offset, self.limit = 0, None
+        if parser.keyword("OFFSET"):
+            self.offset = self._count(parser, "OFFSET")
+            if not parser.keyword("LIMIT"):
+                raise ValueError("Expected LIMIT after OFFSET")
+            self.limit = self._count(parser, "LIMIT")
+        if parser.pos != len(tokens):
+            raise ValueError(f"Unexpected trailing tokens: {tokens[parser.pos:]}")
+
+    @staticmethod
+    def _count(parser, clause):
+        kind, value = parser.peek()
+        parser.pos += 1
+        if kind == "param":
+            if value not in parser.params:
+                raise ValueError(f"Missing query parameter {value}")
+            value = parser.params[value]
+        elif kind != "number":
+            raise ValueError(f"Expected a number after {clause}, got {value!r}")
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError(f"{clause} must be a non-negative integer")
+        return value
+
+    def _project(self, doc):
+        if self.fields is None:
+            return copy.deepcopy(doc)
+        row = {}
+        for field in self.fields:
+            value = _resolve(doc, field)
+            if value is not _UNDEFINED:
+                row[field.split(".")[-1]] = copy.deepcopy(value)
+        return row
+
+    def run(self, docs):
+        matched = [doc for doc in docs if self.predicate(doc)]
+        if self.order:
+            field, descending = self.order
+            matched.sort(key=lambda d: _sort_key(_resolve(d, field)), reverse=descending)
+        rows = [self._project(doc) for doc in matched]
+        if self.distinct:
+            seen, unique = set(), []
+            for row in rows:
+                marker = repr(sorted(row.items()))
+                if marker not in seen:
+                    seen.add(marker)
+                    unique.append(row)
+            rows = unique
+        if self.offset or self.limit is not None:
+            end = None if self.limit is None else self.offset + self.limit
+            rows = rows[self.offset:end]
+        return rows
+
+
+class _LocalPager:
+    """Iteratore di pagine con continuation_token, come ItemPaged.by_page()."""
+
+    def __init__(self, rows, page_size, continuation):
+        self._rows = rows
+        self._page_size = page_size
+        self._offset = int(continuation) if continuation else 0
+        self._done = False
+        self.continuation_token = continuation
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        page = self._rows[self._offset:self._offset + self._page_size]
+        self._offset += len(page)
+        self._done = self._offset >= len(self._rows)
+        self.continuation_token = None if self._done else str(self._offset)
+        return iter(page)
+
+
+class _LocalItemPaged:
+    """Risultato di query_items: iterabile sui documenti o, con by_page(), sulle pagine."""
+
+    def __init__(self, rows, page_size):
+        self._rows = rows
+        self._page_size = page_size or 100
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def by_page(self, continuation_token=None):
+        return _LocalPager(self._rows, self._page_size, continuation_token)
+
+
+def _apply_patch(doc, operations):
+    for operation in operations:
+        op = operation["op"].lower()
+        keys = [k for k in operation["path"].split("/") if k]
+        target = doc
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        leaf = keys[-1]
+        if op in ("set", "add", "replace"):
+            if op == "replace" and leaf not in target:
+                raise CosmosHttpResponseError(status_code=400, message=f"Path {operation['path']} not found")
+            target[leaf] = operation["value"]
+        elif op == "remove":
+            target.pop(leaf, None)
+        elif op == "incr":
+            target[leaf] = target.get(leaf, 0) + operation["value"]
+        else:
+            raise CosmosHttpResponseError(status_code=400, message=f"Unsupported patch op {op}")
+
+
+class SQLiteItemStore:
+    """Persistenza opzionale dei container locali su file SQLite: i dati sopravvivono al riavvio del processo.
+    Le query restano in memoria; il file riceve solo le scritture (write-through)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "container TEXT NOT NULL, pk TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, "
+                "PRIMARY KEY (container, pk, id))"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # Una connessione per thread: sqlite3 non condivide connessioni tra thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, container: str):
+        rows = self._conn().execute("SELECT body FROM items WHERE container = ?", (container,)).fetchall()
+        return [json.loads(body) for (body,) in rows]
+
+    def write(self, container: str, changes):
+        """Applica in una transazione [(pk, id, doc | None)]; None = cancellazione."""
+        with self._conn() as conn:
+            for pk, item_id, doc in changes:
+                if doc is None:
+                    conn.execute("DELETE FROM items WHERE container = ? AND pk = ? AND id = ?",
+                                 (container, json.dumps(pk), item_id))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO items (container, pk, id, body) VALUES (?, ?, ?, ?)",
+                                 (container, json.dumps(pk), item_id, json.dumps(doc)))
+
+
+class LocalContainer:
+    """Container Cosmos in memoria. `supports_patch=False` simula un account/SDK senza patch
+    (HTTP 501), per esercitare il fallback read+upsert. `calls` conta i round-trip per operazione.
+    Con `store` (SQLiteItemStore) il contenuto viene caricato all'avvio e ogni scrittura è persistita."""
+
+    def __init__(self, container_id="Telemetry", partition_key_field="id", supports_patch=True, store=None):
+        self.id = container_id
+        self.partition_key_field = partition_key_field
+        self.supports_patch = supports_patch
+        self.store = store
+        self.calls = Counter()
+        self._items = {}  # (partition_key, id) -> doc
+        self._lock = threading.RLock()
+        if store is not None:
+            for doc in store.load(container_id):
+                self._items[self._key(doc["id"], self._pk_of(doc))] = doc
+
+    # --- Metadati ---
+
+    def read(self, **kwargs):
+        self.calls["read"] += 1
+        return {"id": self.id, "partitionKey": {"paths": [f"/{self.partition_key_field}"], "kind": "Hash"}}
+
+    def _key(self, item_id, partition_key):
+        return (partition_key, item_id)
+
+    def _pk_of(self, body):
+        return body.get(self.partition_key_field)
+
+    def _stamp(self, doc):
+        doc["_etag"] = f'"{uuid.uuid4()}"'
+        doc["_ts"] = int(time.time())
+        return doc
+
+    def _commit(self, changes):
+        """Applica {chiave: doc | None} in memoria e, se configurato, sul file SQLite (lock già acquisito)."""
+        for key, doc in changes.items():
+            if doc is None:
+                self._items.pop(key, None)
+            else:
+                self._items[key] = doc
+        if self.store is not None:
+            self.store.write(self.id, [(pk, item_id, doc) for (pk, item_id), doc in changes.items()])
+
+    # --- CRUD ---
+
+    def read_item(self, item, partition_key, **kwargs):
+        self.calls["read_item"] += 1
+        with self._lock:
+            doc = self._items.get(self._key(item, partition_key))
+            if doc is None:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+            return copy.deepcopy(doc)
+
+    def create_item(self, body, **kwargs):
+        self.calls["create_item"] += 1
+        with self._lock:
+            key = self._key(body["id"], self._pk_of(body))
+            if key in self._items:
+                raise CosmosResourceExistsError(status_code=409, message=f"Item {body['id']} already exists")
+            self._commit({key: self._stamp(copy.deepcopy(body))})
+            return copy.deepcopy(self._items[key])
+
+    def upsert_item(self, body, **kwargs):
+        self.calls["upsert_item"] += 1
+        with self._lock:
+            key = self._key(body["id"], self._pk_of(body))
+            self._commit({key: self._stamp(copy.deepcopy(body))})
+            return copy.deepcopy(self._items[key])
+
+    def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        self.calls["replace_item"] += 1
+        with self._lock:
+            key = self._key(item, self._pk_of(body))
+            existing = self._items.get(key)
+            if existing is None:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+            if etag is not None and match_condition is not None and existing.get("_etag") != etag:
+                raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            self._commit({key: self._stamp(copy.deepcopy(body))})
+            return copy.deepcopy(self._items[key])
+
+    def delete_item(self, item, partition_key, **kwargs):
+        self.calls["delete_item"] += 1
+        with self._lock:
+            key = self._key(item, partition_key)
+            if key not in self._items:
+                raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+            self._commit({key: None})
+
+    # --- Patch e batch transazionali ---
+
+    def _patch_locked(self, item, partition_key, patch_operations, filter_predicate=None):
+        key = self._key(item, partition_key)
+        doc = self._items.get(key)
+        if doc is None:
+            raise CosmosResourceNotFoundError(status_code=404, message=f"Item {item} not found")
+        if filter_predicate and not compile_predicate(filter_predicate)(doc):
+            raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+        patched = copy.deepcopy(doc)
+        _apply_patch(patched, patch_operations)
+        return key, self._stamp(patched)
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, **kwargs):
+        self.calls["patch_item"] += 1
+        if not self.supports_patch:
+            raise CosmosHttpResponseError(status_code=501, message="Patch not supported by local container")
+        with self._lock:
+            key, patched = self._patch_locked(item, partition_key, patch_operations, filter_predicate)
+            self._commit({key: patched})
+            return copy.deepcopy(patched)
+
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        """Tutte le operazioni riescono o nessuna viene applicata (semantica transazionale)."""
+        self.calls["execute_item_batch"] += 1
+        if not self.supports_patch:
+            raise CosmosHttpResponseError(status_code=501, message="Batch not supported by local container")
+        with self._lock:
+            staged = {}
+            responses = []
+            for index, operation in enumerate(batch_operations):
+                kind, args = operation[0], operation[1]
+                options = operation[2] if len(operation) > 2 else {}
+                try:
+                    if kind == "patch":
+                        item_id, ops = args
+                        key, patched = self._patch_locked(item_id, partition_key, ops, options.get("filter_predicate"))
+                        staged[key] = patched
+                    elif kind in ("upsert", "create"):
+                        body = args[0]
+                        key = self._key(body["id"], partition_key)
+                        if kind == "create" and key in self._items:
+                            raise CosmosResourceExistsError(status_code=409, message="Conflict")
+                        staged[key] = self._stamp(copy.deepcopy(body))
+                    elif kind == "delete":
+                        key = self._key(args[0], partition_key)
+                        if key not in self._items:
+                            raise CosmosResourceNotFoundError(status_code=404, message="Not found")
+                        staged[key] = None
+                    else:
+                        raise CosmosHttpResponseError(status_code=400, message=f"Unsupported batch op {kind}")
+                    responses.append({"statusCode": 200})
+                except CosmosHttpResponseError as e:
+                    raise CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=e.status_code,
+                        message=f"Batch operation {index} failed: {e.message}",
+                        operation_responses=responses + [{"statusCode": e.status_code}],
+                    )
+            self._commit(staged)
+            return responses
+
+    # --- Query ---
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, **kwargs):
+        """Sottoinsieme del SQL di Cosmos usato dal backend (vedi _Query). I risultati sono fotografati
+        al momento della chiamata; i continuation token sono offset nel risultato."""
+        self.calls["query_items"] += 1
+        compiled = _Query(query, parameters)
+        with self._lock:
+            docs = [doc for (pk, _), doc in self._items.items() if partition_key is None or pk == partition_key]
+            rows = compiled.run(docs)
+        return _LocalItemPaged(rows, max_item_count)
+
+    # --- Utilità per test e benchmark ---
+
+    def all_items(self):
+        with self._lock:
+            return [copy.deepcopy(doc) for doc in self._items.values()]
+
+
+class LocalAsyncContainer:
+    """Facciata asincrona (stessa API di azure.cosmos.aio) sopra un LocalContainer."""
+
+    def __init__(self, container: LocalContainer):
+        self.sync = container
+
+    async def read(self, **kwargs):
+        return self.sync.read(**kwargs)
+
+    async def read_item(self, item, partition_key, **kwargs):
+        return self.sync.read_item(item, partition_key, **kwargs)
+
+    async def upsert_item(self, body, **kwargs):
+        return self.sync.upsert_item(body, **kwargs)
+
+    async def replace_item(self, item, body, **kwargs):
+        return self.sync.replace_item(item, body, **kwargs)
+
+    async def delete_item(self, item, partition_key, **kwargs):
+        return self.sync.delete_item(item, partition_key, **kwargs)
+
+    async def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        return self.sync.patch_item(item, partition_key, patch_operations, **kwargs)
+
+    async def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        return self.sync.execute_item_batch(batch_operations, partition_key, **kwargs)
@@ -0,0 +1,235 @@
+import datetime
+import logging
+import math
+import os
+import threading
+import time
+from typing import Optional
+
+from shared.rules import ALERT_LEVELS, classify
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+ROLLUPS_ENABLED = os.environ.get("ROLLUPS_ENABLED", "true").lower() == "true"
+ROLLUP_GRACE_SEC = float(os.environ.get("ROLLUP_GRACE_SEC", "30"))          # attesa dopo la chiusura del bucket
+ROLLUP_FLUSH_SEC = float(os.environ.get("ROLLUP_FLUSH_SEC", "15"))          # intervallo minimo tra due flush
+ROLLUP_RPM_THRESHOLD = float(os.environ.get("ROLLUP_RPM_THRESHOLD", "3000"))
+ROLLUP_MAX_GAP_SEC = float(os.environ.get("ROLLUP_MAX_GAP_SEC", "30"))      # gap oltre cui il veicolo è considerato fermo
+
+GRANULARITIES = {"minute": 60, "hour": 3600}
+METRICS = ("speed", "rpm", "fuel_level")
+METRIC_DEFAULTS = {"speed": 0, "rpm": 0, "fuel_level": 100}
+RPM_BINS = (1000, 2000, 3000, 4000, 5000)  # limiti superiori; l'ultimo bin è "5000+"
+
+
+def _rpm_bin(rpm):
+    lower = 0
+    for upper in RPM_BINS:
+        if rpm < upper:
+            return f"{lower}-{upper}"
+        lower = upper
+    return f"{lower}+"
+
+
+def _metric(doc, field):
+    """Valore numerico della metrica (null/assente → default). ValueError se non numerico o non finito."""
+    value = doc.get(field)
+    if value is None:
+        return METRIC_DEFAULTS[field]
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f"Invalid {field}: {value!r}")
+    return value
+
+
+def _iso(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).isoformat()
+
+
+def _empty_rollup(vehicle_id, granularity, start):
+    size = GRANULARITIES[granularity]
+    return {
+        "id": f"{vehicle_id}:{granularity}:{int(start)}",
+        "vehicle_id": vehicle_id,
+        "granularity": granularity,
+        "bucket_start": _iso(start),
+        "bucket_end": _iso(start + size),
+        "count": 0,
+        **{metric: {"sum": 0.0, "min": None, "max": None, "avg": None} for metric in METRICS},
+        "rpm_histogram": {},
+        "time_over_rpm_sec": 0.0,
+        "fuel_burned": 0.0,
+        "fuel_burn_rate_per_hour": 0.0,
+        "alerts": {level: 0 for level in ALERT_LEVELS},
+    }
+
+
+def _finalize(rollup):
+    """Ricalcola i campi derivati (medie e tasso di consumo)."""
+    count = rollup["count"]
+    for metric in METRICS:
+        stat = rollup[metric]
+        stat["avg"] = round(stat["sum"] / count, 2) if count else None
+    size = GRANULARITIES[rollup["granularity"]]
+    rollup["fuel_burn_rate_per_hour"] = round(rollup["fuel_burned"] * 3600.0 / size, 3)
+    return rollup
+
+
+def merge_rollups(base, other):
+    """Unisce due rollup dello stesso veicolo/bucket (es. flush tardivo su un documento già scritto)."""
+    base["count"] += other["count"]
+    for metric in METRICS:
+        a, b = base[metric], other[metric]
+        a["sum"] += b["sum"]
+        a["min"] = b["min"] if a["min"] is None else (a["min"] if b["min"] is None else min(a["min"], b["min"]))
+        a["max"] = b["max"] if a["max"] is None else (a["max"] if b["max"] is None else max(a["max"], b["max"]))
+    for label, n in other["rpm_histogram"].items():
+        base["rpm_histogram"][label] = base["rpm_histogram"].get(label, 0) + n
+    for level, n in other["alerts"].items():
+        base["alerts"][level] = base["alerts"].get(level, 0) + n
+    base["time_over_rpm_sec"] = round(base["time_over_rpm_sec"] + other["time_over_rpm_sec"], 3)
+    base["fuel_burned"] = round(base["fuel_burned"] + other["fuel_burned"], 3)
+    return _finalize(base)
+
+
+class RollupAggregator:
+    """Aggregati incrementali per veicolo e bucket (minuto/ora): count, sum/min/max, istogramma RPM,
+    tempo sopra soglia RPM, carburante consumato e conteggio alert. I bucket chiusi vengono scritti
+    come documenti compatti nel container Rollups."""
+
+    def __init__(self, grace: float = ROLLUP_GRACE_SEC, flush_interval: float = ROLLUP_FLUSH_SEC,
+                 rpm_threshold: float = ROLLUP_RPM_THRESHOLD, max_gap: float = ROLLUP_MAX_GAP_SEC):
+        self.grace = grace
+        self.flush_interval = flush_interval
+        self.rpm_threshold = rpm_threshold
+        self.max_gap = max_gap
+        self._open = {}        # (vehicle_id, granularity, start) -> rollup
+        self._last = {}        # vehicle_id -> (epoch, fuel_level) dell'ultima lettura
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self.events = 0
+        self.flushed = 0
+        self.merged = 0
+
+    def add(self, doc: dict, epoch: Optional[float] = None, alert_level: Optional[str] = None):
+        """Aggiunge una lettura telemetrica agli aggregati aperti (alert_level se già classificata).
+        ValueError se la lettura non è valida: i campi sono verificati prima di toccare i bucket,
+        che non restano mai aggiornati a metà."""
+        vehicle_id = doc.get("vehicle_id")
+        if not vehicle_id:
+            return
+        if epoch is None:
+            epoch = datetime.datetime.fromisoformat(doc["timestamp"]).timestamp()
+        speed, rpm, fuel_level = (_metric(doc, metric) for metric in METRICS)
+        if alert_level is None:
+            alert_level = classify(speed, rpm, fuel_level).alert_level
+        if alert_level not in ALERT_LEVELS:
+            raise ValueError(f"Invalid alert_level: {alert_level!r}")
+        rpm_label = _rpm_bin(rpm)
+
+        with self._lock:
+            self.events += 1
+            # Tempo e carburante rispetto alla lettura precedente dello stesso veicolo
+            gap, burned = 0.0, 0.0
+            previous = self._last.get(vehicle_id)
+            if previous is not None and 0 < epoch - previous[0] <= self.max_gap:
+                gap = epoch - previous[0]
+                burned = max(previous[1] - fuel_level, 0.0)  # i rifornimenti non contano come consumo
+            if previous is None or epoch >= previous[0]:
+                self._last[vehicle_id] = (epoch, fuel_level)
+
+            for granularity, size in GRANULARITIES.items():
+                start = epoch // size * size
+                key = (vehicle_id, granularity, start)
+                rollup = self._open.get(key)
+                if rollup is None:
+                    rollup = self._open[key] = _empty_rollup(vehicle_id, granularity, start)
+                rollup["count"] += 1
+                for metric, value in zip(METRICS, (speed, rpm, fuel_level)):
+                    stat = rollup[metric]
+                    stat["sum"] += value
+                    stat["min"] = value if stat["min"] is None else min(stat["min"], value)
+                    stat["max"] = value if stat["max"] is None else max(stat["max"], value)
+                rollup["rpm_histogram"][rpm_label] = rollup["rpm_histogram"].get(rpm_label, 0) + 1
+                rollup["alerts"][alert_level] += 1
+                if rpm > self.rpm_threshold:
+                    rollup["time_over_rpm_sec"] = round(rollup["time_over_rpm_sec"] + gap, 3)
+                rollup["fuel_burned"] = round(rollup["fuel_burned"] + burned, 3)
+
+    def _take_closed(self, now: float, force: bool = False):
+        with self._lock:
+            closed = [key for key in self._open if force or now >= key[2] + GRANULARITIES[key[1]] + self.grace]
+            return [_finalize(self._open.pop(key)) for key in closed]
+
+    def flush_due(self, container, force: bool = False) -> int:
+        """Scrive i bucket chiusi (al massimo una volta ogni flush_interval, salvo force)."""
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_flush < self.flush_interval:
+                return 0
+            self._last_flush = now
+        rollups = self._take_closed(now, force)
+        for rollup in rollups:
+            try:
+                self._write(container, rollup)
+            except Exception as e:
+                logger.warning(f"⚠️ Could not write rollup {rollup['id']}: {e}")
+        with self._lock:
+            self.flushed += len(rollups)
+        return len(rollups)
+
+    def _write(self, container, rollup):
+        """create_item nel caso comune; se il bucket esiste già (dati tardivi) merge con controllo etag."""
+        from azure.core import MatchConditions
+        from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
+
+        for _ in range(3):
+            try:
+                existing = container.read_item(item=rollup["id"], partition_key=rollup["vehicle_id"])
+            except CosmosResourceNotFoundError:
+                existing = None
+            if existing is None:
+                try:
+                    container.create_item(rollup)
+                    return
+                except CosmosResourceExistsError:
+                    continue  # creato nel frattempo da un'altra istanza: si rilegge e si unisce
+            merged = merge_rollups({k: v for k, v in existing.items() if not k.startswith("_")}, rollup)
+            try:
+                container.replace_item(item=rollup["id"], body=merged,
+                                       etag=existing.get("_etag"), match_condition=MatchConditions.IfNotModified)
+                with self._lock:
+                    self.merged += 1
+                return
+            except CosmosAccessConditionFailedError:
+                continue  # scrittura concorrente: si rilegge e si riprova
+        raise RuntimeError(f"Rollup {rollup['id']} contended, giving up")
+
+    def forget(self, vehicle_id: Optional[str] = None):
+        """Scarta gli aggregati aperti di un veicolo (o di tutti) dopo una cancellazione admin."""
+        with self._lock:
+            for key in [k for k in self._open if vehicle_id is None or k[0] == vehicle_id]:
+                del self._open[key]
+            if vehicle_id is None:
+                self._last.clear()
+            else:
+                self._last.pop(vehicle_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"open_buckets": len(self._open), "events": self.events,
+                    "flushed": self.flushed, "merged": self.merged}
+
+
+# --- Singleton ---
+
+_aggregator = None
+
+def get_rollup_aggregator() -> Optional[RollupAggregator]:
+    """Lazy singleton: None se disabilitato via ROLLUPS_ENABLED."""
+    global _aggregator
+    if _aggregator is None and ROLLUPS_ENABLED:
+        _aggregator = RollupAggregator()
+        logger.info(f"✅ Rollup aggregator initialized (granularities: {', '.join(GRANULARITIES)})")
+    return _aggregator
@@ -0,0 +1,69 @@
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from shared.rules import DEFAULT_RULE, FIELDS, Rule, resolve_rules
+
+logger = logging.getLogger(__name__)
+
+_NP_OPS = {">": np.greater, ">=": np.greater_equal, "<": np.less, "<=": np.less_equal}
+
+# Valori di default dei campi mancanti (come nel resto della pipeline)
+DEFAULTS = {"speed": 0.0, "rpm": 0.0, "fuel_level": 100.0}
+
+
+class RuleEngine:
+    """Valutazione vettorizzata delle regole di shared/rules.py su interi batch (array NumPy di
+    speed/rpm/fuel_level). Restituisce indici nella tabella `rules` (l'ultima voce è la regola di
+    default), così i Rule e gli advice derivati vengono condivisi invece di essere ricostruiti."""
+
+    def __init__(self, priority: Optional[Iterable[str]] = None, thresholds: Optional[Dict[str, float]] = None):
+        self._specs = resolve_rules(priority, thresholds)
+        self.rules = tuple(rule for rule, _ in self._specs) + (DEFAULT_RULE,)
+        self.rule_ids = tuple(rule.rule_id for rule in self.rules)
+        self.default_index = len(self.rules) - 1
+
+    def evaluate(self, speed, rpm, fuel_level) -> np.ndarray:
+        """Indice della prima regola applicabile per ogni riga (uint8)."""
+        columns = (np.asarray(speed, dtype=np.float64), np.asarray(rpm, dtype=np.float64),
+                   np.asarray(fuel_level, dtype=np.float64))
+        result = np.full(columns[0].shape, self.default_index, dtype=np.uint8)
+        # Dalla priorità più bassa alla più alta: le regole più importanti sovrascrivono
+        for index in range(len(self._specs) - 1, -1, -1):
+            _, conditions = self._specs[index]
+            mask = None
+            for field, op, threshold in conditions:
+                hit = _NP_OPS[op](columns[field], threshold)
+                mask = hit if mask is None else mask & hit
+            result[mask] = index
+        return result
+
+    def evaluate_docs(self, docs: List[dict]) -> np.ndarray:
+        """Come evaluate, su una lista di documenti telemetrici."""
+        count = len(docs)
+        columns = [np.fromiter((doc.get(field, DEFAULTS[field]) for doc in docs), dtype=np.float64, count=count)
+                   for field in FIELDS]
+        return self.evaluate(*columns)
+
+    def classify_docs(self, docs: List[dict]) -> List[Rule]:
+        rules = self.rules
+        return [rules[i] for i in self.evaluate_docs(docs).tolist()]
+
+    def counts(self, indices: np.ndarray) -> Dict[str, int]:
+        """Numero di righe per regola."""
+        counts = np.bincount(indices, minlength=len(self.rules))
+        return {rule_id: int(n) for rule_id, n in zip(self.rule_ids, counts)}
+
+
+# --- Singleton ---
+
+_engine = None
+
+def get_rule_engine() -> RuleEngine:
+    """Lazy singleton con soglie e priorità delle Application Settings (RULE_*)."""
+    global _engine
+    if _engine is None:
+        _engine = RuleEngine()
+        logger.info(f"✅ Rule engine initialized (priority: {', '.join(_engine.rule_ids[:-1])})")
+    return _engine
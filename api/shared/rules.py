@@ -0,0 +1,76 @@
+import operator
+import os
+from collections import namedtuple
+
+# --- Regole di guida (pure Python, nessuna dipendenza pesante) ---
+# Usate dal fallback di ai_advisor e dal gate di cambio stato in ProcessTelemetry.
+# Le regole sono dichiarative (condizioni in AND su soglie con nome): la stessa tabella alimenta
+# classify() per la singola lettura e il motore vettorizzato di shared/rule_engine.py per i batch.
+
+Rule = namedtuple("Rule", ["rule_id", "advice", "alert_level"])
+
+ALERT_LEVELS = ("INFO", "WARN", "CRITICAL")  # in ordine di gravità crescente
+
+OVERSPEED = Rule("overspeed", "Stai superando i limiti. Rallenta per sicurezza e consumi.", "CRITICAL")
+FUEL_EMPTY = Rule("fuel_empty", "Carburante quasi esaurito! Fermati al primo distributore.", "CRITICAL")
+HIGH_RPM = Rule("high_rpm", "Giri troppo alti! Cambia marcia per risparmiare carburante.", "WARN")
+IDLING = Rule("idling", "Sei fermo o quasi. Spegni il motore se la sosta è lunga.", "WARN")
+OPTIMAL = Rule("optimal", "Guida ottimale. Continua così!", "INFO")
+
+DEFAULT_RULE = OPTIMAL  # nessuna regola applicabile
+
+# Soglie configurabili (Application Settings)
+THRESHOLDS = {
+    "overspeed_kmh": float(os.environ.get("RULE_OVERSPEED_KMH", "130")),
+    "fuel_empty_pct": float(os.environ.get("RULE_FUEL_EMPTY_PCT", "5")),
+    "high_rpm": float(os.environ.get("RULE_HIGH_RPM", "3000")),
+    "idling_speed_kmh": float(os.environ.get("RULE_IDLING_SPEED_KMH", "10")),
+    "idling_rpm": float(os.environ.get("RULE_IDLING_RPM", "1000")),
+}
+
+# Campi valutati, nell'ordine degli argomenti di classify()
+FIELDS = ("speed", "rpm", "fuel_level")
+
+Condition = namedtuple("Condition", ["field", "op", "threshold"])
+RuleSpec = namedtuple("RuleSpec", ["rule", "conditions"])  # la regola si applica se tutte le condizioni sono vere
+
+RULE_SPECS = {
+    "overspeed": RuleSpec(OVERSPEED, (Condition("speed", ">", "overspeed_kmh"),)),
+    "fuel_empty": RuleSpec(FUEL_EMPTY, (Condition("fuel_level", "<", "fuel_empty_pct"),)),
+    "high_rpm": RuleSpec(HIGH_RPM, (Condition("rpm", ">", "high_rpm"),)),
+    "idling": RuleSpec(IDLING, (Condition("speed", "<", "idling_speed_kmh"), Condition("rpm", ">", "idling_rpm"))),
+}
+
+# Ordine di priorità (la prima regola applicabile vince), es. "fuel_empty,overspeed,high_rpm,idling"
+RULE_PRIORITY = tuple(r.strip() for r in os.environ.get("RULE_PRIORITY", ",".join(RULE_SPECS)).split(",") if r.strip())
+
+OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+
+def resolve_rules(priority=None, thresholds=None):
+    """Tabella delle regole in ordine di priorità: [(Rule, ((indice campo, op, valore soglia), ...))].
+    `thresholds` sovrascrive solo le soglie indicate."""
+    values = {**THRESHOLDS, **(thresholds or {})}
+    resolved = []
+    for rule_id in priority or RULE_PRIORITY:
+        if rule_id not in RULE_SPECS:
+            raise ValueError(f"Unknown rule: {rule_id}")
+        spec = RULE_SPECS[rule_id]
+        conditions = tuple((FIELDS.index(c.field), c.op, values[c.threshold]) for c in spec.conditions)
+        resolved.append((spec.rule, conditions))
+    return resolved
+
+
+_RULES = [(rule, tuple((i, OPS[op], value) for i, op, value in conditions)) for rule, conditions in resolve_rules()]
+
+
+def classify(speed: float, rpm: float, fuel_level: float) -> Rule:
+    """Restituisce la prima regola che si applica ai dati telemetrici (in ordine di priorità)."""
+    values = (speed, rpm, fuel_level)
+    for rule, conditions in _RULES:
+        for index, op, threshold in conditions:
+            if not op(values[index], threshold):
+                break
+        else:
+            return rule
+    return DEFAULT_RULE
@@ -0,0 +1,131 @@
+"""Profilo del cold start: tempo e moduli importati da ogni fase dell'indicizzazione (function_app.py)
+e report del costo di import per modulo.
+
+    python -m shared.startup_profile [--module function_app] [--top 25]
+
+esegue l'import in un interprete pulito con `-X importtime` e stampa i moduli più costosi
+(tempo cumulativo e proprio) e il totale per package di primo livello."""
+
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# SDK pesanti che devono restare fuori dall'indicizzazione (caricati al primo uso o dal pre-warm)
+HEAVY_MODULES = (
+    "langchain_google_genai", "langchain_core", "azure.cosmos", "azure.identity",
+    "azure.iot.hub", "azure.storage.queue", "azure.storage.blob", "numpy", "pyarrow",
+)
+
+_PROCESS_START = time.perf_counter()
+
+
+class StartupProfile:
+    """Fasi dell'avvio del worker: durata e numero di moduli caricati da ciascuna."""
+
+    def __init__(self):
+        self.phases = []   # [{"name", "ms", "modules"}]
+        self.indexed_ms = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000.0
+            with self._lock:
+                self.phases.append({"name": name, "ms": round(elapsed_ms, 1),
+                                    "modules": len(sys.modules) - modules})
+
+    def finish(self):
+        """Indicizzazione completata: tempo dal primo import di questo modulo."""
+        self.indexed_ms = round((time.perf_counter() - _PROCESS_START) * 1000.0, 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "indexed_ms": self.indexed_ms,
+                "phases": list(self.phases),
+                "modules_loaded": len(sys.modules),
+                # True = SDK già caricato (dal primo uso o dal pre-warm)
+                "heavy_modules": {name: name in sys.modules for name in HEAVY_MODULES},
+            }
+
+
+_profile = StartupProfile()
+
+def get_startup_profile() -> StartupProfile:
+    return _profile
+
+
+# --- Report -X importtime ---
+
+_IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def parse_importtime(text: str) -> List[dict]:
+    """Righe di `python -X importtime` -> [{"module", "self_ms", "cumulative_ms", "depth"}]."""
+    rows = []
+    for line in text.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append({"module": module, "self_ms": int(self_us) / 1000.0,
+                         "cumulative_ms": int(cumulative_us) / 1000.0, "depth": (len(indent) - 1) // 2})
+    return rows
+
+
+def package_totals(rows: List[dict]) -> Dict[str, float]:
+    """Tempo proprio sommato per package di primo livello (es. azure.cosmos -> azure.cosmos, numpy.* -> numpy)."""
+    totals = {}
+    for row in rows:
+        parts = row["module"].split(".")
+        package = ".".join(parts[:2]) if parts[0] == "azure" and len(parts) > 1 else parts[0]
+        totals[package] = totals.get(package, 0.0) + row["self_ms"]
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+def profile_imports(module: str = "function_app", cwd: Optional[str] = None) -> List[dict]:
+    """Importa `module` in un interprete pulito con -X importtime e restituisce le righe del report."""
+    import subprocess
+    env = dict(os.environ, CLIENT_PREWARM_ENABLED="false")  # il pre-warm falserebbe le misure
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def format_report(rows: List[dict], top: int = 25) -> str:
+    total_ms = sum(row["cumulative_ms"] for row in rows if row["depth"] == 0)
+    lines = [f"Import totale: {total_ms:.0f} ms, {len(rows)} moduli", "",
+             f"Top {top} per tempo cumulativo (ms):"]
+    for row in sorted(rows, key=lambda r: r["cumulative_ms"], reverse=True)[:top]:
+        lines.append(f"  {row['cumulative_ms']:9.1f}  {'  ' * row['depth']}{row['module']}")
+    lines += ["", f"Top {top} package per tempo proprio (ms):"]
+    for package, ms in list(package_totals(rows).items())[:top]:
+        lines.append(f"  {ms:9.1f}  {package}")
+    loaded = {row["module"] for row in rows}
+    heavy = [name for name in HEAVY_MODULES if name in loaded]
+    lines += ["", "SDK pesanti importati all'avvio: " + (", ".join(heavy) if heavy else "nessuno")]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Costo di import per modulo dell'avvio del worker")
+    parser.add_argument("--module", default="function_app", help="modulo da importare (default: function_app)")
+    parser.add_argument("--top", type=int, default=25, help="righe per sezione")
+    args = parser.parse_args(argv)
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print(format_report(profile_imports(args.module, cwd=cwd), args.top))
+
+
+if __name__ == "__main__":
+    main()
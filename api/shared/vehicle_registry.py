@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from shared.cosmos_client import get_vehicles_container
+
+logger = logging.getLogger(__name__)
+
+# --- Configurazione ---
+
+REGISTRY_ENABLED = os.environ.get("VEHICLE_REGISTRY_ENABLED", "true").lower() == "true"
+REGISTRY_MIN_UPDATE_SEC = float(os.environ.get("VEHICLE_REGISTRY_MIN_UPDATE_SEC", "30"))  # scritture max per veicolo
+REGISTRY_CACHE_TTL_SEC = float(os.environ.get("VEHICLE_REGISTRY_CACHE_TTL_SEC", "15"))    # cache di lettura /vehicles
+
+
+class VehicleRegistry:
+    """Registro materializzato dei veicoli: un documento per veicolo con first/last seen,
+    ultimo snapshot telemetrico e ultimo alert level. Sostituisce il SELECT DISTINCT su Telemetry."""
+
+    def __init__(self, container, min_update_interval: float = REGISTRY_MIN_UPDATE_SEC,
+                 cache_ttl: float = REGISTRY_CACHE_TTL_SEC):
+        self.container = container
+        self.min_update_interval = min_update_interval
+        self.cache_ttl = cache_ttl
+        self._last_write = {}   # vehicle_id -> (monotonic, alert_level) dell'ultima scrittura
+        self._cache = None      # (expires_at, documenti)
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.skipped = 0
+
+    # --- Scrittura (ProcessTelemetry) ---
+
+    def record(self, doc: dict, alert_level: str) -> bool:
+        """Aggiorna il registro con l'ultima lettura del veicolo. Le scritture sono limitate a una ogni
+        min_update_interval per veicolo, salvo cambio di alert level. True se è stata fatta una scrittura."""
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+        vehicle_id = doc.get("vehicle_id")
+        if not vehicle_id:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_write.get(vehicle_id)
+            if last is not None and now - last[0] < self.min_update_interval and last[1] == alert_level:
+                self.skipped += 1
+                return False
+            self._last_write[vehicle_id] = (now, alert_level)
+
+        snapshot = {
+            "speed": doc.get("speed"),
+            "rpm": doc.get("rpm"),
+            "fuel_level": doc.get("fuel_level"),
+            "timestamp": doc.get("timestamp"),
+        }
+        operations = [
+            {"op": "set", "path": "/last_seen", "value": doc.get("timestamp")},
+            {"op": "set", "path": "/last_telemetry", "value": snapshot},
+            {"op": "set", "path": "/last_alert_level", "value": alert_level},
+        ]
+        try:
+            if last is not None:
+                self.container.patch_item(item=vehicle_id, partition_key=vehicle_id, patch_operations=operations)
+            else:
+                self._create_or_patch(vehicle_id, doc, snapshot, alert_level, operations)
+        except CosmosResourceNotFoundError:
+            # Documento rimosso (es. reset admin da un'altra istanza): lo ricreiamo
+            self._create_or_patch(vehicle_id, doc, snapshot, alert_level, operations)
+        with self._lock:
+            self.writes += 1
+        return True
+
+    def _create_or_patch(self, vehicle_id, doc, snapshot, alert_level, operations):
+        from azure.cosmos.exceptions import CosmosResourceExistsError
+
+        try:
+            self.container.create_item({
+                "id": vehicle_id,
+                "vehicle_id": vehicle_id,
+                "first_seen": doc.get("timestamp"),
+                "last_seen": doc.get("timestamp"),
+                "last_telemetry": snapshot,
+                "last_alert_level": alert_level,
+            })
+            self.invalidate()  # nuovo veicolo: visibile subito in /vehicles
+        except CosmosResourceExistsError:
+            self.container.patch_item(item=vehicle_id, partition_key=vehicle_id, patch_operations=operations)
+
+    # --- Lettura (/vehicles) ---
+
+    def list(self) -> list:
+        """Tutti i documenti del registro, O(numero di veicoli), con cache in-process di cache_ttl secondi."""
+        now = time.monotonic()
+        with self._lock:
+            if self._cache is not None and self._cache[0] > now:
+                return self._cache[1]
+        docs = list(self.container.query_items(
+            query="SELECT c.id, c.vehicle_id, c.first_seen, c.last_seen, c.last_telemetry, c.last_alert_level FROM c",
+            enable_cross_partition_query=True,
+        ))
+        docs.sort(key=lambda d: d["id"])
+        with self._lock:
+            self._cache = (now + self.cache_ttl, docs)
+        return docs
+
+    def invalidate(self):
+        with self._lock:
+            self._cache = None
+
+    # --- Coerenza con gli endpoint admin ---
+
+    def remove(self, vehicle_id: str):
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+        with self._lock:
+            self._last_write.pop(vehicle_id, None)
+        try:
+            self.container.delete_item(item=vehicle_id, partition_key=vehicle_id)
+        except CosmosResourceNotFoundError:
+            pass
+        self.invalidate()
+
+    def clear(self) -> int:
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+        with self._lock:
+            self._last_write.clear()
+        items = list(self.container.query_items(query="SELECT c.id FROM c", enable_cross_partition_query=True))
+        for item in items:
+            try:
+                self.container.delete_item(item=item["id"], partition_key=item["id"])
+            except CosmosResourceNotFoundError:
+                pass
+        self.invalidate()
+        return len(items)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tracked_vehicles": len(self._last_write), "writes": self.writes, "skipped": self.skipped}
+
+
+# --- Singleton ---
+
+_registry = None
+
+def get_vehicle_registry() -> Optional[VehicleRegistry]:
+    """Lazy singleton: None se disabilitato o se Cosmos non è configurato."""
+    global _registry
+    if _registry is None and REGISTRY_ENABLED:
+        container = get_vehicles_container()
+        if container is not None:
+            _registry = VehicleRegistry(container)
+    return _registry
@@ -0,0 +1,148 @@
+"""Formato di trasmissione della telemetria D2C (emulatore → IoT Hub → ProcessTelemetry).
+
+Due codifiche, scelte dal device e dichiarate nel content_type del messaggio:
+
+- JSON (`application/json`, fallback): un oggetto per lettura o un array di letture.
+- Binario compatto (`application/vnd.ecofleet.telemetry`), versionato, più letture per messaggio:
+
+      header    <2sBBHHd   magic "EF", versione, flag (riservati), n. veicoli, n. letture, timestamp base (epoch s)
+      veicoli   per ciascuno: <B + vehicle_id UTF-8, <B + boot_id UTF-8
+      letture   <HIiHHHB   indice veicolo, seq (0 = assente), offset dal timestamp base in ms,
+                           velocità in centesimi di km/h, rpm, carburante in centesimi di %, marcia
+
+  17 byte per lettura contro ~150 del JSON; vehicle_id e boot_id compaiono una volta per messaggio.
+  Velocità e carburante arrotondati al centesimo (come li invia l'emulatore) e timestamp al millisecondo.
+
+Senza content_type il formato viene riconosciuto dai byte iniziali (magic), così i consumer che non ricevono
+le proprietà di sistema del messaggio decodificano comunque entrambe le codifiche."""
+
+import json
+import struct
+import time
+from typing import List, Optional, Tuple
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_BINARY = "application/vnd.ecofleet.telemetry"
+
+MAGIC = b"EF"
+VERSION = 1
+MAX_SAMPLES = 0xFFFF
+
+_HEADER = struct.Struct("<2sBBHHd")
+_LENGTH = struct.Struct("<B")
+_SAMPLE = struct.Struct("<HIiHHHB")
+
+FORMATS = {"json": CONTENT_TYPE_JSON, "binary": CONTENT_TYPE_BINARY}
+
+
+def _clamp(value, high: int) -> int:
+    return min(max(int(round(value)), 0), high)
+
+
+def _text(value: str) -> bytes:
+    encoded = value.encode("utf-8")
+    if len(encoded) > 0xFF:
+        raise ValueError(f"Identifier too long for the binary wire format: {value[:32]!r}...")
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+def encode_binary(samples: List[dict]) -> bytes:
+    """Letture (dict come VehicleSimulator.get_telemetry()) → messaggio binario v1."""
+    if not samples or len(samples) > MAX_SAMPLES:
+        raise ValueError(f"A binary message carries 1..{MAX_SAMPLES} samples, got {len(samples)}")
+    now = time.time()
+    stamps = [float(sample.get("timestamp") or now) for sample in samples]
+    base = min(stamps)
+
+    vehicles = {}  # (vehicle_id, boot_id) -> indice nella tabella
+    rows = []
+    for sample, ts in zip(samples, stamps):
+        key = (str(sample.get("vehicle_id") or ""), str(sample.get("boot_id") or ""))
+        index = vehicles.setdefault(key, len(vehicles))
+        rows.append(_SAMPLE.pack(
+            index,
+            _clamp(sample.get("seq") or 0, 0xFFFFFFFF),
+            int(round((ts - base) * 1000.0)),
+            _clamp((sample.get("speed") or 0) * 100, 0xFFFF),
+            _clamp(sample.get("rpm") or 0, 0xFFFF),
+            _clamp((sample.get("fuel_level", 100) or 0) * 100, 0xFFFF),
+            _clamp(sample.get("gear") or 0, 0xFF),
+        ))
+    table = b"".join(_text(vehicle_id) + _text(boot_id) for vehicle_id, boot_id in vehicles)
+    return _HEADER.pack(MAGIC, VERSION, 0, len(vehicles), len(samples), base) + table + b"".join(rows)
+
+
+def decode_binary(body: bytes) -> List[dict]:
+    """Messaggio binario → letture nello stesso formato del JSON. ValueError se malformato o di versione ignota."""
+    view = memoryview(body)
+    try:
+        magic, version, _flags, vehicle_count, sample_count, base = _HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a binary telemetry message")
+        if version != VERSION:
+            raise ValueError(f"Unsupported telemetry wire format version {version}")
+        offset = _HEADER.size
+        vehicles = []
+        for _ in range(vehicle_count):
+            ids = []
+            for _field in range(2):
+                (length,) = _LENGTH.unpack_from(view, offset)
+                offset += _LENGTH.size
+                ids.append(bytes(view[offset:offset + length]).decode("utf-8"))
+                offset += length
+            vehicles.append(ids)
+        end = offset + sample_count * _SAMPLE.size
+        if end != len(body):
+            raise ValueError(f"Binary telemetry message of {len(body)} bytes, expected {end}")
+        samples = []
+        for index, seq, offset_ms, speed, rpm, fuel, gear in _SAMPLE.iter_unpack(view[offset:end]):
+            vehicle_id, boot_id = vehicles[index]
+            sample = {
+                "vehicle_id": vehicle_id,
+                "speed": speed / 100.0,
+                "rpm": rpm,
+                "gear": gear,
+                "fuel_level": fuel / 100.0,
+                "timestamp": round(base + offset_ms / 1000.0, 3),
+            }
+            if seq:
+                sample["seq"] = seq
+                sample["boot_id"] = boot_id or None
+            samples.append(sample)
+        return samples
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed binary telemetry message: {e}") from e
+
+
+def is_binary(body: bytes, content_type: Optional[str] = None) -> bool:
+    """True se il messaggio usa la codifica binaria: dal content_type se dichiarato, altrimenti dal magic."""
+    if content_type:
+        media_type = content_type.split(";", 1)[0].strip().lower()
+        if media_type == CONTENT_TYPE_BINARY:
+            return True
+        if media_type == CONTENT_TYPE_JSON:
+            return False
+    return body[:len(MAGIC)] == MAGIC
+
+
+def decode(body: bytes, content_type: Optional[str] = None) -> List[dict]:
+    """Body D2C → lista di letture (una per i messaggi JSON singoli)."""
+    if is_binary(body, content_type):
+        return decode_binary(body)
+    telemetry = json.loads(body.decode("utf-8"))
+    samples = telemetry if isinstance(telemetry, list) else [telemetry]
+    if not samples:
+        raise ValueError("JSON telemetry array is empty")
+    if not all(isinstance(sample, dict) for sample in samples):
+        raise ValueError("JSON telemetry must be an object or an array of objects")
+    return samples
+
+
+def encode(samples: List[dict], wire_format: str = "json") -> Tuple[bytes, str]:
+    """Letture → (body, content_type). In JSON una lettura sola resta un oggetto (formato storico)."""
+    if wire_format == "binary":
+        return encode_binary(samples), CONTENT_TYPE_BINARY
+    if wire_format != "json":
+        raise ValueError(f"Unknown telemetry wire format: {wire_format!r} (json|binary)")
+    payload = samples[0] if len(samples) == 1 else samples
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8"), CONTENT_TYPE_JSON
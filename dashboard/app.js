@@ -37,6 +37,8 @@ const app = new Vue({
         showInstallBtn: false,
         deferredPrompt: null,
         chart: null,
+        connection: null,
+        subscribedVehicle: undefined,  // veicolo dei gruppi SignalR a cui è iscritta la connessione
         chartData: {
             labels: [],
             speed: [],
@@ -153,6 +155,7 @@ const app = new Vue({
                 if (this.vehicles.length > 0) {
                     this.selectedVehicle = this.vehicles[0];
                     this.loadHistory(this.selectedVehicle);
+                    this.subscribeGroups();
                 }
             } catch (error) {
                 console.error("Errore caricamento veicoli:", error);
@@ -192,6 +195,7 @@ const app = new Vue({
             if (this.selectedVehicle) {
                 appInsights.trackEvent({ name: 'VehicleChanged' }, { vehicleId: this.selectedVehicle });
                 this.loadHistory(this.selectedVehicle);
+                this.subscribeGroups();
             }
         },
 
@@ -233,7 +237,18 @@ const app = new Vue({
                     alert(`Errore ${res.status}: ${errText}`);
                     return;
                 }
-                const result = await res.json();
+                // Il backend risponde 202 con un job asincrono: attendiamo il completamento
+                let result = await res.json();
+                while (result.status === 'pending' || result.status === 'running') {
+                    await new Promise(resolve => setTimeout(resolve, 2000));
+                    const statusRes = await fetch(`${API_BASE}/telemetry/jobs/${result.job_id}`, { headers: this.authHeaders() });
+                    result = await statusRes.json();
+                    console.log(`Reset all in corso: ${result.deleted} docs cancellati`);
+                }
+                if (result.status === 'failed') {
+                    alert(`Errore durante il reset (job ${result.job_id}): ${result.error}`);
+                    return;
+                }
                 console.log(`Deleted ${result.deleted} docs total`);
                 appInsights.trackEvent({ name: 'ResetAll' }, { deletedCount: result.deleted });
 
@@ -266,18 +281,32 @@ const app = new Vue({
                     this.updateDashboard(message);
                 });
 
+                connection.on('newTelemetryBatch', (messages) => {
+                    console.log(`📡 Telemetry batch ricevuto (${messages.length})`);
+                    messages.forEach(message => this.updateDashboard(message));
+                });
+
                 connection.on('newAdvice', (advice) => {
                     console.log("🤖 AI Advice ricevuto:", advice);
                     this.updateAdvice(advice);
                 });
 
+                // Modalità frames (SIGNALR_MODE=frames): un frame per tick con l'ultimo stato (o i soli campi cambiati) per veicolo
+                connection.on('telemetryFrame', (frame) => {
+                    this.applyFrame(frame);
+                });
+
                 connection.onclose(() => {
                     this.isConnected = false;
+                    this.connection = null;
+                    this.subscribedVehicle = undefined;
                     this.statusMessage = 'Disconnesso (Riprovo...)';
                     setTimeout(() => this.initSignalR(), 5000);
                 });
 
                 await connection.start();
+                this.connection = connection;
+                this.subscribeGroups();
                 this.isConnected = true;
                 this.statusMessage = 'Connesso a SignalR 🟢';
                 console.log("SignalR Connected!");
@@ -295,6 +324,49 @@ const app = new Vue({
             }
         },
 
+        async subscribeGroups() {
+            // Iscrive la connessione ai gruppi del veicolo selezionato (no-op se il backend fa broadcast a tutti)
+            if (!this.connection || !this.connection.connectionId) return;
+            const vehicleId = this.selectedVehicle || null;
+            if (vehicleId === this.subscribedVehicle) return;
+            const body = { connectionId: this.connection.connectionId, vehicleId };
+            if (this.subscribedVehicle !== undefined) body.previousVehicleId = this.subscribedVehicle;
+            try {
+                await fetch(`${API_BASE}/signalr/subscribe`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json', ...this.authHeaders() },
+                    body: JSON.stringify(body)
+                });
+                this.subscribedVehicle = vehicleId;
+            } catch (e) {
+                console.warn('⚠️ Iscrizione ai gruppi SignalR non riuscita:', e);
+            }
+        },
+
+        applyFrame(frame) {
+            // I delta vengono applicati campo per campo sull'ultimo stato noto del veicolo (non reattivo);
+            // i keyframe ripetono la telemetria completa, quindi si notifica solo ciò che è cambiato davvero
+            this.frameState = this.frameState || {};
+            Object.entries(frame.vehicles).forEach(([vehicleId, fields]) => {
+                const previous = this.frameState[vehicleId] || { vehicle_id: vehicleId };
+                if (fields.timestamp && previous.timestamp && fields.timestamp < previous.timestamp) {
+                    // Telemetria più vecchia di quella già ricevuta (frame di un'altra istanza): si tiene solo l'advice
+                    const { doc_id, ai_advice, alert_level } = fields;
+                    fields = Object.fromEntries(Object.entries({ doc_id, ai_advice, alert_level }).filter(([, v]) => v !== undefined));
+                }
+                const changed = Object.keys(fields).filter(k => previous[k] !== fields[k]);
+                const state = Object.assign(previous, fields);
+                this.frameState[vehicleId] = state;
+                if (changed.includes('timestamp')) {
+                    const { doc_id, ai_advice, alert_level, ...telemetry } = state;
+                    this.updateDashboard(telemetry);
+                }
+                if (changed.includes('ai_advice') || changed.includes('alert_level')) {
+                    this.updateAdvice({ doc_id: state.doc_id, vehicle_id: vehicleId, ai_advice: state.ai_advice, alert_level: state.alert_level });
+                }
+            });
+        },
+
         updateDashboard(data) {
             if (this.selectedVehicle && data.vehicle_id !== this.selectedVehicle) {
                 return;
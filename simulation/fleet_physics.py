@@ -0,0 +1,163 @@
+"""
+FleetPhysics: motore fisico vettorizzato per l'intera flotta.
+
+Stessa dinamica di VehicleSimulator.update_physics (guida normale/aggressiva,
+cambio marcia, consumo, rifornimento) ma con lo stato di tutti i veicoli in
+array NumPy: un solo step avanza decine di migliaia di veicoli.
+
+USO:
+    physics = FleetPhysics(10_000, aggressive=[9_999], seed=42)
+    physics.step()                 # avanza la fisica
+    data = physics.telemetry()     # lista di dict come VehicleSimulator.get_telemetry()
+    physics.refuel()               # pit-stop dei veicoli rimasti a secco
+
+Lanciato direttamente confronta le distribuzioni con il modello per-veicolo.
+"""
+import time
+import uuid
+
+import numpy as np
+
+# Tabella marce come array indicizzati per marcia (indice 0 non usato)
+GEAR_RATIO = np.array([0.0, 4.0, 2.5, 1.8, 1.2, 0.9, 0.7])
+GEAR_MAX = np.array([0.0, 30, 50, 80, 110, 140, 180])
+MAX_GEAR = 6
+
+
+class FleetPhysics:
+    def __init__(self, count, aggressive=(), seed=None, vehicle_ids=None):
+        self.count = count
+        self.rng = np.random.default_rng(seed)
+        self.vehicle_ids = vehicle_ids or [f"Bus-{i + 1:02d}" for i in range(count)]
+
+        self.aggressive = np.zeros(count, dtype=bool)
+        self.aggressive[list(aggressive)] = True
+
+        # Fisica Base
+        self.speed = np.zeros(count)
+        self.rpm = np.full(count, 800.0)
+        self.gear = np.ones(count, dtype=np.int64)
+        self.fuel_level = np.full(count, 100.0)
+
+        # Numerazione delle letture come VehicleSimulator: un seq per snapshot, monotono per veicolo
+        self.boot_id = uuid.uuid4().hex[:12]
+        self.seq = 0
+
+    def step(self):
+        """Avanza di un tick la fisica di tutti i veicoli (equivalente a update_physics per ciascuno)."""
+        n, rng = self.count, self.rng
+        aggressive, speed = self.aggressive, self.speed
+
+        # 🔥 GUIDA AGGRESSIVA: accelera sempre, non scala mai, frena poco
+        accel = rng.uniform(5, 25, n)
+        brake_hit = rng.random(n) < 0.05
+        brake = rng.uniform(10, 30, n)
+        aggressive_speed = np.clip(speed + accel - np.where(brake_hit, brake, 0.0) - 0.1, 20, 180)
+
+        # Guida normale: frenata brusca 10%, accelerata aggressiva 10%, altrimenti segue la marcia
+        action = rng.random(n)
+        gear_max = GEAR_MAX[self.gear]
+        delta = np.select(
+            [action < 0.10, action < 0.20, speed < gear_max - 5, speed > gear_max],
+            [-rng.uniform(5, 15, n), rng.uniform(8, 20, n), rng.uniform(1.0, 5.0, n), -rng.uniform(1.0, 3.0, n)],
+            default=0.0,
+        )
+        normal_speed = np.clip(speed + delta - 0.2, 0, 180)
+
+        self.speed = np.where(aggressive, aggressive_speed, normal_speed)
+        # Resta in marce basse → RPM altissimi
+        self.gear = np.where(aggressive & (self.gear > 3), 3, self.gear)
+
+        # RPM con variazione marcata
+        base_rpm = self.speed * GEAR_RATIO[self.gear] * 40
+        self.rpm = np.clip(base_rpm + 800 + rng.uniform(-100, 100, n), 600, 6000)
+
+        # Cambio marcia
+        upshift = (self.rpm > 3500) & (self.gear < MAX_GEAR)
+        downshift = ~upshift & (self.rpm < 1200) & (self.gear > 1) & (self.speed > 10)
+        self.gear = self.gear + upshift - downshift
+        self.rpm = self.rpm - 1500 * upshift + 1000 * downshift
+
+        # Consumo proporzionale a RPM
+        self.fuel_level = np.maximum(self.fuel_level - (self.rpm / 2500.0) * 2.0, 0.0)
+
+    def refuel(self):
+        """Pit-stop: i veicoli a secco ripartono da fermi con il pieno. Restituisce gli indici riforniti."""
+        empty = np.flatnonzero(self.fuel_level <= 0)
+        self.speed[empty] = 0.0
+        self.rpm[empty] = 800.0
+        self.gear[empty] = 1
+        self.fuel_level[empty] = 100.0
+        return empty
+
+    def brake(self, indices, factor=0.8):
+        """Frenata da feedback C2D ("rallenta") per i veicoli indicati."""
+        self.speed[indices] *= factor
+
+    def telemetry(self, timestamp=None):
+        """Snapshot della flotta nel formato di VehicleSimulator.get_telemetry()."""
+        timestamp = time.time() if timestamp is None else timestamp
+        self.seq += 1
+        seq, boot_id = self.seq, self.boot_id
+        speed = np.round(self.speed, 2).tolist()
+        rpm = self.rpm.astype(np.int64).tolist()
+        gear = self.gear.tolist()
+        fuel = np.round(self.fuel_level, 2).tolist()
+        return [
+            {"vehicle_id": vid, "seq": seq, "boot_id": boot_id, "speed": s, "rpm": r, "gear": g, "fuel_level": f,
+             "timestamp": timestamp}
+            for vid, s, r, g, f in zip(self.vehicle_ids, speed, rpm, gear, fuel)
+        ]
+
+
+# --- Confronto con il modello per-veicolo ---
+
+def _scalar_samples(aggressive, vehicles, steps, seed):
+    """Esegue VehicleSimulator.update_physics (modello originale) e raccoglie speed/rpm/fuel."""
+    import asyncio
+    import random
+    from vehicle_emulator import VehicleSimulator
+
+    random.seed(seed)
+    sims = [VehicleSimulator(f"Bus-{i}", None, aggressive=aggressive) for i in range(vehicles)]
+    samples = []
+
+    async def run():
+        for _ in range(steps):
+            for sim in sims:
+                await sim.update_physics()
+                samples.append((sim.speed, sim.rpm, sim.fuel_level))
+                if sim.fuel_level <= 0:
+                    sim.speed, sim.rpm, sim.gear, sim.fuel_level = 0, 800, 1, 100.0
+
+    asyncio.run(run())
+    return np.array(samples)
+
+
+def _vector_samples(aggressive, vehicles, steps, seed):
+    physics = FleetPhysics(vehicles, aggressive=range(vehicles) if aggressive else (), seed=seed)
+    samples = []
+    for _ in range(steps):
+        physics.step()
+        samples.append(np.stack([physics.speed, physics.rpm, physics.fuel_level], axis=1))
+        physics.refuel()
+    return np.concatenate(samples)
+
+
+if __name__ == "__main__":
+    VEHICLES, STEPS = 200, 200
+    for aggressive in (False, True):
+        scalar = _scalar_samples(aggressive, VEHICLES, STEPS, seed=1)
+        vector = _vector_samples(aggressive, VEHICLES, STEPS, seed=1)
+        profile = "aggressive" if aggressive else "normal"
+        for column, name in enumerate(("speed", "rpm", "fuel_level")):
+            print(f"{profile:10s} {name:10s} scalar {scalar[:, column].mean():8.1f} ± {scalar[:, column].std():7.1f}"
+                  f" | vector {vector[:, column].mean():8.1f} ± {vector[:, column].std():7.1f}")
+
+    fleet = FleetPhysics(50_000, aggressive=range(0, 50_000, 5), seed=42)
+    start = time.perf_counter()
+    for _ in range(100):
+        fleet.step()
+        fleet.refuel()
+    elapsed = time.perf_counter() - start
+    print(f"🚀 50k vehicles x 100 steps: {elapsed:.2f}s ({50_000 * 100 / elapsed:,.0f} vehicle-steps/s)")
@@ -0,0 +1,206 @@
+"""
+Runner ad alta scala: decine di migliaia di veicoli virtuali da una sola macchina.
+
+La fisica è FleetPhysics (vettorizzata); la consegna è delegata a un sink intercambiabile:
+
+    python fleet_runner.py --vehicles 10000 --sink inprocess --duration 60
+    python fleet_runner.py --vehicles 10000 --sink jsonl --output fleet.jsonl
+    python fleet_runner.py --vehicles 10000 --sink record --output fleet.jsonl.gz  # per replay.py
+    python fleet_runner.py --vehicles 10000 --sink http --serve          # stand-in HTTP locale
+    python fleet_runner.py --vehicles 10000 --sink iothub --pool-size 16 # IoT Hub, 16 connessioni
+    LOCAL_BACKEND=true python fleet_runner.py --vehicles 1000 --sink inprocess   # ciclo completo senza Azure
+
+In modalità iothub i device del pool vengono provisionati in parallelo e le loro credenziali
+salvate in DEVICE_CACHE_PATH, così i run successivi non interrogano il registry.
+
+Con LOCAL_BACKEND=true (sink inprocess o http --serve) anche advice e C2D restano nel processo:
+il feedback "slow"/"rallenta" arriva ai veicoli virtuali in loopback e li fa frenare, come nell'emulatore.
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.iot.hub import IoTHubRegistryManager
+
+from fleet_physics import FleetPhysics
+from sinks import (TELEMETRY_SAMPLES_PER_MESSAGE, TELEMETRY_WIRE_FORMAT, HttpSink, InProcessSink, IoTHubSink,
+                   JsonlSink, LocalIngestServer, RecordingSink, load_local_backend)
+from vehicle_emulator import IOTHUB_SERVICE_CONN_STR, TELEMETRY_INTERVAL_SEC, VEHICLE_PREFIX, logger, provision_device
+
+DEVICE_CACHE_PATH = os.getenv("DEVICE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".device_cache.json"))
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "16"))
+
+
+# --- Provisioning concorrente con cache delle credenziali ---
+
+def _load_cache(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def provision_fleet_concurrent(service_conn_string, device_ids, workers=PROVISION_WORKERS, cache_path=DEVICE_CACHE_PATH):
+    """Come provision_fleet, ma in parallelo e solo per i device assenti dalla cache locale."""
+    hub_name = service_conn_string.split(";")[0].split("=")[1]
+    cache = _load_cache(cache_path)
+    missing = [d for d in device_ids if not cache.get(d, "").startswith(f"HostName={hub_name};")]
+    logger.info(f"🔧 Provisioning {len(device_ids)} devices ({len(device_ids) - len(missing)} cached, {len(missing)} to check)...")
+
+    local = threading.local()  # un registry manager per thread
+
+    def provision(device_id):
+        if not hasattr(local, "registry_manager"):
+            local.registry_manager = IoTHubRegistryManager(service_conn_string)
+        return provision_device(local.registry_manager, hub_name, device_id)
+
+    created = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for conf, created_new in pool.map(provision, missing):
+            cache[conf["id"]] = conf["conn_str"]
+            created += created_new
+
+    if missing:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    logger.info(f"✅ Fleet ready ({created} created, credentials cached in {cache_path})")
+    return [{"id": d, "conn_str": cache[d]} for d in device_ids]
+
+
+# --- Runner ---
+
+class FleetRunner:
+    """Avanza la flotta ogni `interval` secondi e invia la telemetria al sink in batch da `batch_size`."""
+
+    def __init__(self, physics, sink, interval=TELEMETRY_INTERVAL_SEC, batch_size=500):
+        self.physics = physics
+        self.sink = sink
+        self.interval = interval
+        self.batch_size = batch_size
+        self.ticks = 0
+        self.refuels = 0
+        self.late_ticks = 0
+        self.feedback = 0
+        self._index = {vehicle_id: i for i, vehicle_id in enumerate(physics.vehicle_ids)}
+        self._brake = deque()  # indici da frenare, applicati al tick successivo (callback da altri thread)
+
+    def on_feedback(self, message):
+        """Callback C2D in loopback: stessa regola dell'emulatore (frena del 20% su "slow"/"rallenta")."""
+        self.feedback += 1
+        text = message.data.decode("utf-8").lower()
+        if message.device_id in self._index and ("slow" in text or "rallenta" in text):
+            self._brake.append(self._index[message.device_id])
+
+    async def tick(self):
+        if self._brake:
+            indices = [self._brake.popleft() for _ in range(len(self._brake))]
+            self.physics.brake(indices)
+        self.physics.step()
+        data = self.physics.telemetry()
+        for i in range(0, len(data), self.batch_size):
+            await self.sink.send_batch(data[i:i + self.batch_size])
+        self.refuels += len(self.physics.refuel())
+        self.ticks += 1
+
+    async def run(self, duration=None):
+        await self.sink.open()
+        started = time.monotonic()
+        try:
+            while duration is None or time.monotonic() - started < duration:
+                tick_start = time.monotonic()
+                await self.tick()
+                elapsed = time.monotonic() - tick_start
+                if elapsed > self.interval:
+                    self.late_ticks += 1
+                    logger.warning(f"🐢 Tick took {elapsed:.2f}s (> {self.interval}s interval)")
+                else:
+                    await asyncio.sleep(self.interval - elapsed)
+        finally:
+            await self.sink.close()
+        return self.report(time.monotonic() - started)
+
+    def report(self, elapsed):
+        stats = self.sink.stats()
+        return {
+            **stats,
+            "vehicles": self.physics.count,
+            "ticks": self.ticks,
+            "late_ticks": self.late_ticks,
+            "refuels": self.refuels,
+            "c2d_feedback": self.feedback,
+            "elapsed_sec": round(elapsed, 2),
+            "messages_per_sec": round(stats["sent"] / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+def add_wire_arguments(parser):
+    parser.add_argument("--wire-format", choices=["json", "binary"], default=TELEMETRY_WIRE_FORMAT,
+                        help="codifica D2C (iothub, inprocess, http)")
+    parser.add_argument("--samples-per-message", type=int, default=TELEMETRY_SAMPLES_PER_MESSAGE,
+                        help="letture per messaggio D2C (iothub, inprocess)")
+
+
+def build_sink(args):
+    wire = {"wire_format": args.wire_format}
+    if args.sink == "inprocess":
+        return InProcessSink(samples_per_message=args.samples_per_message, **wire), None
+    if args.sink == "jsonl":
+        return JsonlSink(args.output), None
+    if args.sink == "record":
+        return RecordingSink(args.output, meta={"vehicles": args.vehicles, "seed": args.seed, "interval": args.interval}), None
+    if args.sink == "http":
+        server = LocalIngestServer(port=args.port).start() if args.serve else None
+        return HttpSink(server.url if server else args.url, pool_size=args.pool_size, **wire), server
+    if not IOTHUB_SERVICE_CONN_STR:
+        raise SystemExit("Missing IOTHUB_SERVICE_CONNECTION_STRING!")
+    pool_ids = [f"{VEHICLE_PREFIX}Pool-{i:02d}" for i in range(1, args.pool_size + 1)]
+    return IoTHubSink(provision_fleet_concurrent(IOTHUB_SERVICE_CONN_STR, pool_ids),
+                      samples_per_message=args.samples_per_message, **wire), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EcoFleet high-scale emulator")
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--aggressive-every", type=int, default=5, help="un veicolo aggressivo ogni N (0 = nessuno)")
+    parser.add_argument("--sink", choices=["iothub", "inprocess", "jsonl", "record", "http"], default="inprocess")
+    parser.add_argument("--interval", type=float, default=TELEMETRY_INTERVAL_SEC)
+    parser.add_argument("--duration", type=float, default=None, help="secondi (default: fino a CTRL+C)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--pool-size", type=int, default=8, help="connessioni IoT Hub / HTTP")
+    parser.add_argument("--output", default="fleet_telemetry.jsonl")
+    parser.add_argument("--url", default="http://127.0.0.1:8088/telemetry")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--serve", action="store_true", help="avvia lo stand-in HTTP locale (in-process)")
+    add_wire_arguments(parser)
+    args = parser.parse_args()
+
+    every = args.aggressive_every
+    aggressive = range(every - 1, args.vehicles, every) if every > 0 else ()
+    vehicle_ids = [f"{VEHICLE_PREFIX}{i:05d}" for i in range(1, args.vehicles + 1)]
+    physics = FleetPhysics(args.vehicles, aggressive=aggressive, seed=args.seed, vehicle_ids=vehicle_ids)
+
+    sink, server = build_sink(args)
+    runner = FleetRunner(physics, sink, interval=args.interval, batch_size=args.batch_size)
+    backend = load_local_backend() if args.sink == "inprocess" or server else None
+    if backend:
+        backend.c2d.register(None, runner.on_feedback)
+    logger.info(f"🚀 Starting {args.vehicles} virtual vehicles → {sink.name} sink (CTRL+C to stop)")
+    try:
+        report = asyncio.run(runner.run(args.duration))
+        logger.info(f"📊 {json.dumps(report)}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Record/replay deterministico della telemetria con rate shaping.
+
+RECORD — genera una registrazione riproducibile (FleetPhysics con seed, tempo virtuale: nessuna attesa):
+    python replay.py record --vehicles 1000 --ticks 120 --seed 42 --output fleet.jsonl.gz
+
+(In alternativa si può catturare un run reale con `fleet_runner.py --sink record`.)
+
+REPLAY — rinvia la registrazione a un sink (stessi sink di fleet_runner.py):
+    python replay.py replay fleet.jsonl.gz --speed 1            # tempi originali
+    python replay.py replay fleet.jsonl.gz --speed 10           # 10x più veloce
+    python replay.py replay fleet.jsonl.gz --speed max          # il più veloce possibile
+    python replay.py replay fleet.jsonl.gz --rate constant:2000 --duration 60
+    python replay.py replay fleet.jsonl.gz --rate ramp:100:5000 --duration 120
+    python replay.py replay fleet.jsonl.gz --rate burst:500:5000:5:30 --duration 120  # base:picco:durata:periodo
+
+Le schedule a rate sono open-loop: i tempi di invio non dipendono dalle risposte del sink e la latenza
+è misurata dal tempo pianificato (non da quello effettivo), quindi include l'accodamento quando il
+backend non tiene il passo. A fine replay viene stampato un report JSON con throughput e percentili.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+
+import numpy as np
+
+from fleet_physics import FleetPhysics
+from fleet_runner import add_wire_arguments, build_sink
+from sinks import RecordingSink, open_recording
+from vehicle_emulator import TELEMETRY_INTERVAL_SEC, VEHICLE_PREFIX, logger
+
+# --- Record ---
+
+def record(path, vehicles, ticks, seed=None, interval=TELEMETRY_INTERVAL_SEC, aggressive_every=5):
+    """Registra `ticks` passi della flotta in tempo virtuale. Il jitter di invio (0-1s come in
+    VehicleSimulator.run) è estratto da un generatore separato con lo stesso seed."""
+    aggressive = range(aggressive_every - 1, vehicles, aggressive_every) if aggressive_every > 0 else ()
+    vehicle_ids = [f"{VEHICLE_PREFIX}{i:05d}" for i in range(1, vehicles + 1)]
+    physics = FleetPhysics(vehicles, aggressive=aggressive, seed=seed, vehicle_ids=vehicle_ids)
+    jitter_rng = np.random.default_rng(None if seed is None else seed + 1)
+
+    sink = RecordingSink(path, meta={"vehicles": vehicles, "ticks": ticks, "seed": seed, "interval": interval})
+    asyncio.run(sink.open())
+    try:
+        for tick in range(ticks):
+            physics.step()
+            offsets = tick * interval + jitter_rng.uniform(0, 1, vehicles)
+            data = physics.telemetry(timestamp=0)
+            order = np.argsort(offsets, kind="stable")
+            for i in order:
+                data[i]["timestamp"] = round(float(offsets[i]), 3)
+                sink.write([data[i]], float(offsets[i]))
+            physics.refuel()
+    finally:
+        asyncio.run(sink.close())
+    logger.info(f"⏺️ Recorded {sink.sent} readings ({vehicles} vehicles x {ticks} ticks) to {path}")
+    return sink.sent
+
+
+def load_recording(path):
+    """Restituisce (meta, [(t, reading)]) ordinati per t."""
+    meta, records = {}, []
+    with open_recording(path, "r") as f:
+        for line in f:
+            item = json.loads(line)
+            if "_meta" in item:
+                meta = item["_meta"]
+                continue
+            records.append((item.pop("t"), item))
+    records.sort(key=lambda r: r[0])
+    return meta, records
+
+
+# --- Schedule ---
+
+def parse_rate(spec, duration):
+    """Funzione rate(t) in messaggi/s da "constant:RPS", "ramp:FROM:TO" o "burst:BASE:PEAK:SEC:PERIOD"."""
+    kind, *values = spec.split(":")
+    values = [float(v) for v in values]
+    if kind == "constant" and len(values) == 1:
+        return lambda t: values[0]
+    if kind == "ramp" and len(values) == 2:
+        start, end = values
+        return lambda t: start + (end - start) * min(t / duration, 1.0)
+    if kind == "burst" and len(values) == 4:
+        base, peak, burst_sec, period = values
+        return lambda t: peak if t % period < burst_sec else base
+    raise ValueError(f"Invalid rate schedule: {spec}")
+
+
+def rate_offsets(rate, duration):
+    """Tempi di invio pianificati per una schedule a rate (arrivi equispaziati istante per istante)."""
+    t = 0.0
+    while t < duration:
+        yield t
+        t += 1.0 / max(rate(t), 1e-6)
+
+
+def speed_offsets(records, speed):
+    """Tempi originali della registrazione divisi per `speed` (None = max: tutto subito)."""
+    for t, _ in records:
+        yield 0.0 if speed is None else t / speed
+
+
+# --- Replay ---
+
+class ReplayStats:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.errors = 0
+        self.max_lag = 0.0
+
+    def report(self, elapsed, scheduled, planned):
+        lat = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            "scheduled": scheduled,
+            "sent": self.sent,
+            "errors": self.errors,
+            "elapsed_sec": round(elapsed, 2),
+            "achieved_rps": round(self.sent / elapsed, 1) if elapsed else 0.0,
+            "target_rps": round(scheduled / planned, 1) if planned else None,  # None = speed max
+            "max_schedule_lag_ms": round(self.max_lag * 1000, 1),
+            "latency_ms": {
+                "p50": round(float(np.percentile(lat, 50)), 2),
+                "p95": round(float(np.percentile(lat, 95)), 2),
+                "p99": round(float(np.percentile(lat, 99)), 2),
+                "max": round(float(lat.max()), 2),
+            },
+        }
+
+
+async def replay(records, offsets, sink, batch_size=500, max_in_flight=64, closed_loop=False):
+    """Invia i record secondo `offsets` (secondi dall'avvio). I record vengono riciclati se la schedule
+    ne richiede più di quelli registrati; timestamp e sequenza vengono riscritti all'invio (nuovo boot_id per
+    ogni replay), così i record riciclati non sono scartati come duplicati dal backend.
+    closed_loop=True (speed max): la latenza parte dall'accodamento nel batch, non dall'offset."""
+    stats = ReplayStats()
+    in_flight = set()
+    limiter = asyncio.Semaphore(max_in_flight)
+    scheduled, planned = 0, 0.0
+    boot_id, sequence = uuid.uuid4().hex[:12], {}
+
+    async def send(batch, due):
+        try:
+            await sink.send_batch([reading for _, reading in batch])
+            stats.sent += len(batch)
+        except Exception as e:
+            stats.errors += len(batch)
+            logger.error(f"Replay send error: {e}")
+        done = time.monotonic()
+        stats.latencies.extend(done - d for d in due)
+        limiter.release()
+
+    await sink.open()
+    start = time.monotonic()
+    pending = zip(offsets, itertools.cycle(records))
+    batch, due = [], []
+    try:
+        for offset, (_, reading) in pending:
+            target = start + offset
+            now = time.monotonic()
+            # Gli invii già dovuti si accumulano nello stesso batch; prima di attendere il prossimo si fa flush
+            if batch and (target > now or len(batch) >= batch_size):
+                await limiter.acquire()
+                task = asyncio.create_task(send(batch, due))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                batch, due = [], []
+                now = time.monotonic()
+            if target > now:
+                await asyncio.sleep(target - now)
+            stats.max_lag = max(stats.max_lag, time.monotonic() - target)
+            seq = sequence[reading["vehicle_id"]] = sequence.get(reading["vehicle_id"], 0) + 1
+            batch.append((offset, {**reading, "timestamp": time.time(), "seq": seq, "boot_id": boot_id}))
+            due.append(time.monotonic() if closed_loop else target)
+            scheduled, planned = scheduled + 1, offset
+        if batch:
+            await limiter.acquire()
+            await send(batch, due)
+        await asyncio.gather(*in_flight)
+    finally:
+        await sink.close()
+    return stats.report(time.monotonic() - start, scheduled, planned)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EcoFleet record/replay load generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rec = commands.add_parser("record", help="registra una flotta deterministica in tempo virtuale")
+    rec.add_argument("--vehicles", type=int, default=1000)
+    rec.add_argument("--ticks", type=int, default=60)
+    rec.add_argument("--seed", type=int, default=42)
+    rec.add_argument("--interval", type=float, default=TELEMETRY_INTERVAL_SEC)
+    rec.add_argument("--aggressive-every", type=int, default=5)
+    rec.add_argument("--output", default="fleet_recording.jsonl.gz")
+
+    rep = commands.add_parser("replay", help="rinvia una registrazione a un sink")
+    rep.add_argument("recording")
+    shape = rep.add_mutually_exclusive_group()
+    shape.add_argument("--speed", default="1", help="fattore di velocità (1, 10, ...) o 'max'")
+    shape.add_argument("--rate", help="constant:RPS | ramp:FROM:TO | burst:BASE:PEAK:SEC:PERIOD")
+    rep.add_argument("--duration", type=float, default=60.0, help="durata delle schedule --rate (s)")
+    rep.add_argument("--sink", choices=["iothub", "inprocess", "jsonl", "http"], default="inprocess")
+    rep.add_argument("--batch-size", type=int, default=500)
+    rep.add_argument("--max-in-flight", type=int, default=64)
+    rep.add_argument("--pool-size", type=int, default=8)
+    rep.add_argument("--output", default="replay_telemetry.jsonl")
+    rep.add_argument("--url", default="http://127.0.0.1:8088/telemetry")
+    rep.add_argument("--port", type=int, default=8088)
+    rep.add_argument("--serve", action="store_true")
+    rep.add_argument("--report", help="salva il report JSON su file")
+    add_wire_arguments(rep)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.output, args.vehicles, args.ticks, args.seed, args.interval, args.aggressive_every)
+        return
+
+    meta, records = load_recording(args.recording)
+    if not records:
+        raise SystemExit(f"Empty recording: {args.recording}")
+    if args.rate:
+        offsets = rate_offsets(parse_rate(args.rate, args.duration), args.duration)
+        profile = f"rate {args.rate} for {args.duration}s"
+    else:
+        speed = None if args.speed == "max" else float(args.speed)
+        offsets = speed_offsets(records, speed)
+        profile = f"speed {args.speed}"
+
+    sink, server = build_sink(args)
+    logger.info(f"▶️ Replaying {len(records)} readings ({meta.get('vehicles', '?')} vehicles) → {sink.name} sink, {profile}")
+    try:
+        closed_loop = not args.rate and args.speed == "max"
+        report = asyncio.run(replay(records, offsets, sink, args.batch_size, args.max_in_flight, closed_loop))
+    finally:
+        if server:
+            server.stop()
+    report = {"profile": profile, "sink": sink.stats(), **report}
+    logger.info(f"📊 {json.dumps(report)}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+Sink di telemetria per il runner ad alta scala (fleet_runner.py).
+
+Ogni sink riceve batch di letture (dict come VehicleSimulator.get_telemetry()) e le consegna
+a una destinazione diversa. IoTHubSink, InProcessSink e HttpSink codificano i messaggi nel formato
+di trasmissione scelto (wire_format json|binary, samples_per_message letture per messaggio):
+
+- IoTHubSink      → IoT Hub con un pool di connessioni multiplexate (N veicoli su K device client)
+- InProcessSink   → logica di ProcessTelemetry chiamata direttamente, senza cloud (con LOCAL_BACKEND=true
+                    gli output vanno a Cosmos, advice-queue, SignalR e C2D locali: api/shared/local_backend.py)
+- JsonlSink       → file JSONL (una lettura per riga)
+- HttpSink        → endpoint HTTP locale (LocalIngestServer) con connessioni keep-alive
+- RecordingSink   → registrazione JSONL (anche .gz) con offset temporale, riproducibile da replay.py
+"""
+import abc
+import asyncio
+import gzip
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+logger = logging.getLogger("EcoFleetSimulator")
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+# Formato D2C: "json" (un oggetto per lettura, o un array) o "binary" (compatto, più letture per messaggio)
+TELEMETRY_WIRE_FORMAT = os.getenv("TELEMETRY_WIRE_FORMAT", "json").lower()
+TELEMETRY_SAMPLES_PER_MESSAGE = int(os.getenv("TELEMETRY_SAMPLES_PER_MESSAGE", "1"))
+
+
+def load_wire_format():
+    """Codec condiviso con il backend (api/shared/wire_format.py, solo libreria standard)."""
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+    from shared import wire_format
+    return wire_format
+
+
+def load_local_backend():
+    """Backend locale del backend (api/shared/local_backend.py), None se LOCAL_BACKEND non è attivo."""
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+    from shared.local_backend import get_local_backend
+    return get_local_backend()
+
+
+def pack_messages(messages, samples_per_message):
+    """Raggruppa le letture in messaggi da al massimo samples_per_message letture."""
+    size = max(1, samples_per_message)
+    return [messages[i:i + size] for i in range(0, len(messages), size)]
+
+
+class TelemetrySink(abc.ABC):
+    """Interfaccia comune: open → send_batch (N volte) → close."""
+
+    name = "sink"
+
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+
+    async def open(self):
+        pass
+
+    @abc.abstractmethod
+    async def send_batch(self, messages):
+        """Consegna un batch di letture alla destinazione."""
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {"sink": self.name, "sent": self.sent, "errors": self.errors}
+
+
+# --- IoT Hub (pool di connessioni) ---
+
+class IoTHubSink(TelemetrySink):
+    """Multiplexa i veicoli virtuali su un pool di device client: il backend identifica il veicolo
+    dal campo vehicle_id del payload, non dall'identità del device. Ogni veicolo è assegnato sempre
+    alla stessa connessione (crc32 del vehicle_id), così le sue letture restano ordinate sulla stessa
+    partizione Event Hub. Il backend riconosce le letture multiplexate (device mittente ≠ vehicle_id) e
+    non invia loro C2D: in questa modalità i veicoli virtuali non ricevono feedback."""
+
+    name = "iothub"
+
+    def __init__(self, device_configs, max_in_flight=32, wire_format=TELEMETRY_WIRE_FORMAT,
+                 samples_per_message=TELEMETRY_SAMPLES_PER_MESSAGE):
+        super().__init__()
+        self.device_configs = device_configs
+        self.max_in_flight = max_in_flight
+        self.wire_format = wire_format
+        self.samples_per_message = samples_per_message
+        self._codec = load_wire_format()
+        self.messages = 0
+        self.clients = []
+        self._semaphores = []
+
+    async def open(self):
+        from azure.iot.device.aio import IoTHubDeviceClient
+
+        async def connect(conf):
+            client = IoTHubDeviceClient.create_from_connection_string(conf["conn_str"])
+            await client.connect()
+            return client
+
+        self.clients = await asyncio.gather(*(connect(conf) for conf in self.device_configs))
+        self._semaphores = [asyncio.Semaphore(self.max_in_flight) for _ in self.clients]
+        logger.info(f"✅ IoT Hub pool connected ({len(self.clients)} connections)")
+
+    async def _send(self, index, samples):
+        from azure.iot.device import Message
+
+        async with self._semaphores[index]:
+            try:
+                body, content_type = self._codec.encode(samples, self.wire_format)
+                msg = Message(body)
+                msg.content_type = content_type
+                if content_type == self._codec.CONTENT_TYPE_JSON:
+                    msg.content_encoding = "utf-8"
+                await self.clients[index].send_message(msg)
+                self.sent += len(samples)
+                self.messages += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"[{samples[0].get('vehicle_id')}] D2C send error: {e}")
+
+    def _connection(self, vehicle_id):
+        return zlib.crc32(str(vehicle_id).encode("utf-8")) % len(self.clients)
+
+    async def send_batch(self, messages):
+        by_connection = {}
+        for message in messages:
+            by_connection.setdefault(self._connection(message.get("vehicle_id")), []).append(message)
+        await asyncio.gather(*(self._send(index, samples)
+                               for index, group in by_connection.items()
+                               for samples in pack_messages(group, self.samples_per_message)))
+
+    def stats(self):
+        return {**super().stats(), "messages": self.messages, "wire_format": self.wire_format}
+
+    async def close(self):
+        await asyncio.gather(*(client.disconnect() for client in self.clients), return_exceptions=True)
+
+
+# --- In-process (ProcessTelemetry senza cloud) ---
+
+class _Out:
+    """Sostituto minimale di func.Out: memorizza l'ultimo valore impostato."""
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class InProcessSink(TelemetrySink):
+    """Chiama process_telemetry_batch del blueprint telemetry con eventi Event Hub costruiti in memoria.
+    Cosmos, SignalR e advice-queue sono output catturati e contati (e passati a on_output se fornito);
+    con LOCAL_BACKEND=true vengono anche consegnati ai servizi locali, e GenerateAdvice gira sulla coda locale."""
+
+    name = "inprocess"
+
+    def __init__(self, on_output=None, wire_format=TELEMETRY_WIRE_FORMAT,
+                 samples_per_message=TELEMETRY_SAMPLES_PER_MESSAGE):
+        super().__init__()
+        self._codec = load_wire_format()
+        import azure.functions as func
+        from blueprints.telemetry import process_telemetry_batch
+
+        self._func = func
+        self._process = process_telemetry_batch
+        self.backend = load_local_backend()
+        self._lock = threading.Lock()
+        self.on_output = on_output
+        self.wire_format = wire_format
+        self.samples_per_message = samples_per_message
+        self.documents = 0
+        self.advice_requests = 0
+
+    def process(self, messages):
+        """Versione sincrona, usata anche da LocalIngestServer."""
+        events = [self._func.EventHubEvent(body=self._codec.encode(samples, self.wire_format)[0])
+                  for samples in pack_messages(messages, self.samples_per_message)]
+        documents, signalr, advice = self.backend.bindings() if self.backend else (_Out(), _Out(), _Out())
+        with self._lock:
+            self._process(events, documents, signalr, advice)
+            self.sent += len(messages)
+            self.documents += len(documents.value or [])
+            self.advice_requests += len(advice.value or [])
+        if self.on_output:
+            self.on_output(documents.value, signalr.value, advice.value)
+
+    async def send_batch(self, messages):
+        try:
+            self.process(messages)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"In-process ProcessTelemetry error: {e}")
+
+    def stats(self):
+        stats = {**super().stats(), "documents": self.documents, "advice_requests": self.advice_requests,
+                 "wire_format": self.wire_format}
+        if self.backend:
+            stats["local_backend"] = self.backend.stats()
+        return stats
+
+    async def close(self):
+        if self.backend:
+            # Lascia finire GenerateAdvice sulle richieste già accodate
+            if not await asyncio.to_thread(self.backend.close):
+                logger.warning("⚠️ Local advice-queue not drained before shutdown")
+
+
+# --- File JSONL ---
+
+class JsonlSink(TelemetrySink):
+    name = "jsonl"
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._file = None
+
+    async def open(self):
+        self._file = open(self.path, "a", encoding="utf-8", buffering=1 << 20)
+        logger.info(f"📝 Writing telemetry to {self.path}")
+
+    async def send_batch(self, messages):
+        self._file.write("".join(json.dumps(data, separators=(",", ":")) + "\n" for data in messages))
+        self.sent += len(messages)
+
+    async def close(self):
+        if self._file:
+            self._file.close()
+
+
+# --- Registrazione per replay.py ---
+
+def open_recording(path, mode):
+    """Apre una registrazione in testo, compressa gzip se il file termina in .gz."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class RecordingSink(TelemetrySink):
+    """Scrive ogni lettura con "t" = secondi dall'inizio della registrazione. La prima riga è
+    un header {"_meta": {...}} con i parametri del run."""
+
+    name = "record"
+
+    def __init__(self, path, meta=None):
+        super().__init__()
+        self.path = path
+        self.meta = meta or {}
+        self._file = None
+        self._start = None
+
+    async def open(self):
+        self._file = open_recording(self.path, "w")
+        self._file.write(json.dumps({"_meta": {"format": 1, **self.meta}}) + "\n")
+        self._start = time.monotonic()
+        logger.info(f"⏺️ Recording telemetry to {self.path}")
+
+    def write(self, messages, offset):
+        self._file.write("".join(
+            json.dumps({"t": round(offset, 3), **data}, separators=(",", ":")) + "\n" for data in messages
+        ))
+        self.sent += len(messages)
+
+    async def send_batch(self, messages):
+        self.write(messages, time.monotonic() - self._start)
+
+    async def close(self):
+        if self._file:
+            self._file.close()
+
+
+# --- HTTP locale ---
+
+class HttpSink(TelemetrySink):
+    """POST di letture (array JSON o messaggio binario) su un endpoint HTTP; pool di connessioni
+    keep-alive usate da thread."""
+
+    name = "http"
+
+    def __init__(self, url, pool_size=8, wire_format=TELEMETRY_WIRE_FORMAT):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host, self.port, self.path = parsed.hostname, parsed.port or 80, parsed.path or "/"
+        self.pool_size = pool_size
+        self.wire_format = wire_format
+        self._codec = load_wire_format()
+        self._pool = queue.LifoQueue()
+
+    def _post(self, part):
+        payload, content_type = self._codec.encode(part, self.wire_format)
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            conn.request("POST", self.path, body=payload, headers={"Content-Type": content_type})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 300:
+                raise RuntimeError(f"HTTP {response.status}")
+        except Exception:
+            conn.close()
+            raise
+        self._pool.put(conn)
+
+    async def send_batch(self, messages):
+        # Suddivide il batch tra le connessioni del pool
+        chunk = max(1, -(-len(messages) // self.pool_size))
+        chunks = [messages[i:i + chunk] for i in range(0, len(messages), chunk)]
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self._post, part) for part in chunks),
+            return_exceptions=True,
+        )
+        for part, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                self.errors += 1
+                logger.error(f"HTTP send error: {result}")
+            else:
+                self.sent += len(part)
+
+    def stats(self):
+        return {**super().stats(), "wire_format": self.wire_format}
+
+    async def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+class LocalIngestServer:
+    """Stand-in locale di IoT Hub: accetta POST di letture (JSON o binario, secondo il Content-Type)
+    e le passa a handler (di default InProcessSink.process). Gira in un thread; usare start()/stop()."""
+
+    def __init__(self, host="127.0.0.1", port=8088, handler=None):
+        self.handler = handler or InProcessSink().process
+        self.received = 0
+        codec = load_wire_format()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    messages = codec.decode(self.rfile.read(length), self.headers.get("Content-Type"))
+                    server.handler(messages)
+                    server.received += len(messages)
+                    status = 202
+                except Exception as e:
+                    logger.error(f"Local ingest error: {e}")
+                    status = 400
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/telemetry"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"🌐 Local ingest server listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
@@ -1,9 +1,9 @@
 import asyncio
-import json
 import random
 import time
 import os
 import logging
+import uuid
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -13,6 +13,8 @@ from azure.iot.device.aio import IoTHubDeviceClient
 from azure.iot.device import Message
 from azure.iot.hub import IoTHubRegistryManager
 
+from sinks import TELEMETRY_SAMPLES_PER_MESSAGE, TELEMETRY_WIRE_FORMAT, load_wire_format
+
 # --- CONFIGURAZIONE LOGGER ---
 logging.basicConfig(
     level=logging.INFO,
@@ -40,6 +42,15 @@ class VehicleSimulator:
         self.running = True
         self.last_feedback = "In attesa di feedback..."
         self.aggressive = aggressive
+
+        # Numerazione delle letture: monotona per veicolo, ricomincia a ogni avvio (nuovo boot_id).
+        # Il backend la usa per scartare le redelivery e riconoscere le letture fuori ordine
+        self.boot_id = uuid.uuid4().hex[:12]
+        self.seq = 0
+
+        # Letture in attesa di invio: con TELEMETRY_SAMPLES_PER_MESSAGE > 1 ne partono diverse per messaggio D2C
+        self.codec = load_wire_format()
+        self.pending = []
         
         # Fisica Base
         self.speed = 0.0
@@ -129,8 +140,11 @@ class VehicleSimulator:
             self.fuel_level = 0  # Segnala vuoto, il refuel avviene nel loop run()
 
     def get_telemetry(self):
+        self.seq += 1
         return {
             "vehicle_id": self.vehicle_id,
+            "seq": self.seq,
+            "boot_id": self.boot_id,
             "speed": round(self.speed, 2),
             "rpm": int(self.rpm),
             "gear": self.gear,
@@ -152,13 +166,9 @@ class VehicleSimulator:
                 f"🤖 {self.last_feedback}"
             )
             
-            try:
-                msg = Message(json.dumps(data))
-                msg.content_type = "application/json"
-                msg.content_encoding = "utf-8"
-                await self.device_client.send_message(msg)
-            except Exception as e:
-                logger.error(f"[{self.vehicle_id}] D2C send error: {e}")
+            self.pending.append(data)
+            if len(self.pending) >= TELEMETRY_SAMPLES_PER_MESSAGE:
+                await self.send_pending()
 
             # Refuel realistico: fermata ai box
             if self.fuel_level <= 0:
@@ -172,46 +182,66 @@ class VehicleSimulator:
                 
             await asyncio.sleep(TELEMETRY_INTERVAL_SEC + random.uniform(0, 1))
 
+    async def send_pending(self):
+        """Invia le letture accumulate in un solo messaggio D2C, nel formato TELEMETRY_WIRE_FORMAT."""
+        samples, self.pending = self.pending, []
+        if not samples:
+            return
+        try:
+            body, content_type = self.codec.encode(samples, TELEMETRY_WIRE_FORMAT)
+            msg = Message(body)
+            msg.content_type = content_type
+            if content_type == self.codec.CONTENT_TYPE_JSON:
+                msg.content_encoding = "utf-8"
+            await self.device_client.send_message(msg)
+        except Exception as e:
+            logger.error(f"[{self.vehicle_id}] D2C send error: {e}")
+
     async def stop(self):
         self.running = False
         if self.device_client:
+            await self.send_pending()
             await self.device_client.disconnect()
             logger.info(f"[{self.vehicle_id}] Disconnected.")
 
-def provision_fleet(service_conn_string, count):
-    """Crea device SOLO se non esistono già. Usa create_device_with_sas per la creazione."""
+def provision_device(registry_manager, hub_name, device_id):
+    """Restituisce (config, creato) per un device, creandolo con chiavi SAS se non esiste."""
     import base64
     import uuid
 
+    created_new = False
+    try:
+        device = registry_manager.get_device(device_id)
+    except Exception:
+        # Device non esiste, crealo con chiavi SAS auto-generate
+        primary_key = base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes).decode()
+        secondary_key = base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes).decode()
+        device = registry_manager.create_device_with_sas(
+            device_id, primary_key, secondary_key, "enabled"
+        )
+        created_new = True
+
+    # Get Key
+    primary_key = device.authentication.symmetric_key.primary_key
+    conn_str = f"HostName={hub_name};DeviceId={device_id};SharedAccessKey={primary_key}"
+    return {"id": device_id, "conn_str": conn_str}, created_new
+
+def provision_fleet(service_conn_string, count):
+    """Crea device SOLO se non esistono già. Usa create_device_with_sas per la creazione."""
     registry_manager = IoTHubRegistryManager(service_conn_string)
+    hub_name = service_conn_string.split(";")[0].split("=")[1]
     devices_config = []
     
     logger.info(f"🔧 Checking Fleet Status ({count} vehicles needed)...")
     
     for i in range(1, count + 1):
         device_id = f"{VEHICLE_PREFIX}{i:02d}"
-        created_new = False
-        
-        try:
-            device = registry_manager.get_device(device_id)
-        except Exception:
-            # Device non esiste, crealo con chiavi SAS auto-generate
-            primary_key = base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes).decode()
-            secondary_key = base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes).decode()
-            device = registry_manager.create_device_with_sas(
-                device_id, primary_key, secondary_key, "enabled"
-            )
-            created_new = True
-            
-        # Get Key
-        primary_key = device.authentication.symmetric_key.primary_key
-        hub_name = service_conn_string.split(";")[0].split("=")[1]
-        conn_str = f"HostName={hub_name};DeviceId={device_id};SharedAccessKey={primary_key}"
+        conf, created_new = provision_device(registry_manager, hub_name, device_id)
         
         status_icon = "✨ Created" if created_new else "♻️ Reused"
         logger.info(f"   [{status_icon}] {device_id}")
         
-        devices_config.append({"id": device_id, "conn_str": conn_str})
+        devices_config.append(conf)
         
     return devices_config
 